@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.contrib.auth.models import User
 from django.db.models import Count, Sum
 from django.utils.html import format_html
-from .models import AIModel, ChatConversation, ChatMessage, ModelUsageStat, Application
+from .models import AIModel, ApplicationFallbackModel, ChatConversation, ChatMessage, ModelUsageStat, Application
 
 # 自定义过滤器
 class ActiveModelFilter(admin.SimpleListFilter):
@@ -27,8 +27,8 @@ class ActiveModelFilter(admin.SimpleListFilter):
 class ChatMessageInline(admin.TabularInline):
     model = ChatMessage
     extra = 0
-    readonly_fields = ('timestamp', 'role', 'content', 'tokens', 'cost')
-    fields = ('timestamp', 'role', 'content', 'model_used', 'tokens', 'cost')
+    readonly_fields = ('timestamp', 'role', 'content', 'tokens', 'cost', 'retrieval_mode')
+    fields = ('timestamp', 'role', 'content', 'model_used', 'tokens', 'cost', 'retrieval_mode')
     
     def has_add_permission(self, request, obj=None):
         return False
@@ -49,11 +49,16 @@ class ChatConversationInline(admin.TabularInline):
 class ModelUsageStatInline(admin.TabularInline):
     model = ModelUsageStat
     extra = 0
-    readonly_fields = ('date', 'call_count', 'total_tokens', 'total_cost')
+    readonly_fields = ('date', 'application', 'call_count', 'total_tokens', 'total_cost')
     
     def has_add_permission(self, request, obj=None):
         return False
 
+class ApplicationFallbackModelInline(admin.TabularInline):
+    model = ApplicationFallbackModel
+    extra = 0
+    fields = ('model', 'priority')
+
 # 主管理类
 @admin.register(Application)
 class ApplicationAdmin(admin.ModelAdmin):
@@ -65,18 +70,21 @@ class ApplicationAdmin(admin.ModelAdmin):
             'fields': ('name', 'description', 'user', 'is_active', 'icon_svg', 'avatar')
         }),
         ('模型设置', {
-            'fields': ('model', 'embedding_model')
+            'fields': ('model', 'hedge_after', 'embedding_model'),
+            'description': '备用模型在页面下方添加，主模型出错（或超过对冲等待时间未响应）时按优先级依次使用'
         }),
         ('知识库设置', {
-            'fields': ('knowledge_similarity_threshold', 'max_knowledge_items'),
+            'fields': ('knowledge_similarity_threshold', 'max_knowledge_items', 'retrieval_strategy',
+                       'rerank_model', 'rerank_candidates', 'rerank_threshold', 'direct_answer_threshold',
+                       'retrieval_timeout'),
             'classes': ('collapse',),
             'description': '这些设置仅在选择了向量模型时生效'
         }),
         ('对话设置', {
-            'fields': ('system_role',)
+            'fields': ('system_role', 'summary_model', 'response_cache_enabled')
         })
     )
-    inlines = [ChatConversationInline]
+    inlines = [ApplicationFallbackModelInline, ChatConversationInline]
     
     def display_icon(self, obj):
         if obj.icon_svg:
@@ -114,6 +122,11 @@ class AIModelAdmin(admin.ModelAdmin):
             'fields': ('api_url', 'api_key', 'max_tokens_limit'),
             'classes': ('collapse',)
         }),
+        ('限流', {
+            'fields': ('max_concurrent_streams', 'requests_per_minute', 'tokens_per_minute'),
+            'classes': ('collapse',),
+            'description': '按服务商的限额设置，所有 worker 共同遵守；超出时请求排队等待，超过等待时间返回 429'
+        }),
         ('定价策略', {
             'fields': ('input_token_price', 'output_token_price'),
             'classes': ('collapse',)
@@ -164,6 +177,6 @@ class ChatConversationAdmin(admin.ModelAdmin):
 
 @admin.register(ModelUsageStat)
 class ModelUsageStatAdmin(admin.ModelAdmin):
-    list_display = ('model', 'date', 'call_count', 'total_tokens', 'total_cost')
-    list_filter = ('model', 'date')
+    list_display = ('model', 'date', 'application', 'call_count', 'total_tokens', 'total_cost')
+    list_filter = ('model', 'application', 'date')
     search_fields = ('model__name',)
\ No newline at end of file
@@ -0,0 +1,369 @@
+"""ASGI 下使用的异步流式对话视图
+
+与 views.MessageStreamView / views.ChatStreamView 行为一致，但模型调用使用 AsyncOpenAI、
+数据库访问使用异步ORM，单个进程即可同时保持大量SSE连接。
+通过 settings.CHAT_ASYNC_STREAMING（SERVER_MODE=asgi 时开启）在路由中启用。
+"""
+import asyncio
+import json
+import time
+import uuid
+from datetime import datetime
+
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from .failover import ModelRouter, acandidate_models
+from .models import Application, ChatConversation, ChatMessage
+from .services import (
+    SSE_DONE, aprepare_generation, assistant_accounting, build_messages, chunk_delta, direct_answer_fields,
+    may_skip_model, parse_max_tokens, progress_event, replay_events, resolve_usage, sse_event, uses_knowledge_base
+)
+from .ratelimit import (
+    AsyncPermitReleasingStream, RateLimitExceeded, get_rate_limiter, rate_limited_payload, rate_limited_response
+)
+from .response_cache import cached_answer_fields, get_response_cache, response_cache_key
+from .summary import schedule_summary
+from .tokens import count_tokens
+
+
+def _streaming_response(stream, permit=None):
+    response = StreamingHttpResponse(AsyncPermitReleasingStream(stream, permit), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def _get_application(application_id):
+    """查询应用，不存在或未激活时返回对应的错误响应"""
+    try:
+        application = await Application.objects.select_related(
+            'model', 'embedding_model', 'rerank_model'
+        ).aget(id=application_id)
+    except Application.DoesNotExist:
+        return None, JsonResponse({"error": "应用不存在"}, status=404)
+    if not application.is_active:
+        return None, JsonResponse(
+            {
+                "error": "应用未激活",
+                "code": "APPLICATION_NOT_ACTIVE",
+                "status": 403
+            },
+            status=403
+        )
+    return application, None
+
+
+async def _acquire_permit(application, content, max_tokens):
+    """按模型限流排队取得请求额度，返回 (候选模型, 额度, 错误响应)"""
+    models = await acandidate_models(application)
+    try:
+        permit = await get_rate_limiter().aacquire(models, count_tokens(content or '') + max_tokens)
+    except RateLimitExceeded as e:
+        return models, None, rate_limited_response(e)
+    return models, permit, None
+
+
+async def stream_completion(application, conversation, prep, start_time, models, permit,
+                            temperature=0.7, max_tokens=2000, response_cache=False):
+    """调用模型并以SSE格式异步输出，结束后保存助手消息
+
+    prep 为 aprepare_generation 的结果；models 与 permit 为候选模型与排队取得的额度，
+    permit 为None时在确定需要调用模型后才排队；response_cache 为True时可使用回答缓存。
+    """
+    try:
+        history = prep.history
+        retrieval = prep.retrieval
+        prompt = retrieval.prompt
+        question = prep.user_message.content
+
+        # 语义相同的问题回放缓存的回答，不调用模型
+        cache_key = response_cache and response_cache_key(application, conversation, history, retrieval)
+        cached = cache_key and await asyncio.to_thread(
+            get_response_cache().lookup, cache_key, question, retrieval.query_embedding
+        )
+        if cached:
+            print(f"[green]命中回答缓存，相似度: {cached[1]:.4f}，不调用模型[/]")
+            for event in replay_events(cached[0]):
+                yield event
+            await ChatMessage.objects.acreate(
+                conversation=conversation,
+                role='assistant',
+                retrieval_mode=prep.retrieval.mode,
+                **cached_answer_fields(cached, time.time() - start_time, prep.timings)
+            )
+            schedule_summary(application, conversation)
+            yield SSE_DONE
+            return
+
+        if permit is None:
+            try:
+                permit = await get_rate_limiter().aacquire(models, count_tokens(question or '') + max_tokens)
+            except RateLimitExceeded as e:
+                yield sse_event(rate_limited_payload(e))
+                return
+
+        messages = build_messages(application, conversation, history, prompt, max_tokens)
+
+        api_start = time.time()
+        print(f"\n开始调用OpenAI API(异步): {time.strftime('%Y-%m-%d %H:%M:%S')}")
+        # 主模型出错或响应慢时使用备用模型
+        router = ModelRouter(application, models, messages, temperature, max_tokens, permit)
+
+        first_chunk_time = None
+        total_chunks = 0
+        full_response = ""
+        full_reasoning = ""
+        usage = None
+        async for chunk in router.astream():
+            usage = getattr(chunk, 'usage', None) or usage
+            if not chunk.choices:
+                continue
+            if first_chunk_time is None:
+                first_chunk_time = time.time()
+                print(f"第一个响应块耗时: {first_chunk_time - api_start:.3f}秒")
+            total_chunks += 1
+            content, reasoning = chunk_delta(chunk)
+            if content:
+                full_response += content
+                yield sse_event({'content': content})
+            if reasoning:
+                full_reasoning += reasoning
+                yield sse_event({'reasoning_content': reasoning})
+
+        end_time = time.time()
+        usage = resolve_usage(usage, messages, full_response, full_reasoning)
+        accounting = assistant_accounting(
+            router.model, usage, end_time - api_start,
+            first_chunk_time - api_start if first_chunk_time else None,
+            prep.timings
+        )
+        router.annotate(accounting['api_response'])
+        if cache_key and full_response:
+            accounting['api_response']['response_cache'] = 'miss'
+            await asyncio.to_thread(
+                get_response_cache().store, cache_key, question, retrieval.query_embedding, full_response
+            )
+        await ChatMessage.objects.acreate(
+            conversation=conversation,
+            role='assistant',
+            content=full_response,
+            reasoning=full_reasoning,
+            model_used=router.model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            retrieval_mode=prep.retrieval.mode,
+            **accounting
+        )
+        # 后台更新会话摘要，不阻塞当前响应
+        schedule_summary(application, conversation)
+
+        print(f"\n[bold green]执行完成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}[/]")
+        print(f"[dim]总执行时间: {round(end_time - start_time, 3)} 秒, "
+              f"API请求总耗时: {round(end_time - api_start, 3)} 秒, 总响应块数: {total_chunks}, token用量: {usage}[/]")
+
+        yield SSE_DONE
+
+    except Exception as e:
+        print(f"\n流式处理出错: {str(e)}")
+        yield sse_event({'error': str(e)})
+    finally:
+        if permit is not None:
+            permit.release()
+
+
+async def stream_direct_answer(application, conversation, prep, start_time):
+    """命中直接回答时按块输出知识答案并保存助手消息，不调用模型"""
+    try:
+        direct = prep.retrieval.direct_answer
+        for event in replay_events(direct[1]):
+            yield event
+        await ChatMessage.objects.acreate(
+            conversation=conversation,
+            role='assistant',
+            retrieval_mode=prep.retrieval.mode,
+            **direct_answer_fields(direct, time.time() - start_time, prep.timings)
+        )
+        schedule_summary(application, conversation)
+        print(f"[bold green]直接回答完成，总执行时间: {round(time.time() - start_time, 3)} 秒[/]")
+        yield SSE_DONE
+    except Exception as e:
+        print(f"\n流式处理出错: {str(e)}")
+        yield sse_event({'error': str(e)})
+
+
+async def stream_message(application, conversation, content, start_time, models, permit):
+    """先发出检索进度事件，在流内并发保存用户消息、读取历史与检索知识，再调用模型（或直接回答）"""
+    try:
+        async for event in _stream_message(application, conversation, content, start_time, models, permit):
+            yield event
+    finally:
+        # 出错时没有调用模型，同样释放额度
+        if permit is not None:
+            permit.release()
+
+
+async def _stream_message(application, conversation, content, start_time, models, permit):
+    try:
+        knowledge_base = uses_knowledge_base(application)
+        if knowledge_base:
+            yield progress_event('retrieval_started')
+        prep = await aprepare_generation(application, conversation, content, retrieve=knowledge_base)
+        if knowledge_base:
+            yield progress_event(
+                'retrieval_done',
+                hits=len(prep.retrieval.results),
+                elapsed=prep.timings['retrieval'],
+                mode=prep.retrieval.mode
+            )
+        if prep.retrieval.direct_answer:
+            stream = stream_direct_answer(application, conversation, prep, start_time)
+        else:
+            stream = stream_completion(
+                application, conversation, prep, start_time, models, permit, response_cache=True
+            )
+    except Exception as e:
+        print(f"\n流式处理出错: {str(e)}")
+        yield sse_event({'error': str(e)})
+        return
+    async for event in stream:
+        yield event
+
+
+async def stream_chat(application, conversation, content, start_time, models, permit, temperature, max_tokens):
+    """并发保存用户消息与读取历史后调用模型"""
+    try:
+        try:
+            prep = await aprepare_generation(application, conversation, content)
+        except Exception as e:
+            print(f"\n流式处理出错: {str(e)}")
+            yield sse_event({'error': str(e)})
+            return
+        async for event in stream_completion(
+            application, conversation, prep, start_time, models, permit, temperature, max_tokens
+        ):
+            yield event
+    finally:
+        permit.release()
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncMessageStreamView(View):
+    """流式消息处理（异步）"""
+
+    async def post(self, request, application_id, conversation_id):
+        start_time = time.time()
+        try:
+            data = json.loads(request.body)
+            session_id = data.get('session_id')
+            user_message = data.get('message')
+
+            if not session_id:
+                return JsonResponse(
+                    {"error": "缺少session_id参数"},
+                    status=400
+                )
+
+            application, error_response = await _get_application(application_id)
+            if error_response:
+                return error_response
+
+            try:
+                conversation = await ChatConversation.objects.aget(
+                    conversation_id=conversation_id,
+                    session_id=session_id,
+                    application=application
+                )
+            except ChatConversation.DoesNotExist:
+                return JsonResponse({"error": "会话不存在"}, status=404)
+
+            # 按模型限流：排队取得请求额度，超过等待时间直接返回 429；
+            # 可能直接回答或回放缓存的应用在流内确定需要调用模型后才排队，不调用模型的请求不占额度
+            if may_skip_model(application):
+                models, permit = await acandidate_models(application), None
+            else:
+                models, permit, error_response = await _acquire_permit(application, user_message, 2000)
+                if error_response:
+                    return error_response
+
+            return _streaming_response(
+                stream_message(application, conversation, user_message, start_time, models, permit),
+                permit
+            )
+
+        except Exception as e:
+            print(f"\n请求处理错误: {str(e)}")
+            return JsonResponse(
+                {"error": str(e)},
+                status=500
+            )
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatStreamView(View):
+    """流式聊天API接口（异步）"""
+
+    async def post(self, request, *args, **kwargs):
+        start_time = time.time()
+        permit = None
+        try:
+            data = json.loads(request.body)
+            session_id = data.get('session_id')
+            message = data.get('message') or ''
+
+            application, error_response = await _get_application(data.get('application_id'))
+            if error_response:
+                return error_response
+
+            try:
+                max_tokens = parse_max_tokens(data.get('max_tokens'), application.model)
+            except ValueError as e:
+                return JsonResponse({"error": str(e)}, status=400)
+
+            # 按模型限流：排队取得请求额度，超过等待时间直接返回 429，不创建对话
+            models, permit, error_response = await _acquire_permit(application, message, max_tokens)
+            if error_response:
+                return error_response
+
+            # 获取或创建对话
+            conversation_id = data.get('conversation_id')
+            if conversation_id:
+                try:
+                    conversation = await ChatConversation.objects.aget(
+                        conversation_id=conversation_id,
+                        session_id=session_id,
+                        application=application
+                    )
+                except ChatConversation.DoesNotExist:
+                    permit.release()
+                    return JsonResponse({"error": "会话不存在"}, status=404)
+            else:
+                conversation = await ChatConversation.objects.acreate(
+                    session_id=session_id,
+                    application=application,
+                    conversation_id=str(uuid.uuid4()),
+                    title=message[:50] if message else '新对话',  # 使用用户消息作为标题
+                    model=application.model
+                )
+
+            return _streaming_response(
+                stream_chat(
+                    application, conversation, message, start_time, models, permit,
+                    temperature=data.get('temperature', 0.7),
+                    max_tokens=max_tokens
+                ),
+                permit
+            )
+
+        except json.JSONDecodeError:
+            return JsonResponse({"error": "无效的JSON数据"}, status=400)
+        except Exception as e:
+            print(f"\n请求处理错误: {str(e)}")
+            if permit is not None:
+                permit.release()
+            return JsonResponse(
+                {"error": str(e)},
+                status=500
+            )
@@ -0,0 +1,119 @@
+"""进程级 OpenAI 客户端注册表
+
+同一 (api_url, api_key) 在进程内复用一个客户端及其 httpx 连接池（keep-alive，
+可用时启用 HTTP/2），避免每轮对话重新建立连接、TLS握手和DNS解析。
+连接池参数在 settings.OPENAI_CLIENT_POOL 中配置::
+
+    OPENAI_CLIENT_POOL = {
+        'MAX_CONNECTIONS': 100,
+        'MAX_KEEPALIVE_CONNECTIONS': 20,
+        'KEEPALIVE_EXPIRY': 60,
+        'CONNECT_TIMEOUT': 10,
+        'READ_TIMEOUT': 300,
+        'HTTP2': True,        # 需要安装 h2，未安装时自动退回 HTTP/1.1
+        'MAX_RETRIES': 2,
+        'MAX_CLIENTS': 64,    # 注册表最多保留的客户端数，超出后淘汰最久未用的
+    }
+
+AIModel / EmbeddingModel 的地址或密钥变更后，会从注册表中移除旧客户端。
+"""
+import asyncio
+import importlib.util
+import logging
+import threading
+from collections import OrderedDict
+
+import httpx
+from django.conf import settings
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_CONFIG = {
+    'MAX_CONNECTIONS': 100,
+    'MAX_KEEPALIVE_CONNECTIONS': 20,
+    'KEEPALIVE_EXPIRY': 60,
+    'CONNECT_TIMEOUT': 10,
+    'READ_TIMEOUT': 300,
+    'HTTP2': True,
+    'MAX_RETRIES': 2,
+    'MAX_CLIENTS': 64,
+}
+
+_clients = OrderedDict()
+_lock = threading.Lock()
+
+
+def pool_config():
+    return {**DEFAULT_POOL_CONFIG, **getattr(settings, 'OPENAI_CLIENT_POOL', {})}
+
+
+def _http_options(config):
+    return {
+        'limits': httpx.Limits(
+            max_connections=config['MAX_CONNECTIONS'],
+            max_keepalive_connections=config['MAX_KEEPALIVE_CONNECTIONS'],
+            keepalive_expiry=config['KEEPALIVE_EXPIRY'],
+        ),
+        'timeout': httpx.Timeout(config['READ_TIMEOUT'], connect=config['CONNECT_TIMEOUT']),
+        'http2': bool(config['HTTP2']) and importlib.util.find_spec('h2') is not None,
+    }
+
+
+def _get_or_create(key, factory):
+    with _lock:
+        client = _clients.get(key)
+        if client is not None:
+            _clients.move_to_end(key)
+            return client
+        client = factory()
+        _clients[key] = client
+        # 超出上限时只移出注册表，不主动关闭，避免打断仍在使用它的请求
+        while len(_clients) > pool_config()['MAX_CLIENTS']:
+            _clients.popitem(last=False)
+        return client
+
+
+def get_openai_client(api_url, api_key) -> OpenAI:
+    """获取复用连接池的同步客户端"""
+    def factory():
+        config = pool_config()
+        logger.info(f"创建OpenAI客户端: {api_url}")
+        return OpenAI(
+            base_url=api_url,
+            api_key=api_key,
+            max_retries=config['MAX_RETRIES'],
+            http_client=DefaultHttpxClient(**_http_options(config)),
+        )
+    return _get_or_create(('sync', api_url, api_key), factory)
+
+
+def get_async_openai_client(api_url, api_key) -> AsyncOpenAI:
+    """获取复用连接池的异步客户端
+
+    异步连接池与事件循环绑定，因此按事件循环分别缓存。键中保存事件循环对象本身而不是 id()：
+    已关闭的事件循环被回收后 id 可能被新的事件循环复用，会拿到绑定在旧循环上的客户端。
+    """
+    loop = asyncio.get_running_loop()
+
+    def factory():
+        config = pool_config()
+        logger.info(f"创建AsyncOpenAI客户端: {api_url}")
+        return AsyncOpenAI(
+            base_url=api_url,
+            api_key=api_key,
+            max_retries=config['MAX_RETRIES'],
+            http_client=DefaultAsyncHttpxClient(**_http_options(config)),
+        )
+    return _get_or_create(('async', loop, api_url, api_key), factory)
+
+
+def invalidate_clients(api_url, api_key) -> int:
+    """移除指定地址与密钥对应的全部客户端，返回移除数量"""
+    with _lock:
+        keys = [key for key in _clients if key[-2:] == (api_url, api_key)]
+        for key in keys:
+            del _clients[key]
+    if keys:
+        logger.info(f"已移除 {len(keys)} 个OpenAI客户端: {api_url}")
+    return len(keys)
@@ -0,0 +1,459 @@
+"""主模型与备用模型之间的故障转移与对冲请求
+
+应用可按优先级配置若干备用模型（ApplicationFallbackModel），调用时按 主模型 → 备用模型 的顺序尝试：
+某个模型在返回第一个有内容的响应块（正文、思考过程或工具调用；只含角色或用量的块不算）之前
+出错（连接失败、接口报错、限流等）时改用下一个模型；已经开始输出后出错则不再切换，按原来的方式返回错误。
+还有备用模型时不在同一模型上重试。
+
+应用设置了"对冲等待时间"（hedge_after）时，正在请求的模型超过该时间仍未返回有内容的响应块，
+就同时向下一个模型发出请求，采用先返回有内容的响应块的一方，另一方的请求被取消；同一时间最多两个请求在途。
+同步视图在后台线程中读取各个请求，取消时只做标记，由读取该请求的线程自己关闭响应流；异步视图使用协程任务。
+
+实际回答的模型记录在助手消息的 model_used 中，尝试过多个模型时过程记录在 api_response['model_attempts']。
+
+模型设置了限流（见 chat/ratelimit.py）时，第一个模型使用视图排队取得的额度，
+故障转移与对冲请求的模型没有余量时直接跳过；各次请求结束后释放额度，回答的模型按实际用量修正预占的token数。
+"""
+import asyncio
+import queue
+import threading
+import time
+
+from .clients import get_async_openai_client, get_openai_client
+from .models import ApplicationFallbackModel
+from .ratelimit import RateLimitExceeded, get_rate_limiter
+from .services import STREAM_OPTIONS, chunk_delta
+from .tokens import count_message_tokens
+
+# 请求正常结束（工作线程 / 任务放入事件队列的标记）
+_DONE = object()
+
+
+def _has_output(chunk):
+    """响应块是否包含实际输出（正文、思考过程或工具调用），据此决定采用哪个模型"""
+    if not chunk.choices:
+        return False
+    content, reasoning = chunk_delta(chunk)
+    return bool(content or reasoning or getattr(chunk.choices[0].delta, 'tool_calls', None))
+
+
+def _fallback_queryset(application):
+    return ApplicationFallbackModel.objects.filter(
+        application=application, model__is_active=True
+    ).exclude(model_id=application.model_id).select_related('model').order_by('priority', 'id')
+
+
+def candidate_models(application):
+    """主模型与按优先级排列的激活备用模型"""
+    fallbacks = [fallback.model for fallback in _fallback_queryset(application)]
+    return ([application.model] if application.model else []) + fallbacks
+
+
+async def acandidate_models(application):
+    """candidate_models 的异步版本"""
+    fallbacks = [fallback.model async for fallback in _fallback_queryset(application)]
+    return ([application.model] if application.model else []) + fallbacks
+
+
+class ModelAttempt:
+    """对一个模型的一次流式请求"""
+
+    def __init__(self, model, last):
+        self.model = model
+        self.last = last
+        self.start = time.time()
+        self.status = 'pending'
+        self.error = None
+        # 第一个有内容的响应块之前收到的块（如只含角色或用量的块），提交后一并输出
+        self.pending = []
+        self.task = None
+        self.permit = None
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """停止请求：异步请求取消任务；同步请求只做标记，响应流由读取它的工作线程关闭"""
+        self.cancelled.set()
+        if self.status == 'pending':
+            self.status = 'cancelled'
+        if self.task is not None:
+            self.task.cancel()
+
+
+class ModelRouter:
+    """按顺序（或对冲）请求候选模型，输出实际回答的模型的响应块"""
+
+    def __init__(self, application, models, messages, temperature, max_tokens, permit=None):
+        self.models = list(models)
+        self.permit = permit
+        if permit is not None:
+            # 先请求已取得额度的模型
+            self.models = [permit.model] + [model for model in self.models if model.pk != permit.model.pk]
+        self.messages = messages
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.tokens = count_message_tokens(messages) + max_tokens
+        self.hedge_after = application.hedge_after
+        self.model = None
+        self.attempts = []
+        self.started_at = None
+        self.usage = None
+
+    def _request_kwargs(self, model):
+        return {
+            'model': model.name,
+            'messages': self.messages,
+            'stream': True,
+            'temperature': self.temperature,
+            'max_tokens': self.max_tokens,
+            'stream_options': STREAM_OPTIONS,
+        }
+
+    def _client(self, attempt, factory):
+        client = factory(attempt.model.api_url, attempt.model.api_key)
+        # 还有备用模型时出错直接切换，不在同一模型上重试
+        return client if attempt.last else client.with_options(max_retries=0)
+
+    def _begin(self, index):
+        attempt = ModelAttempt(self.models[index], index == len(self.models) - 1)
+        self.attempts.append(attempt)
+        print(f"请求模型: {attempt.model.name}")
+        return attempt
+
+    def _acquire(self, attempt):
+        # 第一个模型使用视图排队取得的额度，其余模型没有余量时不等待，按失败处理
+        if self.permit is not None and attempt is self.attempts[0]:
+            attempt.permit = self.permit
+            return
+        permit, wait = get_rate_limiter().try_acquire(attempt.model, self.tokens)
+        if permit is None:
+            raise RateLimitExceeded(attempt.model, wait)
+        attempt.permit = permit
+
+    async def _aacquire(self, attempt):
+        # 限流存储（SQLite 文件、Redis）的读写会阻塞，放到线程中执行
+        await asyncio.to_thread(self._acquire, attempt)
+
+    def _observe(self, chunk):
+        self.usage = getattr(chunk, 'usage', None) or self.usage
+        return chunk
+
+    def release(self):
+        """释放各次请求占用的额度：回答的模型按实际用量，失败的请求不计token，被取消的保留预占"""
+        for attempt in self.attempts:
+            if attempt.permit is None:
+                continue
+            tokens = None
+            if attempt.status == 'answered' and self.usage is not None:
+                tokens = (self.usage.prompt_tokens or 0) + (self.usage.completion_tokens or 0)
+            elif attempt.status == 'failed':
+                tokens = 0
+            attempt.permit.release(tokens)
+
+    def _fail(self, attempt, error):
+        attempt.status = 'failed'
+        attempt.error = str(error)
+        print(f"[yellow]模型 {attempt.model.name} 请求失败: {str(error)}[/]")
+        return error
+
+    def _commit(self, attempt, others=()):
+        attempt.status = 'answered'
+        self.model = attempt.model
+        for other in others:
+            if other is not attempt:
+                other.cancel()
+        if len(self.attempts) > 1:
+            print(f"[green]由模型 {attempt.model.name} 回答[/]")
+
+    def _check_models(self):
+        if not self.models:
+            raise ValueError("应用未配置模型")
+        self.started_at = time.time()
+
+    def _should_hedge(self, running, remaining):
+        return self.hedge_after and len(running) == 1 and remaining
+
+    def _hedge_notice(self, attempt, index):
+        print(f"[yellow]模型 {attempt.model.name} 超过 {self.hedge_after} 秒未返回，"
+              f"同时请求 {self.models[index].name}[/]")
+
+    def report(self):
+        """各次尝试的模型、结果与相对开始时间，只尝试了一个模型时为None"""
+        if len(self.attempts) < 2:
+            return None
+        return [
+            {
+                'model': attempt.model.name,
+                'status': attempt.status,
+                'started': round(attempt.start - self.started_at, 3),
+                **({'error': attempt.error} if attempt.error else {}),
+            }
+            for attempt in self.attempts
+        ]
+
+    def annotate(self, api_response):
+        """把尝试过程写入助手消息的 api_response"""
+        attempts = self.report()
+        if attempts:
+            api_response['model_attempts'] = attempts
+        return api_response
+
+    # 同步
+
+    def stream(self):
+        """同步输出响应块；所有模型都在开始输出前失败时抛出最后一个错误"""
+        self._check_models()
+        if self.hedge_after and len(self.models) > 1:
+            stream = self._hedged_stream()
+        else:
+            stream = self._sequential_stream()
+        try:
+            for chunk in stream:
+                yield self._observe(chunk)
+        finally:
+            stream.close()
+            self.release()
+
+    def _sequential_stream(self):
+        error = None
+        for index in range(len(self.models)):
+            attempt = self._begin(index)
+            response = None
+            try:
+                self._acquire(attempt)
+                response = self._client(attempt, get_openai_client).chat.completions.create(
+                    **self._request_kwargs(attempt.model)
+                )
+                chunks = iter(response)
+                for chunk in chunks:
+                    attempt.pending.append(chunk)
+                    if _has_output(chunk):
+                        break
+            except Exception as e:
+                error = self._fail(attempt, e)
+                if response is not None:
+                    response.close()
+                continue
+            self._commit(attempt)
+            yield from attempt.pending
+            yield from chunks
+            return
+        raise error
+
+    def _run(self, attempt, events):
+        # 工作线程：读取一个模型的响应流并放入事件队列；被取消后在收到下一个响应块时停止，
+        # 响应流只由本线程关闭（httpx 的流不能在读取它的线程之外关闭）
+        response = None
+        try:
+            response = self._client(attempt, get_openai_client).chat.completions.create(
+                **self._request_kwargs(attempt.model)
+            )
+            if attempt.cancelled.is_set():
+                return
+            for chunk in response:
+                if attempt.cancelled.is_set():
+                    return
+                events.put((attempt, chunk))
+            events.put((attempt, _DONE))
+        except Exception as e:
+            if not attempt.cancelled.is_set():
+                events.put((attempt, e))
+        finally:
+            if response is not None:
+                response.close()
+
+    def _hedged_stream(self):
+        events = queue.Queue()
+        remaining = list(range(len(self.models)))
+        running = []
+        winner = None
+        finished = False
+        error = None
+
+        def launch():
+            nonlocal error
+            attempt = self._begin(remaining.pop(0))
+            try:
+                self._acquire(attempt)
+            except RateLimitExceeded as e:
+                error = self._fail(attempt, e)
+                return
+            running.append(attempt)
+            threading.Thread(target=self._run, args=(attempt, events), daemon=True).start()
+
+        try:
+            while winner is None:
+                if not running:
+                    if not remaining:
+                        raise error
+                    launch()
+                    continue
+                timeout = None
+                if self._should_hedge(running, remaining):
+                    timeout = max(running[0].start + self.hedge_after - time.time(), 0)
+                try:
+                    attempt, item = events.get(timeout=timeout)
+                except queue.Empty:
+                    self._hedge_notice(running[0], remaining[0])
+                    launch()
+                    continue
+                if attempt not in running:
+                    continue
+                if isinstance(item, Exception):
+                    error = self._fail(attempt, item)
+                    running.remove(attempt)
+                    continue
+                if item is _DONE:
+                    # 没有输出任何内容就正常结束，同样采用
+                    finished = True
+                else:
+                    attempt.pending.append(item)
+                    if not _has_output(item):
+                        continue
+                winner = attempt
+                self._commit(winner, running)
+
+            yield from winner.pending
+            if finished:
+                return
+            while True:
+                attempt, item = events.get()
+                if attempt is not winner:
+                    continue
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # 客户端断开或出错时关闭仍在进行的请求
+            for attempt in running:
+                attempt.cancel()
+
+    # 异步
+
+    async def astream(self):
+        """stream 的异步版本"""
+        self._check_models()
+        if self.hedge_after and len(self.models) > 1:
+            stream = self._ahedged_stream()
+        else:
+            stream = self._asequential_stream()
+        try:
+            async for chunk in stream:
+                yield self._observe(chunk)
+        finally:
+            await stream.aclose()
+            self.release()
+
+    async def _asequential_stream(self):
+        error = None
+        for index in range(len(self.models)):
+            attempt = self._begin(index)
+            response = None
+            try:
+                await self._aacquire(attempt)
+                response = await self._client(attempt, get_async_openai_client).chat.completions.create(
+                    **self._request_kwargs(attempt.model)
+                )
+                chunks = response.__aiter__()
+                async for chunk in chunks:
+                    attempt.pending.append(chunk)
+                    if _has_output(chunk):
+                        break
+            except Exception as e:
+                error = self._fail(attempt, e)
+                if response is not None:
+                    await response.close()
+                continue
+            self._commit(attempt)
+            for chunk in attempt.pending:
+                yield chunk
+            async for chunk in chunks:
+                yield chunk
+            return
+        raise error
+
+    async def _arun(self, attempt, events):
+        response = None
+        try:
+            response = await self._client(attempt, get_async_openai_client).chat.completions.create(
+                **self._request_kwargs(attempt.model)
+            )
+            async for chunk in response:
+                events.put_nowait((attempt, chunk))
+            events.put_nowait((attempt, _DONE))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            events.put_nowait((attempt, e))
+        finally:
+            if response is not None:
+                await response.close()
+
+    async def _ahedged_stream(self):
+        events = asyncio.Queue()
+        remaining = list(range(len(self.models)))
+        running = []
+        winner = None
+        finished = False
+        error = None
+
+        async def launch():
+            nonlocal error
+            attempt = self._begin(remaining.pop(0))
+            try:
+                await self._aacquire(attempt)
+            except RateLimitExceeded as e:
+                error = self._fail(attempt, e)
+                return
+            running.append(attempt)
+            attempt.task = asyncio.ensure_future(self._arun(attempt, events))
+
+        try:
+            while winner is None:
+                if not running:
+                    if not remaining:
+                        raise error
+                    await launch()
+                    continue
+                timeout = None
+                if self._should_hedge(running, remaining):
+                    timeout = max(running[0].start + self.hedge_after - time.time(), 0)
+                try:
+                    attempt, item = await asyncio.wait_for(events.get(), timeout)
+                except asyncio.TimeoutError:
+                    self._hedge_notice(running[0], remaining[0])
+                    await launch()
+                    continue
+                if attempt not in running:
+                    continue
+                if isinstance(item, Exception):
+                    error = self._fail(attempt, item)
+                    running.remove(attempt)
+                    continue
+                if item is _DONE:
+                    # 没有输出任何内容就正常结束，同样采用
+                    finished = True
+                else:
+                    attempt.pending.append(item)
+                    if not _has_output(item):
+                        continue
+                winner = attempt
+                self._commit(winner, running)
+
+            for chunk in winner.pending:
+                yield chunk
+            if finished:
+                return
+            while True:
+                attempt, item = await events.get()
+                if attempt is not winner:
+                    continue
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            for attempt in running:
+                attempt.cancel()
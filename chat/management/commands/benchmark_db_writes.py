@@ -0,0 +1,143 @@
+import multiprocessing
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections, transaction
+
+ENGINES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'OPTIONS': {},
+    },
+    'wal': {
+        'ENGINE': 'gongjuyuan_chat.sqlite_wal',
+        'OPTIONS': {'timeout': 20, 'transaction_mode': 'IMMEDIATE'},
+    },
+}
+
+SCHEMA = [
+    "CREATE TABLE bench_conversation ("
+    " id INTEGER PRIMARY KEY, total_tokens INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE bench_message ("
+    " id INTEGER PRIMARY KEY AUTOINCREMENT, conversation_id INTEGER NOT NULL,"
+    " role TEXT NOT NULL, content TEXT NOT NULL, tokens INTEGER NOT NULL, timestamp REAL NOT NULL)",
+    "CREATE INDEX bench_message_conversation ON bench_message (conversation_id, timestamp)",
+]
+
+
+def _register(alias, engine, path):
+    """在当前进程中注册基准测试用的数据库别名"""
+    config = {'NAME': path, **ENGINES[engine]}
+    connections.settings[alias] = connections.configure_settings({'default': config})['default']
+
+
+def _turn(alias, conversation_id, content):
+    """模拟一轮对话的数据库访问：读取历史，保存用户消息与助手消息并更新会话统计"""
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT role, content FROM bench_message WHERE conversation_id = %s"
+            " ORDER BY timestamp DESC LIMIT 40",
+            [conversation_id]
+        )
+        cursor.fetchall()
+    started = time.perf_counter()
+    with transaction.atomic(using=alias):
+        with connection.cursor() as cursor:
+            for role in ('user', 'assistant'):
+                cursor.execute(
+                    "INSERT INTO bench_message (conversation_id, role, content, tokens, timestamp)"
+                    " VALUES (%s, %s, %s, %s, %s)",
+                    [conversation_id, role, content, len(content), time.time()]
+                )
+            cursor.execute(
+                "UPDATE bench_conversation SET total_tokens = total_tokens + %s WHERE id = %s",
+                [len(content) * 2, conversation_id]
+            )
+    return time.perf_counter() - started
+
+
+def _worker(alias, engine, path, threads, turns, conversations, stream_delay, queue):
+    _register(alias, engine, path)
+    content = '测' * 400
+
+    def run(thread_index):
+        latencies, errors = [], 0
+        for i in range(turns):
+            conversation_id = (os.getpid() + thread_index + i) % conversations + 1
+            # 模拟流式响应期间不持有数据库连接上的事务
+            time.sleep(stream_delay)
+            try:
+                latencies.append(_turn(alias, conversation_id, content))
+            except OperationalError:
+                errors += 1
+        connections[alias].close()
+        queue.put((latencies, errors))
+
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+class Command(BaseCommand):
+    help = '模拟多进程多线程并发保存对话消息，对比默认 SQLite 与 WAL 后端的写入吞吐量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4, help='进程数（对应 uWSGI processes）')
+        parser.add_argument('--threads', type=int, default=2, help='每个进程的线程数')
+        parser.add_argument('--turns', type=int, default=200, help='每个线程模拟的对话轮数')
+        parser.add_argument('--conversations', type=int, default=20, help='会话数量')
+        parser.add_argument('--stream-delay', type=float, default=0.0, help='每轮对话模拟的流式响应时间（秒）')
+        parser.add_argument('--engine', choices=list(ENGINES), action='append', help='只测试指定后端，可重复')
+
+    def handle(self, *args, **options):
+        context = multiprocessing.get_context('fork')
+        for engine in options['engine'] or list(ENGINES):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, 'bench.sqlite3')
+                alias = f'benchmark_{engine}'
+                _register(alias, engine, path)
+                with connections[alias].cursor() as cursor:
+                    for statement in SCHEMA:
+                        cursor.execute(statement)
+                    for i in range(options['conversations']):
+                        cursor.execute("INSERT INTO bench_conversation (id) VALUES (%s)", [i + 1])
+                connections[alias].close()
+
+                queue = context.Queue()
+                started = time.perf_counter()
+                processes = [
+                    context.Process(target=_worker, args=(
+                        alias, engine, path, options['threads'], options['turns'],
+                        options['conversations'], options['stream_delay'], queue
+                    ))
+                    for _ in range(options['processes'])
+                ]
+                for process in processes:
+                    process.start()
+                results = [queue.get() for _ in range(options['processes'] * options['threads'])]
+                for process in processes:
+                    process.join()
+                elapsed = time.perf_counter() - started
+
+                latencies = sorted(latency for result in results for latency in result[0])
+                errors = sum(result[1] for result in results)
+                self.stdout.write(self._report(engine, elapsed, latencies, errors))
+
+    @staticmethod
+    def _report(engine, elapsed, latencies, errors):
+        if not latencies:
+            return f"{engine:<8} 全部 {errors} 轮写入失败"
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return (
+            f"{engine:<8} 成功 {len(latencies)} 轮, 失败(database is locked) {errors} 轮, "
+            f"吞吐 {len(latencies) / elapsed:.1f} 轮/秒, "
+            f"写入耗时 p50 {statistics.median(latencies) * 1000:.1f}ms / p95 {p95 * 1000:.1f}ms / "
+            f"max {latencies[-1] * 1000:.1f}ms"
+        )
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_application_avatar_application_icon_svg'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='modelusagestat',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='modelusagestat',
+            name='application',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='usage_stats', to='chat.application', verbose_name='应用'),
+        ),
+        migrations.AddConstraint(
+            model_name='modelusagestat',
+            constraint=models.UniqueConstraint(condition=models.Q(('application__isnull', False)), fields=('model', 'date', 'application'), name='unique_model_usage_per_application'),
+        ),
+        migrations.AddConstraint(
+            model_name='modelusagestat',
+            constraint=models.UniqueConstraint(condition=models.Q(('application__isnull', True)), fields=('model', 'date'), name='unique_model_usage_without_application'),
+        ),
+    ]
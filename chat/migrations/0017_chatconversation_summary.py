@@ -0,0 +1,23 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0016_modelusagestat_application'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatconversation',
+            name='summary',
+            field=models.TextField(blank=True, verbose_name='对话摘要'),
+        ),
+        migrations.AddField(
+            model_name='chatconversation',
+            name='summary_until',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='摘要截止消息ID'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0017_chatconversation_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='application',
+            name='summary_model',
+            field=models.ForeignKey(blank=True, help_text='用于在后台压缩较早对话的低成本模型，留空则不生成摘要', limit_choices_to={'is_active': True, 'model_type': 'LLM'}, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='summary_applications', to='chat.aimodel', verbose_name='摘要模型'),
+        ),
+    ]
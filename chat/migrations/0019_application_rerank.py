@@ -0,0 +1,29 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0018_application_summary_model'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='application',
+            name='rerank_candidates',
+            field=models.IntegerField(default=20, help_text='启用重排时向量检索取出的候选知识条数，重排后保留最大知识条数', verbose_name='重排候选条数'),
+        ),
+        migrations.AddField(
+            model_name='application',
+            name='rerank_model',
+            field=models.ForeignKey(blank=True, help_text='对向量检索的候选知识按相关性重新排序，留空则直接使用向量相似度', limit_choices_to={'is_active': True, 'model_type': 'RERANK'}, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='rerank_applications', to='chat.aimodel', verbose_name='重排模型'),
+        ),
+        migrations.AddField(
+            model_name='application',
+            name='rerank_threshold',
+            field=models.FloatField(default=0, help_text='重排得分低于该值的知识不使用', verbose_name='重排得分阈值'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0019_application_rerank'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='application',
+            name='retrieval_strategy',
+            field=models.CharField(choices=[('vector', '向量检索'), ('hybrid', '混合检索（向量 + 关键词）')], default='vector', help_text='混合检索把向量检索与关键词（SQLite FTS5）检索结果按排名融合，适合包含专有名词、型号的知识', max_length=10, verbose_name='检索方式'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0020_application_retrieval_strategy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='application',
+            name='direct_answer_threshold',
+            field=models.FloatField(blank=True, help_text='问题与知识的向量相似度不低于该值时直接返回知识答案，不调用模型；留空不启用，建议设置为0.92-0.97之间', null=True, verbose_name='直接回答阈值'),
+        ),
+    ]
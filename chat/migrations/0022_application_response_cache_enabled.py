@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0021_application_direct_answer_threshold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='application',
+            name='response_cache_enabled',
+            field=models.BooleanField(default=False, help_text='语义相同的问题直接回放此前模型生成的回答，不再调用模型；默认只缓存会话的第一轮问答', verbose_name='回答缓存'),
+        ),
+    ]
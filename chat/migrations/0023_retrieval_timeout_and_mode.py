@@ -0,0 +1,23 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0022_application_response_cache_enabled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='application',
+            name='retrieval_timeout',
+            field=models.FloatField(default=3, help_text='查询向量与知识检索超过该时间时不再等待，改用关键词检索结果（没有时不使用知识）调用模型；0表示不限制', verbose_name='检索时间预算(秒)'),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='retrieval_mode',
+            field=models.CharField(blank=True, choices=[('vector', '向量检索'), ('hybrid', '混合检索'), ('lexical', '关键词检索（向量接口出错）'), ('breaker', '关键词检索（向量接口熔断中）'), ('timeout', '检索超时（仅关键词检索结果）'), ('error', '检索出错（未使用知识）')], default='', help_text='生成该回复时实际使用的知识检索方式，未使用知识库时为空', max_length=10, verbose_name='知识检索方式'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0023_retrieval_timeout_and_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='application',
+            name='hedge_after',
+            field=models.FloatField(blank=True, help_text='模型超过该时间仍未返回第一个响应块时，同时请求下一个备用模型，采用先返回的一方；留空则只在出错时切换', null=True, verbose_name='对冲等待时间(秒)'),
+        ),
+        migrations.CreateModel(
+            name='ApplicationFallbackModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('priority', models.PositiveIntegerField(default=0, help_text='数值越小越先使用', verbose_name='优先级')),
+                ('application', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fallbacks', to='chat.application', verbose_name='应用')),
+                ('model', models.ForeignKey(limit_choices_to={'is_active': True, 'model_type': 'LLM'}, on_delete=django.db.models.deletion.CASCADE, to='chat.aimodel', verbose_name='备用模型')),
+            ],
+            options={
+                'verbose_name': '备用模型',
+                'verbose_name_plural': '备用模型',
+                'ordering': ['priority', 'id'],
+                'unique_together': {('application', 'model')},
+            },
+        ),
+        migrations.AddField(
+            model_name='application',
+            name='fallback_models',
+            field=models.ManyToManyField(blank=True, related_name='fallback_applications', through='chat.ApplicationFallbackModel', to='chat.aimodel', verbose_name='备用模型'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0024_application_fallback_models'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aimodel',
+            name='max_concurrent_streams',
+            field=models.PositiveIntegerField(blank=True, help_text='同时进行中的流式请求上限', null=True, verbose_name='最大并发请求数'),
+        ),
+        migrations.AddField(
+            model_name='aimodel',
+            name='requests_per_minute',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='每分钟请求数(RPM)'),
+        ),
+        migrations.AddField(
+            model_name='aimodel',
+            name='tokens_per_minute',
+            field=models.PositiveIntegerField(blank=True, help_text='请求开始时按输入估算值与最大输出token数预占，结束后按实际用量修正', null=True, verbose_name='每分钟token数(TPM)'),
+        ),
+    ]
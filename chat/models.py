@@ -1,9 +1,11 @@
+from decimal import Decimal
+
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
-from django.db.models import Sum
+from django.db.models import F, Q, Sum
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 
 class ModelType(models.TextChoices):
     LLM = 'LLM', '大语言模型'
@@ -42,6 +44,25 @@ class AIModel(models.Model):
         related_name="chat_aimodels"  # 添加这一行
     )
     description = models.TextField(verbose_name="模型描述", blank=True)
+
+    # 限流字段：所有 worker 共同遵守（见 chat/ratelimit.py），留空不限制
+    max_concurrent_streams = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        verbose_name="最大并发请求数",
+        help_text="同时进行中的流式请求上限"
+    )
+    requests_per_minute = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        verbose_name="每分钟请求数(RPM)"
+    )
+    tokens_per_minute = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        verbose_name="每分钟token数(TPM)",
+        help_text="请求开始时按输入估算值与最大输出token数预占，结束后按实际用量修正"
+    )
     
     # 定价字段
     input_token_price = models.DecimalField(
@@ -70,8 +91,8 @@ class AIModel(models.Model):
 
     def calculate_cost(self, input_tokens, output_tokens):
         """计算使用成本"""
-        input_cost = (input_tokens / 1000000) * self.input_token_price
-        output_cost = (output_tokens / 1000000) * self.output_token_price
+        input_cost = Decimal(input_tokens) / 1000000 * self.input_token_price
+        output_cost = Decimal(output_tokens) / 1000000 * self.output_token_price
         return round(input_cost + output_cost, 6)
 
 class Application(models.Model):
@@ -105,6 +126,19 @@ class Application(models.Model):
         verbose_name="使用的模型",
         limit_choices_to={'is_active': True}
     )
+    fallback_models = models.ManyToManyField(
+        AIModel,
+        through='ApplicationFallbackModel',
+        related_name='fallback_applications',
+        blank=True,
+        verbose_name="备用模型"
+    )
+    hedge_after = models.FloatField(
+        null=True,
+        blank=True,
+        verbose_name="对冲等待时间(秒)",
+        help_text="模型超过该时间仍未返回第一个响应块时，同时请求下一个备用模型，采用先返回的一方；留空则只在出错时切换"
+    )
     # 添加与向量模型的关联
     embedding_model = models.ForeignKey(
         'embeddings.EmbeddingModel',
@@ -125,6 +159,49 @@ class Application(models.Model):
         verbose_name="最大知识条数",
         help_text="每次对话最多使用的知识条数"
     )
+    retrieval_strategy = models.CharField(
+        max_length=10,
+        choices=[('vector', '向量检索'), ('hybrid', '混合检索（向量 + 关键词）')],
+        default='vector',
+        verbose_name="检索方式",
+        help_text="混合检索把向量检索与关键词（SQLite FTS5）检索结果按排名融合，适合包含专有名词、型号的知识"
+    )
+    rerank_model = models.ForeignKey(
+        AIModel,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='rerank_applications',
+        verbose_name="重排模型",
+        limit_choices_to={'is_active': True, 'model_type': ModelType.RERANK},
+        help_text="对向量检索的候选知识按相关性重新排序，留空则直接使用向量相似度"
+    )
+    rerank_candidates = models.IntegerField(
+        default=20,
+        verbose_name="重排候选条数",
+        help_text="启用重排时向量检索取出的候选知识条数，重排后保留最大知识条数"
+    )
+    rerank_threshold = models.FloatField(
+        default=0,
+        verbose_name="重排得分阈值",
+        help_text="重排得分低于该值的知识不使用"
+    )
+    retrieval_timeout = models.FloatField(
+        default=3,
+        verbose_name="检索时间预算(秒)",
+        help_text="查询向量与知识检索超过该时间时不再等待，改用关键词检索结果（没有时不使用知识）调用模型；0表示不限制"
+    )
+    direct_answer_threshold = models.FloatField(
+        null=True,
+        blank=True,
+        verbose_name="直接回答阈值",
+        help_text="问题与知识的向量相似度不低于该值时直接返回知识答案，不调用模型；留空不启用，建议设置为0.92-0.97之间"
+    )
+    response_cache_enabled = models.BooleanField(
+        default=False,
+        verbose_name="回答缓存",
+        help_text="语义相同的问题直接回放此前模型生成的回答，不再调用模型；默认只缓存会话的第一轮问答"
+    )
     system_role = models.TextField(
         verbose_name="系统角色",
         blank=True,
@@ -135,6 +212,16 @@ class Application(models.Model):
         default=False,
         verbose_name="显示思考过程"
     )
+    summary_model = models.ForeignKey(
+        AIModel,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='summary_applications',
+        verbose_name="摘要模型",
+        limit_choices_to={'is_active': True, 'model_type': ModelType.LLM},
+        help_text="用于在后台压缩较早对话的低成本模型，留空则不生成摘要"
+    )
 
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
@@ -161,12 +248,67 @@ class Application(models.Model):
                 'knowledge_similarity_threshold': '相似度阈值必须在0到1之间'
             })
             
+        # 验证检索时间预算
+        if self.retrieval_timeout < 0:
+            raise ValidationError({
+                'retrieval_timeout': '检索时间预算不能小于0'
+            })
+
+        # 验证直接回答阈值
+        if self.direct_answer_threshold is not None and not (
+            self.knowledge_similarity_threshold <= self.direct_answer_threshold <= 1
+        ):
+            raise ValidationError({
+                'direct_answer_threshold': '直接回答阈值必须在知识相似度阈值与1之间'
+            })
+
         # 验证最大知识条数
         if self.max_knowledge_items < 1:
             raise ValidationError({
                 'max_knowledge_items': '最大知识条数必须大于0'
             })
 
+        # 验证重排候选条数
+        if self.rerank_model_id and self.rerank_candidates < self.max_knowledge_items:
+            raise ValidationError({
+                'rerank_candidates': '重排候选条数不能少于最大知识条数'
+            })
+
+        # 验证对冲等待时间
+        if self.hedge_after is not None and self.hedge_after <= 0:
+            raise ValidationError({
+                'hedge_after': '对冲等待时间必须大于0'
+            })
+
+class ApplicationFallbackModel(models.Model):
+    """应用的备用模型：主模型出错（或超过对冲等待时间未响应）时按优先级依次使用"""
+    application = models.ForeignKey(
+        Application,
+        on_delete=models.CASCADE,
+        related_name='fallbacks',
+        verbose_name="应用"
+    )
+    model = models.ForeignKey(
+        AIModel,
+        on_delete=models.CASCADE,
+        verbose_name="备用模型",
+        limit_choices_to={'is_active': True, 'model_type': ModelType.LLM}
+    )
+    priority = models.PositiveIntegerField(
+        default=0,
+        verbose_name="优先级",
+        help_text="数值越小越先使用"
+    )
+
+    class Meta:
+        verbose_name = "备用模型"
+        verbose_name_plural = "备用模型"
+        ordering = ['priority', 'id']
+        unique_together = ('application', 'model')
+
+    def __str__(self):
+        return f"{self.application.name} - {self.model.name} ({self.priority})"
+
 class ChatConversation(models.Model):
     """用户对话会话记录"""
     user = models.ForeignKey(
@@ -235,6 +377,14 @@ class ChatConversation(models.Model):
         blank=True,
         verbose_name="Top-P参数"
     )
+
+    # 滚动摘要：summary_until 及之前的消息不再逐条发送给模型，以摘要代替
+    summary = models.TextField(blank=True, verbose_name="对话摘要")
+    summary_until = models.BigIntegerField(
+        null=True,
+        blank=True,
+        verbose_name="摘要截止消息ID"
+    )
     
     class Meta:
         verbose_name = "聊天会话"
@@ -249,7 +399,7 @@ class ChatConversation(models.Model):
         return f"{user_str}{self.title or '未命名对话'}"
 
     def update_stats(self):
-        """更新会话的统计信息"""
+        """按全部消息重新汇总会话的统计信息（日常由消息保存信号增量维护，此处用于校正）"""
         aggregates = self.messages.aggregate(
             total_tokens=Sum('tokens'),
             total_cost=Sum('cost')
@@ -266,6 +416,14 @@ class ChatMessage(models.Model):
         ('assistant', '助手'),
         ('function', '函数'),
     ]
+    RETRIEVAL_MODE_CHOICES = [
+        ('vector', '向量检索'),
+        ('hybrid', '混合检索'),
+        ('lexical', '关键词检索（向量接口出错）'),
+        ('breaker', '关键词检索（向量接口熔断中）'),
+        ('timeout', '检索超时（仅关键词检索结果）'),
+        ('error', '检索出错（未使用知识）'),
+    ]
     
     conversation = models.ForeignKey(
         ChatConversation, 
@@ -317,6 +475,14 @@ class ChatMessage(models.Model):
         default=True,
         verbose_name="是否成功"
     )
+    retrieval_mode = models.CharField(
+        max_length=10,
+        choices=RETRIEVAL_MODE_CHOICES,
+        blank=True,
+        default='',
+        verbose_name="知识检索方式",
+        help_text="生成该回复时实际使用的知识检索方式，未使用知识库时为空"
+    )
     
     # 调用参数
     temperature = models.FloatField(
@@ -355,6 +521,14 @@ class ModelUsageStat(models.Model):
         verbose_name="模型"
     )
     date = models.DateField(verbose_name="统计日期")
+    application = models.ForeignKey(
+        Application,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='usage_stats',
+        verbose_name="应用"
+    )
     call_count = models.PositiveIntegerField(
         default=0,
         verbose_name="调用次数"
@@ -373,33 +547,99 @@ class ModelUsageStat(models.Model):
     class Meta:
         verbose_name = "模型使用统计"
         verbose_name_plural = "模型使用统计"
-        unique_together = ('model', 'date')
+        # application 可为空，而唯一约束中 NULL 互不相等，不区分应用的统计需单独约束
+        constraints = [
+            models.UniqueConstraint(
+                fields=['model', 'date', 'application'],
+                condition=Q(application__isnull=False),
+                name='unique_model_usage_per_application'
+            ),
+            models.UniqueConstraint(
+                fields=['model', 'date'],
+                condition=Q(application__isnull=True),
+                name='unique_model_usage_without_application'
+            ),
+        ]
         ordering = ['-date']
     
     def __str__(self):
         return f"{self.model.name} - {self.date}: {self.call_count}次调用"
 
 # 信号处理
+# 会话统计用 F() 表达式增量更新，单条UPDATE完成，与会话消息数量无关，并发写入时也不会互相覆盖
+
+@receiver(pre_save, sender=ChatMessage)
+def remember_message_stats(sender, instance, raw=False, **kwargs):
+    """更新已有消息时记录原token数与成本，用于计算增量"""
+    instance._old_stats = None
+    if instance.pk and not raw:
+        instance._old_stats = sender.objects.filter(pk=instance.pk).values_list('tokens', 'cost').first()
+
+def _decimal_cost(cost):
+    # 新建消息时 cost 可能是 calculate_cost 返回的 float
+    return Decimal(str(cost)) if cost else Decimal(0)
+
+def _apply_conversation_delta(conversation_id, tokens, cost):
+    if not tokens and not cost:
+        return
+    ChatConversation.objects.filter(pk=conversation_id).update(
+        total_tokens=F('total_tokens') + tokens,
+        total_cost=F('total_cost') + cost,
+        updated_at=timezone.now()
+    )
+
 @receiver(post_save, sender=ChatMessage)
-def update_conversation_stats(sender, instance, **kwargs):
-    """当消息保存时自动更新会话统计"""
-    instance.conversation.update_stats()
+def update_conversation_stats(sender, instance, created, raw=False, **kwargs):
+    """当消息保存时增量更新会话统计（loaddata 等原样导入时统计已包含在导入数据中）"""
+    if raw:
+        return
+    tokens, cost = instance.tokens, _decimal_cost(instance.cost)
+    old = getattr(instance, '_old_stats', None)
+    if not created and old:
+        tokens, cost = tokens - old[0], cost - _decimal_cost(old[1])
+    _apply_conversation_delta(instance.conversation_id, tokens, cost)
+
+@receiver(post_delete, sender=ChatMessage)
+def revert_conversation_stats(sender, instance, **kwargs):
+    """删除消息时扣除其token数与成本"""
+    _apply_conversation_delta(instance.conversation_id, -instance.tokens, -_decimal_cost(instance.cost))
 
 @receiver(post_save, sender=ChatMessage)
-def update_model_stats(sender, instance, **kwargs):
-    """当消息保存时更新模型使用统计"""
-    if instance.model_used and instance.is_success:
-        date = instance.timestamp.date()
-        stat, created = ModelUsageStat.objects.get_or_create(
-            model=instance.model_used,
-            date=date,
-            defaults={
-                'call_count': 0,
-                'total_tokens': 0,
-                'total_cost': 0
-            }
-        )
-        stat.call_count += 1
-        stat.total_tokens += instance.tokens
-        stat.total_cost += instance.cost if instance.cost else 0
-        stat.save()
\ No newline at end of file
+def update_model_stats(sender, instance, created, raw=False, **kwargs):
+    """助手回复保存时累加模型使用统计，由 chat.usage 批量写入
+
+    一次调用的输入（含历史与当前问题）与输出token都记录在助手消息的 api_response['usage'] 中，
+    用户消息的token已计入其中，不再单独累加。
+    """
+    if raw or not created or instance.role != 'assistant' or not instance.model_used_id or not instance.is_success:
+        return
+    from .usage import record_usage
+    usage = (instance.api_response or {}).get('usage') or {}
+    record_usage(
+        instance.model_used_id,
+        timezone.localdate(instance.timestamp),
+        instance.conversation.application_id,
+        calls=1,
+        tokens=usage.get('total_tokens', instance.tokens),
+        cost=instance.cost
+    )
+
+@receiver(pre_save, sender=AIModel)
+def remember_model_endpoint(sender, instance, **kwargs):
+    """记录更新前的API地址与密钥"""
+    instance._old_endpoint = None
+    if instance.pk:
+        instance._old_endpoint = sender.objects.filter(pk=instance.pk).values_list('api_url', 'api_key').first()
+
+@receiver(post_save, sender=AIModel)
+def drop_model_clients(sender, instance, **kwargs):
+    """模型配置更新后移除复用的旧客户端"""
+    from .clients import invalidate_clients
+    if getattr(instance, '_old_endpoint', None):
+        invalidate_clients(*instance._old_endpoint)
+
+@receiver(post_delete, sender=AIModel)
+def drop_deleted_model_clients(sender, instance, **kwargs):
+    """模型删除后移除复用的客户端"""
+    from .clients import invalidate_clients
+    invalidate_clients(instance.api_url, instance.api_key)
@@ -0,0 +1,470 @@
+"""按模型限制并发请求数、每分钟请求数与每分钟token数
+
+AIModel 设置了 最大并发请求数 / RPM / TPM 后，调用模型前先在共享存储中登记一次请求（租约），
+所有 worker 看到同一份计数，不会各自发出请求直到服务商返回 429。RPM / TPM 按最近 60 秒的滑动窗口计算；
+TPM 在请求开始时按输入估算值加最大输出token数预占，结束后按实际用量修正。
+
+没有余量时按需要等待的时间轮询，最多等待 MAX_WAIT 秒，仍然没有余量时视图直接返回
+429 与 Retry-After，不再开始流式响应。配置见 settings.MODEL_RATE_LIMIT::
+
+    MODEL_RATE_LIMIT = {
+        'BACKEND': 'sqlite',        # sqlite / redis / locmem，或后端类的完整路径
+        'PATH': BASE_DIR / 'rate_limit.sqlite3',   # sqlite 后端文件路径
+        'REDIS_URL': 'redis://127.0.0.1:6379/0',   # redis 后端地址（需安装 redis）
+        'REDIS_CLIENT': None,       # 创建 Redis 兼容客户端的可调用对象路径，如 'fakeredis.FakeRedis'
+        'MAX_WAIT': 10,             # 排队等待的最长时间（秒）
+        'POLL_INTERVAL': 0.25,      # 只受并发数限制时的轮询间隔（秒）
+        'LEASE_TTL': 600,           # 租约有效期，worker 异常退出未释放的租约到期后不再计入并发
+    }
+
+sqlite 后端在同一主机的 worker 之间共享；多台主机时使用 redis 后端。locmem 只在当前进程内有效。
+共享存储出错时记录警告并放行请求。
+"""
+import asyncio
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE_LIMIT_CONFIG = {
+    'BACKEND': 'sqlite',
+    'REDIS_URL': 'redis://127.0.0.1:6379/0',
+    'REDIS_CLIENT': None,
+    'MAX_WAIT': 10,
+    'POLL_INTERVAL': 0.25,
+    'LEASE_TTL': 600,
+}
+
+# 滑动窗口长度（秒）
+WINDOW = 60
+
+
+def rate_limit_config() -> dict:
+    return {**DEFAULT_RATE_LIMIT_CONFIG, **getattr(settings, 'MODEL_RATE_LIMIT', {})}
+
+
+class RateLimitExceeded(Exception):
+    """等待超过期限仍没有余量，retry_after 为建议的重试等待时间（秒）"""
+
+    def __init__(self, model, retry_after):
+        self.model = model
+        self.retry_after = retry_after
+        super().__init__(f"模型 {model.name} 请求过多，请 {math.ceil(retry_after)} 秒后重试")
+
+
+def model_limits(model) -> Optional[dict]:
+    """模型的限额，都未设置时为None"""
+    limits = {
+        'max_streams': model.max_concurrent_streams,
+        'rpm': model.requests_per_minute,
+        'tpm': model.tokens_per_minute,
+    }
+    return limits if any(limits.values()) else None
+
+
+def _is_stale(lease, now):
+    # 已移出窗口且不再计入并发的租约
+    return lease['started_at'] < now - WINDOW and (not lease['active'] or lease['expires_at'] < now)
+
+
+def wait_time(limits, leases, tokens, now, poll_interval):
+    """还需等待多少秒才有余量，0 表示可以立即开始；leases 为该模型未过期的租约"""
+    waits = [0]
+    if limits['max_streams']:
+        active = sum(1 for lease in leases if lease['active'] and lease['expires_at'] >= now)
+        if active >= limits['max_streams']:
+            # 并发数何时下降无法预知，按轮询间隔重试
+            waits.append(poll_interval)
+    window = sorted(
+        (lease['started_at'], lease['tokens']) for lease in leases if lease['started_at'] >= now - WINDOW
+    )
+    if limits['rpm'] and len(window) >= limits['rpm']:
+        waits.append(window[len(window) - limits['rpm']][0] + WINDOW - now)
+    if limits['tpm']:
+        # 单次预占超过每分钟限额时按限额计，避免永远等不到
+        excess = sum(used for _, used in window) + min(tokens, limits['tpm']) - limits['tpm']
+        freed = 0
+        for started_at, used in window:
+            if excess <= 0:
+                break
+            freed += used
+            if freed >= excess:
+                waits.append(started_at + WINDOW - now)
+                break
+    return max(waits)
+
+
+def _new_lease(tokens, now, lease_ttl):
+    return {'started_at': now, 'tokens': tokens, 'active': True, 'expires_at': now + lease_ttl}
+
+
+class LocMemRateLimitBackend:
+    """进程内计数，只适用于单进程部署或本地开发"""
+
+    def __init__(self, lease_ttl=600, poll_interval=0.25, **kwargs):
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, model_id, limits, tokens):
+        now = time.time()
+        with self._lock:
+            leases = self._leases.setdefault(model_id, {})
+            for lease_id in [lease_id for lease_id, lease in leases.items() if _is_stale(lease, now)]:
+                del leases[lease_id]
+            wait = wait_time(limits, leases.values(), tokens, now, self.poll_interval)
+            if wait > 0:
+                return None, wait
+            lease_id = uuid.uuid4().hex
+            leases[lease_id] = _new_lease(tokens, now, self.lease_ttl)
+            return lease_id, 0
+
+    def release(self, model_id, lease_id, tokens=None):
+        with self._lock:
+            lease = self._leases.get(model_id, {}).get(lease_id)
+            if lease is not None:
+                lease['active'] = False
+                if tokens is not None:
+                    lease['tokens'] = tokens
+
+
+class SQLiteRateLimitBackend:
+    """基于本地 SQLite 文件，同一主机上的多个 worker 共享；登记租约在 IMMEDIATE 事务中完成"""
+
+    def __init__(self, path=None, table='model_rate_lease', lease_ttl=600, poll_interval=0.25, **kwargs):
+        self.path = str(path or settings.BASE_DIR / 'rate_limit.sqlite3')
+        self.table = table
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} ("
+            " lease_id TEXT PRIMARY KEY,"
+            " model_id INTEGER NOT NULL,"
+            " started_at REAL NOT NULL,"
+            " tokens INTEGER NOT NULL,"
+            " active INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_model ON {self.table} (model_id, started_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # 自动提交模式，事务由 BEGIN IMMEDIATE 显式开始
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def try_acquire(self, model_id, limits, tokens):
+        now = time.time()
+        conn = self._connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                f"DELETE FROM {self.table} WHERE model_id = ? AND started_at < ? AND (active = 0 OR expires_at < ?)",
+                (model_id, now - WINDOW, now)
+            )
+            leases = [
+                {'started_at': row[0], 'tokens': row[1], 'active': bool(row[2]), 'expires_at': row[3]}
+                for row in conn.execute(
+                    f"SELECT started_at, tokens, active, expires_at FROM {self.table} WHERE model_id = ?",
+                    (model_id,)
+                )
+            ]
+            wait = wait_time(limits, leases, tokens, now, self.poll_interval)
+            lease_id = None
+            if wait <= 0:
+                lease_id = uuid.uuid4().hex
+                conn.execute(
+                    f"INSERT INTO {self.table} (lease_id, model_id, started_at, tokens, active, expires_at)"
+                    " VALUES (?, ?, ?, ?, 1, ?)",
+                    (lease_id, model_id, now, tokens, now + self.lease_ttl)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            # BEGIN 本身失败（如等待写锁超时）时没有打开的事务，不需要回滚
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return lease_id, wait
+
+    def release(self, model_id, lease_id, tokens=None):
+        self._connection().execute(
+            f"UPDATE {self.table} SET active = 0, tokens = COALESCE(?, tokens) WHERE lease_id = ?",
+            (tokens, lease_id)
+        )
+
+
+class RedisRateLimitBackend:
+    """基于 Redis（或兼容的客户端），多台主机共享
+
+    每个模型的租约保存在一个哈希中，读取、计算与写入在 WATCH / MULTI 乐观事务中完成，
+    只用到 Redis 的基本命令，本地测试时可用 fakeredis 等兼容客户端代替。
+    """
+
+    def __init__(self, redis_url=None, redis_client=None, prefix='model_rate', lease_ttl=600,
+                 poll_interval=0.25, **kwargs):
+        from redis.exceptions import WatchError
+
+        self._watch_error = WatchError
+        if redis_client:
+            self.client = import_string(redis_client)()
+        else:
+            import redis
+            self.client = redis.Redis.from_url(redis_url)
+        self.prefix = prefix
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+
+    def _key(self, model_id):
+        return f"{self.prefix}:{model_id}"
+
+    def try_acquire(self, model_id, limits, tokens):
+        key = self._key(model_id)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    now = time.time()
+                    leases = {
+                        lease_id: json.loads(value) for lease_id, value in pipe.hgetall(key).items()
+                    }
+                    stale = [lease_id for lease_id, lease in leases.items() if _is_stale(lease, now)]
+                    live = [lease for lease_id, lease in leases.items() if lease_id not in stale]
+                    wait = wait_time(limits, live, tokens, now, self.poll_interval)
+                    lease_id = None
+                    pipe.multi()
+                    if stale:
+                        pipe.hdel(key, *stale)
+                    if wait <= 0:
+                        lease_id = uuid.uuid4().hex
+                        pipe.hset(key, lease_id, json.dumps(_new_lease(tokens, now, self.lease_ttl)))
+                        pipe.expire(key, int(self.lease_ttl + WINDOW))
+                    pipe.execute()
+                    return lease_id, wait
+                except self._watch_error:
+                    continue
+
+    def release(self, model_id, lease_id, tokens=None):
+        key = self._key(model_id)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    value = pipe.hget(key, lease_id)
+                    if value is None:
+                        return
+                    lease = json.loads(value)
+                    lease['active'] = False
+                    if tokens is not None:
+                        lease['tokens'] = tokens
+                    pipe.multi()
+                    pipe.hset(key, lease_id, json.dumps(lease))
+                    pipe.execute()
+                    return
+                except self._watch_error:
+                    continue
+
+
+BACKENDS = {
+    'locmem': LocMemRateLimitBackend,
+    'sqlite': SQLiteRateLimitBackend,
+    'redis': RedisRateLimitBackend,
+}
+
+
+def build_backend(config: dict):
+    backend_name = config.get('BACKEND', 'sqlite')
+    backend_class = BACKENDS.get(backend_name) or import_string(backend_name)
+    return backend_class(
+        path=config.get('PATH'),
+        redis_url=config.get('REDIS_URL'),
+        redis_client=config.get('REDIS_CLIENT'),
+        lease_ttl=config.get('LEASE_TTL', 600),
+        poll_interval=config.get('POLL_INTERVAL', 0.25),
+    )
+
+
+class ModelPermit:
+    """一次模型请求占用的额度，请求结束后 release（可重复调用）"""
+
+    def __init__(self, limiter, model, lease_id, tokens):
+        self.limiter = limiter
+        self.model = model
+        self.lease_id = lease_id
+        self.tokens = tokens
+        self.released = False
+
+    def release(self, tokens=None):
+        """释放并发名额；tokens 为实际用量，用于修正每分钟token数的预占"""
+        if self.released:
+            return
+        self.released = True
+        if self.lease_id is None:
+            return
+        try:
+            self.limiter.backend.release(self.model.pk, self.lease_id, tokens)
+        except Exception as e:
+            logger.warning(f"释放模型限流租约失败: {str(e)}")
+
+
+class ModelRateLimiter:
+    """按模型登记与等待请求额度"""
+
+    def __init__(self, backend, max_wait=10, poll_interval=0.25):
+        self.backend = backend
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+
+    def try_acquire(self, model, tokens):
+        """不等待地登记一次请求，返回 (额度, 需等待秒数)，没有余量时额度为None"""
+        limits = model_limits(model)
+        if limits is None:
+            return ModelPermit(self, model, None, tokens), 0
+        try:
+            lease_id, wait = self.backend.try_acquire(model.pk, limits, tokens)
+        except Exception as e:
+            logger.warning(f"模型限流存储出错，放行请求: {str(e)}")
+            return ModelPermit(self, model, None, tokens), 0
+        if lease_id is None:
+            return None, wait
+        return ModelPermit(self, model, lease_id, tokens), 0
+
+    def _try_models(self, models, tokens):
+        # 按顺序取第一个有余量的模型，都没有时返回等待时间最短的模型及其等待时间
+        blocking, shortest = None, None
+        for model in models:
+            permit, wait = self.try_acquire(model, tokens)
+            if permit is not None:
+                return permit, None, 0
+            if shortest is None or wait < shortest:
+                blocking, shortest = model, wait
+        return None, blocking, shortest
+
+    def _check_models(self, models):
+        if not models:
+            raise ValueError("应用未配置模型")
+        return time.time() + self.max_wait
+
+    def acquire(self, models, tokens):
+        """在候选模型中按顺序取得一个有余量的额度，没有时排队等待，超过 MAX_WAIT 抛出 RateLimitExceeded"""
+        deadline = self._check_models(models)
+        while True:
+            permit, blocking, wait = self._try_models(models, tokens)
+            if permit is not None:
+                return permit
+            remaining = deadline - time.time()
+            if wait > remaining:
+                raise RateLimitExceeded(blocking, wait)
+            time.sleep(max(wait, self.poll_interval))
+
+    async def aacquire(self, models, tokens):
+        """acquire 的异步版本；共享存储（SQLite 文件、Redis）的读写会阻塞，放到线程中执行"""
+        deadline = self._check_models(models)
+        while True:
+            permit, blocking, wait = await asyncio.to_thread(self._try_models, models, tokens)
+            if permit is not None:
+                return permit
+            remaining = deadline - time.time()
+            if wait > remaining:
+                raise RateLimitExceeded(blocking, wait)
+            await asyncio.sleep(max(wait, self.poll_interval))
+
+
+_limiter: Optional[ModelRateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> ModelRateLimiter:
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                config = rate_limit_config()
+                _limiter = ModelRateLimiter(
+                    build_backend(config),
+                    max_wait=config['MAX_WAIT'],
+                    poll_interval=config['POLL_INTERVAL'],
+                )
+    return _limiter
+
+
+def retry_after_seconds(error: RateLimitExceeded) -> int:
+    return max(math.ceil(error.retry_after), 1)
+
+
+def rate_limited_response(error: RateLimitExceeded) -> JsonResponse:
+    """排队超时时返回给客户端的 429 响应"""
+    response = JsonResponse(
+        {
+            "error": str(error),
+            "code": "RATE_LIMITED",
+            "status": 429
+        },
+        status=429
+    )
+    response['Retry-After'] = str(retry_after_seconds(error))
+    return response
+
+
+def rate_limited_payload(error: RateLimitExceeded) -> dict:
+    """响应头已发出后（流内排队）排队超时时，以SSE错误事件返回的内容"""
+    return {
+        'error': str(error),
+        'code': 'RATE_LIMITED',
+        'retry_after': retry_after_seconds(error),
+    }
+
+
+class PermitReleasingStream:
+    """流式响应内容的包装：响应关闭时释放额度
+
+    StreamingHttpResponse 关闭时会调用内容的 close()。生成器从未被迭代（客户端在首字节前断开）时
+    其 finally 不会执行，由这里释放，避免额度被占用到租约过期。
+    """
+
+    def __init__(self, stream, permit=None):
+        self.stream = stream
+        self.permit = permit
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def close(self):
+        try:
+            close = getattr(self.stream, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            if self.permit is not None:
+                self.permit.release()
+
+
+class AsyncPermitReleasingStream:
+    """异步生成器版本：异步生成器没有同步的 close，只在关闭时释放额度"""
+
+    def __init__(self, stream, permit=None):
+        self.stream = stream
+        self.permit = permit
+
+    def __aiter__(self):
+        return self.stream.__aiter__()
+
+    def close(self):
+        if self.permit is not None:
+            self.permit.release()
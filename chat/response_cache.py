@@ -0,0 +1,217 @@
+"""模型回答的语义缓存
+
+应用开启"回答缓存"后，同一应用下语义相同的问题直接回放此前模型生成的回答（模拟流式输出），不再调用模型。
+
+缓存按 (应用, 对话模型, 系统角色哈希, 检索到的知识哈希) 分组，组内保存最近的若干条
+(规范化问题, 问题向量, 回答)；查询时在组内找与当前问题向量余弦相似度最高的一条，
+不低于 SIMILARITY_THRESHOLD 时命中。应用没有可用的向量模型（或向量接口出错）时，
+只有规范化后完全相同的问题才会命中。
+
+默认只缓存单轮请求（会话中没有更早的消息与摘要），多轮对话的回答依赖上下文。
+配置见 settings.RESPONSE_CACHE，后端与查询向量缓存相同::
+
+    RESPONSE_CACHE = {
+        'BACKEND': 'sqlite',            # locmem / django / sqlite
+        'PATH': BASE_DIR / 'embedding_cache.sqlite3',
+        'TABLE': 'response_cache',
+        'MAX_SIZE': 10000,              # 最多保存的分组数
+        'TTL': 3600,                    # 回答的有效期（秒）
+        'SIMILARITY_THRESHOLD': 0.97,
+        'GROUP_SIZE': 16,               # 每组最多保存的回答条数
+        'SINGLE_TURN_ONLY': True,
+    }
+
+多个 worker 同时写入同一分组时可能丢失其中一条回答，只影响命中率。
+命中与未命中记录在助手消息的 api_response['response_cache'] 中，按应用统计见 response_cache_stats。
+"""
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Optional
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from embeddings.cache import build_backend, normalize_query
+
+from .models import ChatMessage
+from .tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESPONSE_CACHE_CONFIG = {
+    'BACKEND': 'locmem',
+    'TABLE': 'response_cache',
+    'MAX_SIZE': 10000,
+    'TTL': 60 * 60,
+    'SIMILARITY_THRESHOLD': 0.97,
+    'GROUP_SIZE': 16,
+    'SINGLE_TURN_ONLY': True,
+}
+
+
+def response_cache_config() -> dict:
+    return {**DEFAULT_RESPONSE_CACHE_CONFIG, **getattr(settings, 'RESPONSE_CACHE', {})}
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+
+
+def context_digest(results) -> str:
+    """检索到的知识 (知识ID, 答案, 得分) 的哈希，与得分无关"""
+    return _digest(''.join(f"{knowledge_id}\x00{answer}\x00" for knowledge_id, answer, _ in results or []))
+
+
+def make_key(application, results) -> str:
+    raw = '\x00'.join([
+        str(application.pk),
+        str(application.model_id),
+        application.model.name if application.model else '',
+        _digest(application.system_role),
+        context_digest(results),
+    ])
+    return 'resp:' + _digest(raw)
+
+
+def _encode_vector(vector) -> Optional[str]:
+    if vector is None:
+        return None
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode('ascii')
+
+
+def _decode_vector(value) -> Optional[np.ndarray]:
+    if value is None:
+        return None
+    return np.frombuffer(base64.b64decode(value), dtype=np.float32)
+
+
+def _cosine(a: np.ndarray, b: np.ndarray) -> float:
+    if a.shape != b.shape:
+        return -1.0
+    norm = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return float(np.dot(a, b)) / norm if norm else -1.0
+
+
+class ResponseCache:
+    """按分组保存回答，组内按问题向量的相似度查找"""
+
+    def __init__(self, backend, similarity_threshold=0.97, group_size=16, ttl=3600):
+        self.backend = backend
+        self.similarity_threshold = similarity_threshold
+        self.group_size = group_size
+        self.ttl = ttl
+
+    def _entries(self, key: str) -> list:
+        try:
+            cached = self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"读取回答缓存失败: {str(e)}")
+            return []
+        if cached is None:
+            return []
+        expires_before = time.time() - self.ttl
+        return [entry for entry in json.loads(cached) if entry['created_at'] >= expires_before]
+
+    def lookup(self, key: str, query: str, embedding=None):
+        """返回 (回答, 相似度)，没有命中时为None"""
+        query = normalize_query(query)
+        embedding = None if embedding is None else np.asarray(embedding, dtype=np.float32)
+        best = None
+        for entry in self._entries(key):
+            if entry['query'] == query:
+                return entry['answer'], 1.0
+            vector = _decode_vector(entry['vector'])
+            if embedding is None or vector is None:
+                continue
+            similarity = _cosine(embedding, vector)
+            if similarity >= self.similarity_threshold and (best is None or similarity > best[1]):
+                best = (entry['answer'], similarity)
+        return best
+
+    def store(self, key: str, query: str, embedding, answer: str) -> None:
+        query = normalize_query(query)
+        entries = [entry for entry in self._entries(key) if entry['query'] != query]
+        entries.append({
+            'query': query,
+            'vector': _encode_vector(embedding),
+            'answer': answer,
+            'created_at': time.time(),
+        })
+        try:
+            self.backend.set(key, json.dumps(entries[-self.group_size:]).encode('utf-8'))
+        except Exception as e:
+            logger.warning(f"写入回答缓存失败: {str(e)}")
+
+
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = response_cache_config()
+                _cache = ResponseCache(
+                    build_backend(config, table='response_cache'),
+                    similarity_threshold=config['SIMILARITY_THRESHOLD'],
+                    group_size=config['GROUP_SIZE'],
+                    ttl=config['TTL'],
+                )
+    return _cache
+
+
+def response_cache_key(application, conversation, history, retrieval):
+    """可使用回答缓存时返回分组键，否则为None
+
+    应用需开启回答缓存，且（默认）为会话中的第一轮问答：没有更早的消息与摘要。
+    """
+    if not application.response_cache_enabled:
+        return None
+    if response_cache_config()['SINGLE_TURN_ONLY'] and (history or conversation.summary):
+        return None
+    return make_key(application, retrieval.results)
+
+
+def cached_answer_fields(cached, latency, timings=None):
+    """回放缓存回答的助手消息字段：不计模型与成本"""
+    answer, similarity = cached
+    api_response = {'response_cache': 'hit', 'similarity': round(float(similarity), 4)}
+    if timings:
+        api_response['timings'] = timings
+    return {
+        'content': answer,
+        'tokens': count_tokens(answer),
+        'cost': 0,
+        'latency': round(latency, 3),
+        'api_response': api_response,
+    }
+
+
+def response_cache_stats(days=7):
+    """最近 days 天内各应用可缓存请求的命中次数与命中率"""
+    since = timezone.now() - timedelta(days=days)
+    rows = ChatMessage.objects.filter(
+        role='assistant', timestamp__gte=since, api_response__response_cache__in=['hit', 'miss']
+    ).values('conversation__application_id', 'conversation__application__name').annotate(
+        hits=Count('id', filter=Q(api_response__response_cache='hit')),
+        total=Count('id'),
+    ).order_by('conversation__application_id')
+    return [
+        {
+            'application_id': row['conversation__application_id'],
+            'application_name': row['conversation__application__name'],
+            'hits': row['hits'],
+            'misses': row['total'] - row['hits'],
+            'hit_rate': round(row['hits'] / row['total'], 4) if row['total'] else 0.0,
+        }
+        for row in rows
+    ]
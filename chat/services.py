@@ -0,0 +1,529 @@
+"""对话流程中同步与异步视图共用的处理逻辑"""
+import asyncio
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from embeddings.breaker import CircuitOpenError, get_breaker
+from embeddings.cache import get_query_cache
+from embeddings.rerank import arerank_knowledge, get_rerank_cache, rerank_knowledge, uses_rerank
+from embeddings.services import aembed_query, embed_query, match_knowledge, search_lexical
+
+from .models import ChatMessage
+from .tokens import MESSAGE_OVERHEAD, count_message_tokens, count_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SYSTEM_ROLE = "你是一个智能助手，可以帮助用户解答问题。请保持友好和专业的态度。"
+
+DEFAULT_HISTORY_CONFIG = {
+    'MAX_MESSAGES': 40,
+    'DEFAULT_CONTEXT_TOKENS': 8192,
+}
+
+
+def sse_event(payload) -> str:
+    """格式化一条SSE数据"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+SSE_DONE = "data: [DONE]\n\n"
+
+
+def progress_event(event, **fields) -> str:
+    """流程进度事件（如 retrieval_started / retrieval_done），前端只处理 content 等字段，会忽略这类事件"""
+    return sse_event({'event': event, **fields})
+
+# 回放已有回答（直接回答等）时每个SSE块的字符数
+REPLAY_CHUNK_SIZE = 16
+
+# 要求接口在流式响应的最后一块返回本次调用的 usage
+STREAM_OPTIONS = {"include_usage": True}
+
+
+def build_system_message(application):
+    """根据应用的系统角色生成system消息，未设置时返回None"""
+    if not application.system_role:
+        return None
+    # 确保系统角色不包含应用名称
+    system_role = application.system_role.replace(application.name, "").strip()
+    return {"role": "system", "content": system_role or DEFAULT_SYSTEM_ROLE}
+
+
+def build_knowledge_prompt(user_message, results):
+    """把检索到的知识拼接进用户问题，没有命中时直接返回原问题"""
+    if not results:
+        return user_message
+    context = "\n".join([f"- {item[1]}" for item in results])
+    return f"""基于以下上下文信息回答问题：
+
+上下文信息：
+{context}
+
+用户问题：{user_message}
+
+请基于上述上下文信息回答问题。如果问题与上下文无关，请明确告知用户。"""
+
+
+def uses_knowledge_base(application):
+    return bool(application.embedding_model and application.embedding_model.is_active)
+
+
+def may_skip_model(application):
+    """应用可能直接回答或回放缓存而不调用模型；这类请求在确定需要调用模型后才排队取得限流额度"""
+    return bool(
+        application.response_cache_enabled
+        or (uses_knowledge_base(application) and application.direct_answer_threshold is not None)
+    )
+
+
+def _log_results(results):
+    if results:
+        print("\n[yellow]找到的相关知识：[/]")
+        for item in results:
+            print(f"[dim]相似度: {item[2]:.4f} - {item[1]}[/]")
+    else:
+        print("[yellow]未找到相关知识，将直接回答问题...[/]")
+
+
+@dataclass
+class Retrieval:
+    """一次知识检索的结果：发送给模型的提示词，以及可直接作为回答的知识 (知识ID, 答案, 相似度)
+
+    mode 为实际使用的检索方式（见 ChatMessage.RETRIEVAL_MODE_CHOICES），未使用知识库时为空。
+    """
+    prompt: str
+    results: list = field(default_factory=list)
+    direct_answer: Optional[tuple] = None
+    query_embedding: Optional[object] = None
+    mode: str = ''
+
+
+def retrieve_knowledge(application, user_message, deadline=None, cancelled=None) -> Retrieval:
+    """检索知识并生成最终发送给模型的用户提示词，出错时退回原问题
+
+    deadline 为检索时间预算的截止时刻（time.time()），向量接口的超时取剩余时间；
+    cancelled 被设置（调用方已超时放弃等待）时不再继续检索与重排。
+    """
+    if not uses_knowledge_base(application):
+        return Retrieval(user_message)
+    print("\n[yellow]开始处理对话请求...[/]")
+    print("[yellow]开始获取向量...[/]")
+    query_embedding = None
+    # 没有查询向量时的检索方式：熔断中跳过了向量接口，或调用出错
+    fallback_mode = 'lexical'
+    try:
+        # 获取查询的向量表示，接口超时为剩余的检索时间预算；只有真正调用接口时才经过熔断器
+        timeout = max(deadline - time.time(), 0.001) if deadline else None
+        query_embedding = embed_query(
+            application.embedding_model, user_message, timeout, breaker=get_breaker(application.embedding_model)
+        )
+        print(f"获取到向量，维度: {len(query_embedding)}")
+        print(f"查询向量缓存统计: {get_query_cache().stats()}")
+    except CircuitOpenError:
+        fallback_mode = 'breaker'
+        print("向量接口熔断中，改用关键词检索")
+    except Exception as e:
+        print(f"获取向量失败，改用关键词检索: {str(e)}")
+    if cancelled is not None and cancelled.is_set():
+        return Retrieval(user_message, mode='timeout')
+    try:
+        # 在内存索引中检索（一次矩阵向量乘法），按阈值与条数过滤；没有向量时只做关键词检索
+        search_start = time.time()
+        direct = None
+        if query_embedding is None:
+            mode = fallback_mode
+            results = search_lexical(application, user_message)
+        else:
+            mode = application.retrieval_strategy
+            results, direct = match_knowledge(application, query_embedding, user_message)
+        print(f"知识检索耗时: {time.time() - search_start:.3f}秒, 命中 {len(results)} 条")
+        if direct:
+            print(f"[green]命中直接回答，相似度: {direct[2]:.4f}，不调用模型[/]")
+            return Retrieval(user_message, [direct], direct, query_embedding, mode)
+
+        if uses_rerank(application) and not (cancelled is not None and cancelled.is_set()):
+            rerank_start = time.time()
+            results = rerank_knowledge(application, user_message, results)
+            print(f"知识重排耗时: {time.time() - rerank_start:.3f}秒, 保留 {len(results)} 条")
+            print(f"重排缓存统计: {get_rerank_cache().stats()}")
+    except Exception as e:
+        print(f"检索知识时出错: {str(e)}")
+        return Retrieval(user_message, query_embedding=query_embedding, mode='error')
+    _log_results(results)
+    return Retrieval(build_knowledge_prompt(user_message, results), results, None, query_embedding, mode)
+
+
+async def aretrieve_knowledge(application, user_message) -> Retrieval:
+    """retrieve_knowledge 的异步版本：向量接口异步调用，检索放到线程中执行
+
+    超出检索时间预算时由调用方取消，向量接口调用被取消时计入熔断。
+    """
+    from asgiref.sync import sync_to_async
+
+    if not uses_knowledge_base(application):
+        return Retrieval(user_message)
+    query_embedding = None
+    # 没有查询向量时的检索方式：熔断中跳过了向量接口，或调用出错
+    fallback_mode = 'lexical'
+    try:
+        query_embedding = await aembed_query(
+            application.embedding_model, user_message, application.retrieval_timeout,
+            breaker=get_breaker(application.embedding_model)
+        )
+    except CircuitOpenError:
+        fallback_mode = 'breaker'
+        print("向量接口熔断中，改用关键词检索")
+    except Exception as e:
+        print(f"获取向量失败，改用关键词检索: {str(e)}")
+    try:
+        search_start = time.time()
+        direct = None
+        if query_embedding is None:
+            mode = fallback_mode
+            results = await sync_to_async(search_lexical)(application, user_message)
+        else:
+            mode = application.retrieval_strategy
+            results, direct = await sync_to_async(match_knowledge)(application, query_embedding, user_message)
+        print(f"知识检索耗时: {time.time() - search_start:.3f}秒, 命中 {len(results)} 条")
+        if direct:
+            print(f"[green]命中直接回答，相似度: {direct[2]:.4f}，不调用模型[/]")
+            return Retrieval(user_message, [direct], direct, query_embedding, mode)
+        if uses_rerank(application):
+            rerank_start = time.time()
+            results = await arerank_knowledge(application, user_message, results)
+            print(f"知识重排耗时: {time.time() - rerank_start:.3f}秒, 保留 {len(results)} 条")
+    except Exception as e:
+        print(f"检索知识时出错: {str(e)}")
+        return Retrieval(user_message, query_embedding=query_embedding, mode='error')
+    _log_results(results)
+    return Retrieval(build_knowledge_prompt(user_message, results), results, None, query_embedding, mode)
+
+
+def timeout_retrieval(application, user_message) -> Retrieval:
+    """检索超出时间预算时的退路：只用本地关键词检索，没有结果时不使用知识
+
+    这条路径不做重排，直接取 max_knowledge_items 条，不按 rerank_candidates 取候选。
+    """
+    try:
+        results = search_lexical(application, user_message, top_k=application.max_knowledge_items)
+    except Exception as e:
+        print(f"关键词检索出错: {str(e)}")
+        results = []
+    print(f"[yellow]知识检索超出 {application.retrieval_timeout} 秒预算，使用关键词检索结果 {len(results)} 条[/]")
+    _log_results(results)
+    return Retrieval(build_knowledge_prompt(user_message, results), results, mode='timeout')
+
+
+def replay_events(answer, chunk_size=REPLAY_CHUNK_SIZE):
+    """把已有的回答切分为SSE内容块，模拟模型的流式输出"""
+    for start in range(0, len(answer), chunk_size):
+        yield sse_event({'content': answer[start:start + chunk_size]})
+
+
+def direct_answer_fields(direct, latency, timings=None):
+    """直接回答的助手消息字段：不计模型与成本，api_response 记录所用知识"""
+    knowledge_id, answer, similarity = direct
+    api_response = {
+        'direct_answer': {'knowledge_id': knowledge_id, 'similarity': round(float(similarity), 4)},
+    }
+    if timings:
+        api_response['timings'] = timings
+    return {
+        'content': answer,
+        'tokens': count_tokens(answer),
+        'cost': 0,
+        'latency': round(latency, 3),
+        'api_response': api_response,
+    }
+
+
+def history_config():
+    return {**DEFAULT_HISTORY_CONFIG, **getattr(settings, 'CHAT_HISTORY_WINDOW', {})}
+
+
+def history_queryset(conversation, before_id=None):
+    """当前消息之前、摘要之后的用户与助手消息，按时间倒序，最多读取 MAX_MESSAGES 条
+
+    before_id 为None时不限定在当前消息之前（与保存当前消息并发读取），多读取一条，
+    由 exclude_message 剔除可能读到的当前消息。
+    """
+    queryset = conversation.messages.filter(
+        role__in=['user', 'assistant'],
+        id__gt=conversation.summary_until or 0
+    )
+    limit = history_config()['MAX_MESSAGES']
+    if before_id is None:
+        limit += 1
+    else:
+        queryset = queryset.filter(id__lt=before_id)
+    return queryset.order_by('-timestamp', '-id').values('id', 'role', 'content')[:limit]
+
+
+def exclude_message(history, message_id):
+    """从 history_queryset(conversation) 的结果中剔除当前消息，保留 MAX_MESSAGES 条"""
+    return [msg for msg in history if msg['id'] != message_id][:history_config()['MAX_MESSAGES']]
+
+
+def summary_message(conversation):
+    """会话已有滚动摘要时，作为system消息代替更早的对话"""
+    if not conversation.summary:
+        return None
+    return {"role": "system", "content": f"以下是此前对话的摘要：\n{conversation.summary}"}
+
+
+def context_limit(model):
+    return model.max_tokens_limit or history_config()['DEFAULT_CONTEXT_TOKENS']
+
+
+def parse_max_tokens(value, model, default=2000):
+    """解析请求中的 max_tokens：须为正整数，超过模型上下文上限时截断为上限；不合法时抛出 ValueError"""
+    if value is None:
+        value = default
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError("max_tokens 必须是正整数")
+    try:
+        max_tokens = int(value)
+    except ValueError:
+        raise ValueError("max_tokens 必须是正整数")
+    if max_tokens < 1:
+        raise ValueError("max_tokens 必须是正整数")
+    return min(max_tokens, context_limit(model))
+
+
+def fit_history(history, budget):
+    """从最近的消息开始保留，直到用完token预算；history 为时间倒序，返回时间正序"""
+    selected = []
+    for msg in history:
+        cost = count_tokens(msg['content']) + MESSAGE_OVERHEAD
+        if cost > budget:
+            break
+        budget -= cost
+        selected.append(msg)
+    selected.reverse()
+    return selected
+
+
+def build_messages(application, conversation, history, prompt, max_tokens):
+    """组装发送给模型的消息：系统角色 + 会话摘要 + 预算内的最近历史 + 当前问题
+
+    预算为模型上下文上限（AIModel.max_tokens_limit）减去回复预留的 max_tokens
+    与系统角色、摘要、当前问题的token数。
+    """
+    head = [msg for msg in (build_system_message(application), summary_message(conversation)) if msg]
+    current = {"role": "user", "content": prompt}
+    budget = context_limit(application.model) - max_tokens - count_message_tokens(head + [current])
+    history = list(history)
+    selected = fit_history(history, budget)
+    if len(selected) < len(history):
+        print(f"历史消息超出token预算，保留最近 {len(selected)}/{len(history)} 条")
+    messages = head
+    messages.extend({"role": msg['role'], "content": msg['content']} for msg in selected)
+    messages.append(current)
+    return messages
+
+
+def chunk_delta(chunk):
+    """取出流式响应块中的 (正文, 思考过程)，没有时为None"""
+    if not chunk.choices:
+        return None, None
+    delta = chunk.choices[0].delta
+    return getattr(delta, 'content', None), getattr(delta, 'reasoning_content', None)
+
+
+def resolve_usage(usage, messages, completion, reasoning=''):
+    """整理本次调用的token用量，接口未返回 usage 时用本地分词估算"""
+    if usage is not None and (usage.prompt_tokens or usage.completion_tokens):
+        prompt_tokens, completion_tokens = usage.prompt_tokens or 0, usage.completion_tokens or 0
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': usage.total_tokens or prompt_tokens + completion_tokens,
+            'estimated': False,
+        }
+    prompt_tokens = count_message_tokens(messages)
+    completion_tokens = count_tokens(completion) + count_tokens(reasoning)
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+        'estimated': True,
+    }
+
+
+def assistant_accounting(model, usage, latency, first_token_latency=None, timings=None):
+    """助手消息的 tokens / cost / latency / api_response 字段，timings 为调用模型前各阶段的耗时"""
+    api_response = {
+        'usage': usage,
+        'first_token_latency': round(first_token_latency, 3) if first_token_latency is not None else None,
+    }
+    if timings:
+        api_response['timings'] = timings
+    return {
+        'tokens': usage['completion_tokens'],
+        'cost': model.calculate_cost(usage['prompt_tokens'], usage['completion_tokens']),
+        'latency': round(latency, 3),
+        'api_response': api_response,
+    }
+
+
+DEFAULT_PREGENERATION_CONFIG = {
+    'WORKERS': 8,
+}
+
+
+@dataclass
+class Pregeneration:
+    """调用模型前的准备结果：已保存的用户消息、会话历史（时间倒序）、知识检索结果与各阶段耗时（秒）"""
+    user_message: object
+    history: list
+    retrieval: Retrieval
+    timings: dict = field(default_factory=dict)
+
+
+_pregeneration_executor = None
+# 同时进行的检索最多占用线程池的一半：超时后仍在等待向量接口的检索不会挤占保存用户消息
+_retrieval_slots = None
+_pregeneration_lock = threading.Lock()
+
+
+def _get_pregeneration_executor():
+    global _pregeneration_executor, _retrieval_slots
+    with _pregeneration_lock:
+        if _pregeneration_executor is None:
+            config = {**DEFAULT_PREGENERATION_CONFIG, **getattr(settings, 'CHAT_PREGENERATION', {})}
+            _pregeneration_executor = ThreadPoolExecutor(
+                max_workers=config['WORKERS'],
+                thread_name_prefix='chat-pregeneration'
+            )
+            _retrieval_slots = threading.BoundedSemaphore(max(config['WORKERS'] // 2, 1))
+        return _pregeneration_executor
+
+
+def _timed(timings, stage, func, *args):
+    start = time.time()
+    try:
+        return func(*args)
+    finally:
+        timings[stage] = round(time.time() - start, 3)
+
+
+def _timed_in_worker(timings, stage, func, *args):
+    try:
+        return _timed(timings, stage, func, *args)
+    finally:
+        close_old_connections()
+
+
+async def _atimed(timings, stage, awaitable):
+    start = time.time()
+    try:
+        return await awaitable
+    finally:
+        timings[stage] = round(time.time() - start, 3)
+
+
+def _user_message_fields(application, conversation, content):
+    return {
+        'conversation': conversation,
+        'role': 'user',
+        'content': content,
+        'tokens': count_tokens(content),
+        'model_used': application.model,
+    }
+
+
+def _finish_pregeneration(user_message, history, retrieval, timings, start):
+    timings['pregeneration'] = round(time.time() - start, 3)
+    print(f"调用模型前的准备耗时: {timings}")
+    return Pregeneration(user_message, exclude_message(history, user_message.id), retrieval, timings)
+
+
+def prepare_generation(application, conversation, content, retrieve=False) -> Pregeneration:
+    """并发完成调用模型前的准备：保存用户消息、读取会话历史、检索知识（retrieve=True 时）
+
+    检索（远程向量接口）与保存用户消息在线程池中执行，当前线程同时读取历史，
+    到调用模型的等待时间为各项中最慢的一项而不是总和。
+    检索超出应用的时间预算（retrieval_timeout）时不再等待，改用 timeout_retrieval 的结果：
+    尚未开始的检索被取消，已开始的在向量接口返回后停止；进行中的检索已达上限时也直接使用该结果。
+    """
+    start = time.time()
+    timings = {}
+    # 超时后检索线程仍会继续执行，各线程的耗时先写入各自的字典
+    retrieval_timings, message_timings = {}, {}
+    executor = _get_pregeneration_executor()
+    budget = application.retrieval_timeout
+    deadline = start + budget if budget else None
+    cancelled = threading.Event()
+    retrieval_future = None
+    if retrieve:
+        slots = _retrieval_slots
+        if slots.acquire(blocking=False):
+            retrieval_future = executor.submit(
+                _timed_in_worker, retrieval_timings, 'retrieval', retrieve_knowledge,
+                application, content, deadline, cancelled
+            )
+            retrieval_future.add_done_callback(lambda _: slots.release())
+        else:
+            print("[yellow]进行中的知识检索已达上限，不再排队[/]")
+    message_future = executor.submit(
+        _timed_in_worker, message_timings, 'save_user_message',
+        lambda: ChatMessage.objects.create(**_user_message_fields(application, conversation, content))
+    )
+    history = _timed(timings, 'history', lambda: list(history_queryset(conversation)))
+    user_message = message_future.result()
+    timings.update(message_timings)
+    retrieval = Retrieval(content)
+    if retrieval_future:
+        try:
+            retrieval = retrieval_future.result(timeout=max(deadline - time.time(), 0) if deadline else None)
+            timings.update(retrieval_timings)
+        except FutureTimeoutError:
+            cancelled.set()
+            retrieval_future.cancel()
+            retrieval_future = None
+    if retrieve and retrieval_future is None:
+        retrieval = timeout_retrieval(application, content)
+        timings['retrieval'] = round(time.time() - start, 3)
+    return _finish_pregeneration(user_message, history, retrieval, timings, start)
+
+
+async def aprepare_generation(application, conversation, content, retrieve=False) -> Pregeneration:
+    """prepare_generation 的异步版本：三项作为协程并发执行，检索超出时间预算时取消
+
+    异步ORM的查询都在同一个线程（thread_sensitive）中依次执行，只读的历史查询改在独立线程中
+    使用自己的数据库连接，与保存用户消息真正并发。
+    """
+    from asgiref.sync import sync_to_async
+
+    async def history():
+        return await sync_to_async(_timed_in_worker, thread_sensitive=False)(
+            timings, 'history', lambda: list(history_queryset(conversation))
+        )
+
+    async def retrieval():
+        if not retrieve:
+            return Retrieval(content)
+        try:
+            return await asyncio.wait_for(
+                aretrieve_knowledge(application, content), application.retrieval_timeout or None
+            )
+        except asyncio.TimeoutError:
+            return await sync_to_async(timeout_retrieval)(application, content)
+
+    start = time.time()
+    timings = {}
+    user_message, history, retrieval = await asyncio.gather(
+        _atimed(timings, 'save_user_message',
+                ChatMessage.objects.acreate(**_user_message_fields(application, conversation, content))),
+        history(),
+        _atimed(timings, 'retrieval', retrieval()) if retrieve else retrieval(),
+    )
+    return _finish_pregeneration(user_message, history, retrieval, timings, start)
@@ -0,0 +1,148 @@
+"""对话滚动摘要
+
+助手回复保存后，把会话中较早的对话交给应用配置的摘要模型（Application.summary_model）
+压缩为一段摘要，写入 ChatConversation.summary / summary_until。之后组装提示词时，
+摘要代替这些较早的消息（见 services.build_messages）。
+
+摘要在进程内的后台线程池中生成，不占用SSE响应；同一会话同时只会有一个摘要任务。
+配置见 settings.CHAT_SUMMARY::
+
+    CHAT_SUMMARY = {
+        'TRIGGER_TOKENS': 3000,  # 未摘要消息累计token数达到该值时生成摘要
+        'KEEP_RECENT': 6,        # 最近的若干条消息保持原文，不纳入摘要
+        'MAX_TOKENS': 600,       # 摘要的最大长度
+        'WORKERS': 2,            # 后台线程数
+    }
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Sum
+from django.utils import timezone
+
+from .clients import get_openai_client
+from .usage import record_usage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SUMMARY_CONFIG = {
+    'TRIGGER_TOKENS': 3000,
+    'KEEP_RECENT': 6,
+    'MAX_TOKENS': 600,
+    'WORKERS': 2,
+}
+
+SUMMARY_PROMPT = (
+    "请把下面的对话压缩成一段简洁的摘要，保留用户的身份与偏好、讨论过的关键事实、"
+    "已得出的结论和尚未解决的问题，供后续对话参考。只输出摘要内容。"
+)
+
+_executor = None
+_running = set()
+_lock = threading.Lock()
+
+
+def summary_config():
+    return {**DEFAULT_SUMMARY_CONFIG, **getattr(settings, 'CHAT_SUMMARY', {})}
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=summary_config()['WORKERS'],
+                thread_name_prefix='conversation-summary'
+            )
+        return _executor
+
+
+def schedule_summary(application, conversation):
+    """助手回复保存后调用；应用配置了摘要模型时提交后台摘要任务，立即返回"""
+    if not application.summary_model_id:
+        return
+    with _lock:
+        if conversation.pk in _running:
+            return
+        _running.add(conversation.pk)
+    try:
+        _get_executor().submit(_run, conversation.pk)
+    except RuntimeError:
+        # 进程退出时线程池已关闭
+        with _lock:
+            _running.discard(conversation.pk)
+
+
+def _run(conversation_id):
+    try:
+        summarize_conversation(conversation_id)
+    except Exception as e:
+        logger.warning(f"生成会话摘要失败 conversation={conversation_id}: {str(e)}")
+    finally:
+        with _lock:
+            _running.discard(conversation_id)
+        close_old_connections()
+
+
+def _format_transcript(rows):
+    names = {'user': '用户', 'assistant': '助手'}
+    return "\n".join(f"{names[row['role']]}: {row['content']}" for row in rows)
+
+
+def summarize_conversation(conversation_id):
+    """未摘要的消息超过阈值时，把除最近 KEEP_RECENT 条以外的消息并入摘要；返回是否更新了摘要"""
+    from .models import ChatConversation
+
+    config = summary_config()
+    conversation = ChatConversation.objects.select_related(
+        'application__summary_model'
+    ).get(pk=conversation_id)
+    model = conversation.application.summary_model if conversation.application else None
+    if model is None:
+        return False
+
+    pending = conversation.messages.filter(
+        role__in=['user', 'assistant'],
+        id__gt=conversation.summary_until or 0
+    )
+    if (pending.aggregate(total=Sum('tokens'))['total'] or 0) < config['TRIGGER_TOKENS']:
+        return False
+    rows = list(pending.order_by('timestamp', 'id').values('id', 'role', 'content'))
+    rows = rows[:-config['KEEP_RECENT']] if config['KEEP_RECENT'] else rows
+    if not rows:
+        return False
+
+    transcript = _format_transcript(rows)
+    if conversation.summary:
+        transcript = f"此前的摘要：\n{conversation.summary}\n\n后续对话：\n{transcript}"
+
+    client = get_openai_client(model.api_url, model.api_key)
+    response = client.chat.completions.create(
+        model=model.name,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ],
+        temperature=0.3,
+        max_tokens=config['MAX_TOKENS']
+    )
+    if response.usage:
+        record_usage(
+            model.pk, timezone.localdate(), conversation.application_id, calls=1,
+            tokens=response.usage.total_tokens,
+            cost=model.calculate_cost(response.usage.prompt_tokens, response.usage.completion_tokens)
+        )
+    summary = (response.choices[0].message.content or '').strip()
+    if not summary:
+        return False
+
+    # 以原 summary_until 为条件更新，避免覆盖其他进程同时生成的较新摘要
+    updated = ChatConversation.objects.filter(
+        pk=conversation_id, summary_until=conversation.summary_until
+    ).update(summary=summary, summary_until=rows[-1]['id'])
+    if updated:
+        logger.info(f"会话 {conversation_id} 摘要已更新，覆盖 {len(rows)} 条消息")
+    return bool(updated)
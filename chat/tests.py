@@ -1,3 +1,1467 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from embeddings.breaker import CircuitBreaker, CircuitOpenError, get_breaker
+from embeddings.cache import LocMemBackend, QueryEmbeddingCache, get_query_cache
+from embeddings.models import EmbeddingModel, Knowledge
+from embeddings.services import direct_answer
+from gongjuyuan_chat.sqlite_wal.base import DatabaseWrapper
+
+from .async_views import AsyncMessageStreamView
+from .clients import get_async_openai_client, get_openai_client
+from .failover import ModelRouter
+from .models import AIModel, Application, ChatConversation, ChatMessage, ModelUsageStat
+from .ratelimit import (
+    AsyncPermitReleasingStream, LocMemRateLimitBackend, ModelRateLimiter, PermitReleasingStream,
+    RateLimitExceeded, SQLiteRateLimitBackend, rate_limited_response
+)
+from .response_cache import ResponseCache, make_key, response_cache_key, response_cache_stats
+from .services import (
+    Retrieval, aprepare_generation, assistant_accounting, build_messages, exclude_message, fit_history,
+    history_queryset, parse_max_tokens, prepare_generation, resolve_usage, retrieve_knowledge
+)
+from .summary import schedule_summary, summarize_conversation
+from .tokens import MESSAGE_OVERHEAD, REPLY_OVERHEAD, count_message_tokens, count_tokens
+from .views import ChatStreamView
+from . import services
+from .usage import UsageBuffer
+
+
+def executed_statements(queries):
+    """捕获到的SQL中除保存点以外的语句"""
+    return [query['sql'].split()[0] for query in queries.captured_queries if 'SAVEPOINT' not in query['sql']]
+
+
+def content_chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+
+
+def usage_chunk(prompt_tokens=10, completion_tokens=5):
+    return SimpleNamespace(choices=[], usage=SimpleNamespace(
+        prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens
+    ))
+
+
+class FakeStream:
+    """同步流式响应：delay 秒后输出各块，块之间间隔 gap 秒，fail_after 为输出若干块后出错"""
+
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        if self.closed.wait(self.behaviour.get('delay', 0)):
+            return
+        for index, text in enumerate(self.behaviour.get('chunks', ['你好'])):
+            if index and self.closed.wait(self.behaviour.get('gap', 0)):
+                return
+            if index == self.behaviour.get('fail_after'):
+                raise RuntimeError('连接中断')
+            if self.closed.is_set():
+                return
+            yield content_chunk(text)
+        yield usage_chunk()
+
+    def close(self):
+        self.closed.set()
+
+
+class FakeAsyncStream(FakeStream):
+
+    def __iter__(self):
+        raise TypeError('异步响应')
+
+    async def _chunks(self):
+        await asyncio.sleep(self.behaviour.get('delay', 0))
+        for index, text in enumerate(self.behaviour.get('chunks', ['你好'])):
+            if index:
+                await asyncio.sleep(self.behaviour.get('gap', 0))
+            if index == self.behaviour.get('fail_after'):
+                raise RuntimeError('连接中断')
+            yield content_chunk(text)
+        yield usage_chunk()
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def close(self):
+        self.closed.set()
+
+
+class FakeOpenAI:
+    """代替 get_openai_client / get_async_openai_client：按模型名称决定出错、延迟与输出"""
+
+    def __init__(self, behaviours=None, asynchronous=False):
+        self.behaviours = behaviours or {}
+        self.asynchronous = asynchronous
+        self.requests = []
+        self.streams = {}
+        self.options = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def __call__(self, api_url, api_key):
+        return self
+
+    def with_options(self, **options):
+        self.options.append(options)
+        return self
+
+    def _open(self, model, messages, **kwargs):
+        self.requests.append((model, messages))
+        behaviour = self.behaviours.get(model, {})
+        if behaviour.get('error'):
+            raise RuntimeError(behaviour['error'])
+        stream = (FakeAsyncStream if self.asynchronous else FakeStream)(behaviour)
+        self.streams[model] = stream
+        return stream
+
+    def _create(self, **kwargs):
+        if not self.asynchronous:
+            return self._open(**kwargs)
+
+        async def create():
+            return self._open(**kwargs)
+        return create()
+
+    @property
+    def models(self):
+        return [model for model, _ in self.requests]
+
+
+def ai_model(pk, name, **fields):
+    return AIModel(pk=pk, name=name, api_url='http://llm.invalid/v1', api_key='k', **fields)
+
+
+class RateLimiterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.limiter = ModelRateLimiter(LocMemRateLimitBackend(poll_interval=0.05), max_wait=0, poll_interval=0.05)
+
+    def leases(self, model):
+        return list(self.limiter.backend._leases.get(model.pk, {}).values())
+
+    def test_unlimited_model_takes_no_lease(self):
+        model = ai_model(1, 'm')
+        permit = self.limiter.acquire([model], 100)
+        self.assertIsNone(permit.lease_id)
+        self.assertEqual(self.leases(model), [])
+
+    def test_concurrent_streams(self):
+        model = ai_model(1, 'm', max_concurrent_streams=1)
+        permit = self.limiter.acquire([model], 100)
+        with self.assertRaises(RateLimitExceeded) as raised:
+            self.limiter.acquire([model], 100)
+        self.assertIs(raised.exception.model, model)
+        permit.release()
+        permit.release()
+        self.limiter.acquire([model], 100)
+
+    def test_waits_for_a_released_stream(self):
+        model = ai_model(1, 'm', max_concurrent_streams=1)
+        self.limiter.max_wait = 2
+        permit = self.limiter.acquire([model], 100)
+        threading.Timer(0.2, permit.release).start()
+        start = time.time()
+        self.limiter.acquire([model], 100)
+        self.assertLess(time.time() - start, 1)
+
+    def test_requests_per_minute(self):
+        model = ai_model(1, 'm', requests_per_minute=2)
+        for _ in range(2):
+            self.limiter.acquire([model], 100).release()
+        with self.assertRaises(RateLimitExceeded) as raised:
+            self.limiter.acquire([model], 100)
+        self.assertAlmostEqual(raised.exception.retry_after, 60, delta=1)
+        response = rate_limited_response(raised.exception)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '60')
+
+    def test_tokens_per_minute_corrected_by_actual_usage(self):
+        model = ai_model(1, 'm', tokens_per_minute=1000)
+        permit = self.limiter.acquire([model], 600)
+        with self.assertRaises(RateLimitExceeded):
+            self.limiter.acquire([model], 600)
+        permit.release(tokens=100)
+        self.limiter.acquire([model], 600)
+        self.assertEqual(sorted(lease['tokens'] for lease in self.leases(model)), [100, 600])
+
+    def test_falls_back_to_model_with_capacity(self):
+        primary = ai_model(1, 'primary', requests_per_minute=1)
+        fallback = ai_model(2, 'fallback', requests_per_minute=1)
+        self.assertIs(self.limiter.acquire([primary, fallback], 100).model, primary)
+        self.assertIs(self.limiter.acquire([primary, fallback], 100).model, fallback)
+
+    def test_reports_model_with_shortest_wait(self):
+        primary = ai_model(1, 'primary', requests_per_minute=1)
+        fallback = ai_model(2, 'fallback', max_concurrent_streams=1)
+        self.limiter.acquire([primary], 100)
+        self.limiter.acquire([fallback], 100)
+        with self.assertRaises(RateLimitExceeded) as raised:
+            self.limiter.acquire([primary, fallback], 100)
+        self.assertIs(raised.exception.model, fallback)
+        self.assertEqual(raised.exception.retry_after, 0.05)
+
+    def test_expired_lease_no_longer_counts(self):
+        self.limiter.backend.lease_ttl = 0.05
+        model = ai_model(1, 'm', max_concurrent_streams=1)
+        self.limiter.acquire([model], 100)
+        time.sleep(0.1)
+        self.limiter.acquire([model], 100)
+
+    def test_async_acquire(self):
+        model = ai_model(1, 'm', max_concurrent_streams=1)
+        self.limiter.max_wait = 2
+
+        async def run():
+            permit = await self.limiter.aacquire([model], 100)
+            asyncio.get_running_loop().call_later(0.2, permit.release)
+            return await self.limiter.aacquire([model], 100)
+
+        self.assertIs(asyncio.run(run()).model, model)
+        self.limiter.max_wait = 0
+        with self.assertRaises(RateLimitExceeded):
+            asyncio.run(self.limiter.aacquire([model], 100))
+
+    def test_stream_wrappers_release_on_close(self):
+        model = ai_model(1, 'm', max_concurrent_streams=1)
+
+        def stream():
+            yield 'data'
+
+        # 客户端在首字节前断开：生成器从未被迭代，关闭时仍释放额度
+        PermitReleasingStream(stream(), self.limiter.acquire([model], 100)).close()
+        self.assertFalse(any(lease['active'] for lease in self.leases(model)))
+
+        async def astream():
+            yield 'data'
+
+        AsyncPermitReleasingStream(astream(), self.limiter.acquire([model], 100)).close()
+        self.assertFalse(any(lease['active'] for lease in self.leases(model)))
+
+    def test_sqlite_backend_fails_cleanly_when_locked(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        backend = SQLiteRateLimitBackend(path=os.path.join(directory, 'rate.sqlite3'))
+        limits = {'max_streams': 1, 'rpm': None, 'tpm': None}
+        lease_id, _ = backend.try_acquire(1, limits, 100)
+        self.assertIsNotNone(lease_id)
+        self.assertEqual(backend.try_acquire(1, limits, 100)[0], None)
+        backend.release(1, lease_id)
+        # 另一个进程持有写锁时 BEGIN 超时：抛出原来的错误，连接不留下事务
+        holder = sqlite3.connect(backend.path, isolation_level=None)
+        self.addCleanup(holder.close)
+        holder.execute("BEGIN IMMEDIATE")
+        backend._local.conn = sqlite3.connect(backend.path, timeout=0.05, isolation_level=None)
+        with self.assertRaisesMessage(sqlite3.OperationalError, 'locked'):
+            backend.try_acquire(1, limits, 100)
+        self.assertFalse(backend._local.conn.in_transaction)
+        holder.execute("ROLLBACK")
+        self.assertIsNotNone(backend.try_acquire(1, limits, 100)[0])
+
+
+class ModelRouterTests(SimpleTestCase):
+    messages = [{'role': 'user', 'content': '你好'}]
+
+    def setUp(self):
+        self.limiter = ModelRateLimiter(LocMemRateLimitBackend(), max_wait=0)
+        patcher = mock.patch('chat.ratelimit._limiter', self.limiter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.primary = ai_model(1, 'primary')
+        self.fallback = ai_model(2, 'fallback')
+        self.last = ai_model(3, 'last')
+
+    def router(self, models, hedge_after=None, permit=None):
+        application = SimpleNamespace(hedge_after=hedge_after)
+        return ModelRouter(application, models, self.messages, temperature=0.7, max_tokens=100, permit=permit)
+
+    def run_sync(self, fake, router):
+        with mock.patch('chat.failover.get_openai_client', fake):
+            return ''.join(chunk.choices[0].delta.content or '' for chunk in router.stream() if chunk.choices)
+
+    def run_async(self, fake, router):
+        async def collect():
+            return ''.join([
+                chunk.choices[0].delta.content or '' async for chunk in router.astream() if chunk.choices
+            ])
+
+        fake.asynchronous = True
+        with mock.patch('chat.failover.get_async_openai_client', fake):
+            return asyncio.run(collect())
+
+    def statuses(self, router):
+        return [(attempt.model.name, attempt.status) for attempt in router.attempts]
+
+    def test_single_model(self):
+        for run in (self.run_sync, self.run_async):
+            fake = FakeOpenAI({'primary': {'chunks': ['你', '好']}})
+            router = self.router([self.primary])
+            self.assertEqual(run(fake, router), '你好')
+            self.assertIsNone(router.report())
+            # 只有一个模型时保留客户端的重试
+            self.assertEqual(fake.options, [])
+
+    def test_fails_over_before_first_chunk(self):
+        for run in (self.run_sync, self.run_async):
+            fake = FakeOpenAI({'primary': {'error': '502'}, 'fallback': {'chunks': ['备用']}})
+            router = self.router([self.primary, self.fallback])
+            self.assertEqual(run(fake, router), '备用')
+            self.assertIs(router.model, self.fallback)
+            self.assertEqual(self.statuses(router), [('primary', 'failed'), ('fallback', 'answered')])
+            self.assertEqual(router.report()[0]['error'], '502')
+            self.assertEqual(fake.options, [{'max_retries': 0}])
+
+    def test_fails_over_after_empty_first_chunk(self):
+        # 只含角色的首块不算开始输出，之后出错仍改用备用模型
+        for run in (self.run_sync, self.run_async):
+            fake = FakeOpenAI({
+                'primary': {'chunks': [None, '一'], 'fail_after': 1}, 'fallback': {'chunks': ['备用']}
+            })
+            router = self.router([self.primary, self.fallback])
+            self.assertEqual(run(fake, router), '备用')
+            self.assertEqual(self.statuses(router), [('primary', 'failed'), ('fallback', 'answered')])
+
+    def test_no_failover_after_output_started(self):
+        for run in (self.run_sync, self.run_async):
+            fake = FakeOpenAI({'primary': {'chunks': ['一', '二'], 'fail_after': 1}})
+            with self.assertRaisesMessage(RuntimeError, '连接中断'):
+                run(fake, self.router([self.primary, self.fallback]))
+            self.assertEqual(fake.models, ['primary'])
+
+    def test_all_models_fail(self):
+        for run in (self.run_sync, self.run_async):
+            fake = FakeOpenAI({'primary': {'error': '502'}, 'fallback': {'error': '503'}})
+            with self.assertRaisesMessage(RuntimeError, '503'):
+                run(fake, self.router([self.primary, self.fallback]))
+
+    def test_skips_fallback_without_capacity(self):
+        limited = ai_model(2, 'fallback', requests_per_minute=1)
+        self.limiter.acquire([limited], 100)
+        for run in (self.run_sync, self.run_async):
+            fake = FakeOpenAI({'primary': {'error': '502'}})
+            router = self.router([self.primary, limited, self.last])
+            self.assertEqual(run(fake, router), '你好')
+            self.assertEqual(fake.models, ['primary', 'last'])
+            self.assertEqual(
+                self.statuses(router), [('primary', 'failed'), ('fallback', 'failed'), ('last', 'answered')]
+            )
+
+    def test_hedges_slow_model(self):
+        for run in (self.run_sync, self.run_async):
+            fake = FakeOpenAI({'primary': {'delay': 2, 'chunks': ['慢']}, 'fallback': {'chunks': ['快']}})
+            router = self.router([self.primary, self.fallback], hedge_after=0.1)
+            start = time.time()
+            self.assertEqual(run(fake, router), '快')
+            self.assertLess(time.time() - start, 1)
+            self.assertEqual(self.statuses(router), [('primary', 'cancelled'), ('fallback', 'answered')])
+            self.assertGreaterEqual(router.report()[1]['started'], 0.1)
+
+    def test_losing_stream_closed_by_its_worker(self):
+        fake = FakeOpenAI({'primary': {'delay': 0.3, 'chunks': ['慢']}, 'fallback': {'chunks': ['快']}})
+        closers = []
+        with mock.patch.object(FakeStream, 'close', lambda stream: closers.append(threading.current_thread())):
+            self.assertEqual(self.run_sync(fake, self.router([self.primary, self.fallback], hedge_after=0.1)), '快')
+            deadline = time.time() + 2
+            while len(closers) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        # 两个响应流都在各自的工作线程中关闭，而不是在读取结果的线程中
+        self.assertEqual(len(closers), 2)
+        self.assertNotIn(threading.current_thread(), closers)
+
+    def test_hedge_ignores_empty_first_chunk(self):
+        # 主模型很快返回只含角色的块，但直到备用模型输出前都没有内容，仍采用备用模型
+        for run in (self.run_sync, self.run_async):
+            fake = FakeOpenAI({
+                'primary': {'chunks': [None, '慢'], 'gap': 2}, 'fallback': {'delay': 0.2, 'chunks': ['快']}
+            })
+            router = self.router([self.primary, self.fallback], hedge_after=0.1)
+            self.assertEqual(run(fake, router), '快')
+            self.assertEqual(self.statuses(router), [('primary', 'cancelled'), ('fallback', 'answered')])
+
+    def test_no_hedge_when_first_chunk_is_fast(self):
+        for run in (self.run_sync, self.run_async):
+            fake = FakeOpenAI({'primary': {'delay': 0.05, 'chunks': ['主']}})
+            router = self.router([self.primary, self.fallback], hedge_after=1)
+            self.assertEqual(run(fake, router), '主')
+            self.assertEqual(fake.models, ['primary'])
+
+    def test_hedge_fails_over_on_error(self):
+        for run in (self.run_sync, self.run_async):
+            fake = FakeOpenAI({'primary': {'error': '502'}, 'fallback': {'chunks': ['备用']}})
+            router = self.router([self.primary, self.fallback], hedge_after=1)
+            self.assertEqual(run(fake, router), '备用')
+
+    def test_permits_released_with_actual_usage(self):
+        primary = ai_model(1, 'primary', tokens_per_minute=100000)
+        fallback = ai_model(2, 'fallback', tokens_per_minute=100000)
+        permit = self.limiter.acquire([primary, fallback], 1000)
+        fake = FakeOpenAI({'primary': {'error': '502'}})
+        self.run_sync(fake, self.router([primary, fallback], permit=permit))
+        leases = self.limiter.backend._leases
+        self.assertEqual([(lease['active'], lease['tokens']) for lease in leases[1].values()], [(False, 0)])
+        # 回答的模型按接口返回的用量修正预占
+        self.assertEqual([(lease['active'], lease['tokens']) for lease in leases[2].values()], [(False, 15)])
+
+
+class ChatTestMixin:
+    """隔离进程级的限流、缓存、统计与索引，模型接口由 FakeOpenAI 代替"""
+    dimension = 8
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.limiter = ModelRateLimiter(LocMemRateLimitBackend(), max_wait=0)
+        self.response_cache = ResponseCache(LocMemBackend())
+        self.fake = FakeOpenAI({'llm': {'chunks': ['模型', '回答']}})
+        for patcher in (
+            mock.patch('chat.ratelimit._limiter', self.limiter),
+            mock.patch('chat.response_cache._cache', self.response_cache),
+            mock.patch('chat.usage._buffer', UsageBuffer(enabled=False)),
+            mock.patch('chat.failover.get_openai_client', self.fake),
+            mock.patch('embeddings.cache._cache', QueryEmbeddingCache(LocMemBackend())),
+            # 测试数据都带有向量，不需要后台补齐
+            mock.patch('embeddings.services.schedule_missing_embeddings'),
+            mock.patch.dict('embeddings.index._indexes', clear=True),
+            mock.patch.dict('embeddings.breaker._breakers', clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        config = override_settings(
+            KNOWLEDGE_VECTOR_STORE={'BACKEND': 'memory', 'DIRECTORY': directory},
+            KNOWLEDGE_LEXICAL={'ENABLED': False},
+        )
+        config.enable()
+        self.addCleanup(config.disable)
+
+        self.model = AIModel.objects.create(
+            name='llm', model_type='LLM', api_url='http://llm.invalid/v1', api_key='k',
+            input_token_price=1, output_token_price=2
+        )
+        self.embedding_model = EmbeddingModel.objects.create(
+            name='emb', model_name='bge', api_url='http://embedding.invalid/v1', api_key='k',
+            dimension=self.dimension
+        )
+        self.application = Application.objects.create(name='app', model=self.model)
+        self.vectors = np.eye(self.dimension, dtype=np.float32)
+        items = [
+            Knowledge(question=f'问题{i}', answer=f'答案{i}', model=self.embedding_model)
+            for i in range(self.dimension)
+        ]
+        for item, vector in zip(items, self.vectors):
+            item.set_embedding(vector)
+        self.knowledge = Knowledge.objects.bulk_create(items)
+
+    def use_knowledge_base(self, **fields):
+        fields = {'embedding_model': self.embedding_model, 'knowledge_similarity_threshold': 0.5, **fields}
+        for name, value in fields.items():
+            setattr(self.application, name, value)
+        self.application.save()
+
+    def conversation(self):
+        return ChatConversation.objects.create(
+            application=self.application, session_id='s', conversation_id=f'c{ChatConversation.objects.count()}',
+            model=self.model
+        )
+
+    def stream_url(self, conversation):
+        return (f'/api/chat/applications/{self.application.pk}/conversations/'
+                f'{conversation.conversation_id}/messages/stream/')
+
+    def post(self, message, conversation=None):
+        """发送一条消息，返回 (状态码, SSE数据列表)"""
+        conversation = conversation or self.conversation()
+        response = self.client.post(
+            self.stream_url(conversation),
+            data=json.dumps({'session_id': 's', 'message': message}), content_type='application/json'
+        )
+        if response.status_code != 200:
+            return response.status_code, json.loads(response.content)
+        return 200, self.events(b''.join(response.streaming_content))
+
+    async def apost(self, message, conversation):
+        """经异步视图发送一条消息，返回 (状态码, SSE数据列表)"""
+        request = RequestFactory().post(
+            self.stream_url(conversation),
+            data=json.dumps({'session_id': 's', 'message': message}), content_type='application/json'
+        )
+        response = await AsyncMessageStreamView.as_view()(
+            request, application_id=self.application.pk, conversation_id=conversation.conversation_id
+        )
+        if response.status_code != 200:
+            return response.status_code, json.loads(response.content)
+        return 200, self.events(b''.join([chunk async for chunk in response.streaming_content]))
+
+    @staticmethod
+    def events(content):
+        events = []
+        for block in content.decode().split('\n\n'):
+            if block.startswith('data: ') and block != 'data: [DONE]':
+                events.append(json.loads(block[len('data: '):]))
+        return events
+
+    def answer(self, events):
+        return ''.join(event.get('content', '') for event in events)
+
+    def last_reply(self):
+        return ChatMessage.objects.filter(role='assistant').latest('id')
+
+
+class ClientRegistryTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch('chat.clients._clients', OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_same_endpoint_reuses_client(self):
+        client = get_openai_client('http://llm.local/v1/', 'k1')
+        self.assertIs(get_openai_client('http://llm.local/v1/', 'k1'), client)
+        self.assertIsNot(get_openai_client('http://llm.local/v1/', 'k2'), client)
+        self.assertIsNot(get_openai_client('http://other.local/v1/', 'k1'), client)
+
+    def test_async_clients_are_kept_per_event_loop(self):
+        async def get():
+            return get_async_openai_client('http://llm.local/v1/', 'k1')
+
+        async def get_twice():
+            return await get(), await get()
+
+        first, same = asyncio.run(get_twice())
+        self.assertIs(first, same)
+        self.assertIsNot(asyncio.run(get()), first)
+
+    @override_settings(OPENAI_CLIENT_POOL={'MAX_CLIENTS': 2})
+    def test_least_recently_used_client_is_dropped(self):
+        first = get_openai_client('http://a.local/v1/', 'k')
+        second = get_openai_client('http://b.local/v1/', 'k')
+        get_openai_client('http://a.local/v1/', 'k')
+        get_openai_client('http://c.local/v1/', 'k')
+        self.assertIs(get_openai_client('http://a.local/v1/', 'k'), first)
+        self.assertIsNot(get_openai_client('http://b.local/v1/', 'k'), second)
+
+    def test_model_endpoint_change_drops_old_client(self):
+        model = AIModel.objects.create(name='llm', model_type='LLM', api_url='http://llm.local/v1/', api_key='k1')
+        old = get_openai_client(model.api_url, model.api_key)
+        model.api_key = 'k2'
+        model.save()
+        self.assertIsNot(get_openai_client('http://llm.local/v1/', 'k1'), old)
+
+    def test_model_delete_drops_client(self):
+        model = AIModel.objects.create(name='llm', model_type='LLM', api_url='http://llm.local/v1/', api_key='k1')
+        old = get_openai_client(model.api_url, model.api_key)
+        other = get_openai_client('http://other.local/v1/', 'k1')
+        model.delete()
+        self.assertIsNot(get_openai_client('http://llm.local/v1/', 'k1'), old)
+        self.assertIs(get_openai_client('http://other.local/v1/', 'k1'), other)
+
+    def test_embedding_model_endpoint_change_drops_old_client(self):
+        embedding_model = EmbeddingModel.objects.create(
+            name='emb', model_name='bge', api_url='http://embeddings.local/v1/', api_key='k1', dimension=4
+        )
+        old = get_openai_client(embedding_model.api_url, embedding_model.api_key)
+        embedding_model.api_url = 'http://embeddings2.local/v1/'
+        embedding_model.save()
+        self.assertIsNot(get_openai_client('http://embeddings.local/v1/', 'k1'), old)
+
+
+class ConversationStatsTests(TestCase):
+    def setUp(self):
+        # 统计即时写入，测试中不启动后台写入线程
+        patcher = mock.patch('chat.usage._buffer', UsageBuffer(enabled=False))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.model = AIModel.objects.create(name='llm', model_type='LLM', api_url='http://llm.local/v1/')
+        self.conversation = ChatConversation.objects.create(conversation_id='c1')
+
+    def message(self, role='assistant', tokens=0, cost=None):
+        return ChatMessage.objects.create(
+            conversation=self.conversation, role=role, content='内容', tokens=tokens, cost=cost, model_used=self.model
+        )
+
+    def totals(self):
+        self.conversation.refresh_from_db()
+        return self.conversation.total_tokens, self.conversation.total_cost
+
+    def test_totals_follow_create_update_and_delete(self):
+        question = self.message('user', tokens=10)
+        answer = self.message(tokens=25, cost=0.0015)
+        self.assertEqual(self.totals(), (35, Decimal('0.0015')))
+
+        answer.tokens, answer.cost = 30, Decimal('0.002')
+        answer.save()
+        self.assertEqual(self.totals(), (40, Decimal('0.002')))
+
+        question.delete()
+        self.assertEqual(self.totals(), (30, Decimal('0.002')))
+
+        # 增量结果与全量重新汇总一致
+        self.conversation.update_stats()
+        self.assertEqual(self.totals(), (30, Decimal('0.002')))
+
+    def test_save_does_not_reaggregate_messages(self):
+        # 每条消息只执行一条 F() 增量 UPDATE，与会话已有消息数量无关
+        for _ in range(3):
+            self.message(tokens=2)
+        with mock.patch.object(ChatConversation, 'update_stats') as update_stats, \
+                CaptureQueriesContext(connection) as queries:
+            self.message(tokens=4)
+        update_stats.assert_not_called()
+        # 插入消息，会话与模型统计各一条增量 UPDATE
+        self.assertEqual(executed_statements(queries), ['INSERT', 'UPDATE', 'UPDATE'])
+        self.assertEqual(self.totals()[0], 10)
+
+    def test_model_stats_count_each_assistant_reply_once(self):
+        # 用户消息的token已计入助手消息记录的输入token，模型统计只按助手回复累加
+        self.message('user', tokens=10)
+        answer = ChatMessage.objects.create(
+            conversation=self.conversation, role='assistant', content='回答', tokens=20, cost=Decimal('0.001'),
+            model_used=self.model, api_response={'usage': {'prompt_tokens': 30, 'completion_tokens': 20,
+                                                           'total_tokens': 50}}
+        )
+        answer.content = '修改后的内容'
+        answer.save()
+        stat = ModelUsageStat.objects.get(model=self.model)
+        self.assertEqual((stat.call_count, stat.total_tokens, stat.total_cost), (1, 50, Decimal('0.001')))
+
+    def test_raw_save_keeps_imported_totals(self):
+        message = ChatMessage(conversation=self.conversation, role='assistant', content='导入', tokens=50,
+                              model_used=self.model)
+        message.save_base(raw=True)
+        self.assertEqual(self.totals()[0], 0)
+        self.assertFalse(ModelUsageStat.objects.exists())
+
+
+class UsageBufferTests(TestCase):
+    def setUp(self):
+        self.model = AIModel.objects.create(name='llm', model_type='LLM', api_url='http://llm.local/v1/')
+        self.application = Application.objects.create(name='app', model=self.model)
+        self.buffer = UsageBuffer(max_pending=100)
+        patcher = mock.patch.object(self.buffer, '_ensure_thread')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.day = date(2026, 1, 1)
+
+    def stats(self):
+        return {
+            stat.application_id: (stat.call_count, stat.total_tokens, stat.total_cost)
+            for stat in ModelUsageStat.objects.filter(model=self.model, date=self.day)
+        }
+
+    def test_records_are_merged_per_key_until_flush(self):
+        for _ in range(3):
+            self.buffer.record(self.model.pk, self.day, self.application.pk, calls=1, tokens=10, cost=0.001)
+        self.buffer.record(self.model.pk, self.day, None, calls=1, tokens=5)
+        self.assertEqual(self.stats(), {})
+        self.assertEqual(self.buffer.pending_count(), 2)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.buffer.flush(), 2)
+        # 每个键一条 UPDATE，行不存在时再 INSERT
+        self.assertEqual(executed_statements(queries), ['UPDATE', 'INSERT', 'UPDATE', 'INSERT'])
+        self.assertEqual(self.stats(), {
+            self.application.pk: (3, 30, Decimal('0.003')),
+            None: (1, 5, Decimal('0')),
+        })
+
+        self.buffer.record(self.model.pk, self.day, None, calls=2, tokens=7)
+        with CaptureQueriesContext(connection) as queries:
+            self.buffer.flush()
+        self.assertEqual(executed_statements(queries), ['UPDATE'])
+        self.assertEqual(self.stats()[None], (3, 12, Decimal('0')))
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_failed_flush_puts_records_back(self):
+        self.buffer.record(self.model.pk, self.day, None, calls=1, tokens=10, cost=Decimal('0.5'))
+        with mock.patch.object(UsageBuffer, '_write', side_effect=RuntimeError('database is locked')):
+            with self.assertRaises(RuntimeError):
+                self.buffer.flush()
+        self.assertEqual(self.buffer.pending_count(), 1)
+        # 写入失败期间的新记录与放回的记录合并
+        self.buffer.record(self.model.pk, self.day, None, calls=1, tokens=1)
+        self.buffer.flush()
+        self.assertEqual(self.stats(), {None: (2, 11, Decimal('0.5'))})
+
+    def test_full_buffer_wakes_flush_thread(self):
+        self.buffer.max_pending = 2
+        self.buffer.record(self.model.pk, self.day, calls=1)
+        self.assertFalse(self.buffer._wakeup.is_set())
+        self.buffer.record(self.model.pk, self.day, calls=1)
+        self.assertTrue(self.buffer._wakeup.is_set())
+
+    def test_disabled_buffer_writes_immediately(self):
+        buffer = UsageBuffer(enabled=False)
+        buffer.record(self.model.pk, self.day, None, calls=1, tokens=3)
+        self.assertEqual(self.stats(), {None: (1, 3, Decimal('0'))})
+
+    def test_one_row_per_model_and_day_without_application(self):
+        ModelUsageStat.objects.create(model=self.model, date=self.day)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ModelUsageStat.objects.create(model=self.model, date=self.day)
+        ModelUsageStat.objects.create(model=self.model, date=self.day, application=self.application)
+
+
+@mock.patch('chat.tokens._encoding', return_value=None)
+class TokenAccountingTests(TestCase):
+    def setUp(self):
+        count_tokens.cache_clear()
+        self.addCleanup(count_tokens.cache_clear)
+        self.messages = [{'role': 'system', 'content': '你是客服'}, {'role': 'user', 'content': 'hello world'}]
+
+    def test_heuristic_counts(self, _):
+        self.assertEqual(count_tokens(''), 0)
+        # 中日韩字符每个1个token，其余约每4个字符1个token
+        self.assertEqual(count_tokens('你好世界'), 4)
+        self.assertEqual(count_tokens('hello world'), 3)
+        self.assertEqual(count_tokens('你好 world'), 2 + 2)
+        self.assertEqual(count_message_tokens(self.messages), 4 + 3 + 2 * MESSAGE_OVERHEAD + REPLY_OVERHEAD)
+
+    def test_provider_usage_is_preferred(self, _):
+        usage = SimpleNamespace(prompt_tokens=120, completion_tokens=30, total_tokens=150)
+        self.assertEqual(resolve_usage(usage, self.messages, '回答'), {
+            'prompt_tokens': 120, 'completion_tokens': 30, 'total_tokens': 150, 'estimated': False,
+        })
+
+    def test_missing_usage_is_estimated(self, _):
+        empty = SimpleNamespace(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+        for usage in (None, empty):
+            self.assertEqual(resolve_usage(usage, self.messages, '回答', reasoning='思考'), {
+                'prompt_tokens': count_message_tokens(self.messages), 'completion_tokens': 4,
+                'total_tokens': count_message_tokens(self.messages) + 4, 'estimated': True,
+            })
+
+    def test_cost_is_exact_decimal(self, _):
+        model = AIModel(input_token_price=Decimal('2.5'), output_token_price=Decimal('10'))
+        cost = model.calculate_cost(1234, 567)
+        self.assertIsInstance(cost, Decimal)
+        # 0.003085 + 0.00567，浮点运算会得到 0.008755000000000001
+        self.assertEqual(cost, Decimal('0.008755'))
+
+    def test_assistant_accounting(self, _):
+        model = AIModel(input_token_price=Decimal('1'), output_token_price=Decimal('2'))
+        usage = {'prompt_tokens': 1000, 'completion_tokens': 500, 'total_tokens': 1500, 'estimated': False}
+        self.assertEqual(assistant_accounting(model, usage, 1.23456, 0.20001), {
+            'tokens': 500,
+            'cost': Decimal('0.002'),
+            'latency': 1.235,
+            'api_response': {'usage': usage, 'first_token_latency': 0.2},
+        })
+        self.assertIsNone(assistant_accounting(model, usage, 1)['api_response']['first_token_latency'])
+
+
+@mock.patch('chat.tokens._encoding', return_value=None)
+class HistoryWindowTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch('chat.usage._buffer', UsageBuffer(enabled=False))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        count_tokens.cache_clear()
+        self.model = AIModel.objects.create(name='llm', model_type='LLM', api_url='http://llm.local/v1/',
+                                            max_tokens_limit=100)
+        self.application = Application.objects.create(name='app', model=self.model, system_role='你是客服')
+        self.conversation = ChatConversation.objects.create(conversation_id='c1', application=self.application)
+
+    def add(self, role, content):
+        return ChatMessage.objects.create(conversation=self.conversation, role=role, content=content)
+
+    def test_fit_history_keeps_newest_turns_within_budget(self, _):
+        newest_first = [{'role': 'assistant', 'content': '三' * 6}, {'role': 'user', 'content': '二' * 6},
+                        {'role': 'assistant', 'content': '一' * 6}]
+        # 每条 6 + MESSAGE_OVERHEAD 个token
+        self.assertEqual(fit_history(newest_first, 25), newest_first[1::-1])
+        self.assertEqual(fit_history(newest_first, 30), newest_first[::-1])
+        self.assertEqual(fit_history(newest_first, 9), [])
+        # 较早的短消息不会越过超出预算的较新消息被选入
+        self.assertEqual(fit_history([{'role': 'user', 'content': '长' * 50}, {'role': 'user', 'content': '短'}],
+                                     20), [])
+
+    def test_history_is_bounded_and_starts_after_summary(self, _):
+        messages = [self.add('user' if i % 2 == 0 else 'assistant', f'第{i}条') for i in range(6)]
+        self.add('system', '系统消息')
+        current = self.add('user', '当前问题')
+        with override_settings(CHAT_HISTORY_WINDOW={'MAX_MESSAGES': 3}):
+            history = list(history_queryset(self.conversation, current.id))
+        self.assertEqual([msg['content'] for msg in history], ['第5条', '第4条', '第3条'])
+
+        self.conversation.summary_until = messages[3].id
+        history = list(history_queryset(self.conversation, current.id))
+        self.assertEqual([msg['content'] for msg in history], ['第5条', '第4条'])
+
+    def test_build_messages_reserves_reply_and_fixed_parts(self, _):
+        self.conversation.summary = '用户在问退货'
+        history = [{'role': 'assistant', 'content': '答' * 20}, {'role': 'user', 'content': '问' * 20},
+                   {'role': 'assistant', 'content': '旧' * 20}]
+        messages = build_messages(self.application, self.conversation, history, '当前问题', max_tokens=20)
+        # 固定部分共40个token，剩余40个token只够保留最近一条（24个token）
+        self.assertEqual([msg['role'] for msg in messages], ['system', 'system', 'assistant', 'user'])
+        self.assertEqual(messages[1]['content'], '以下是此前对话的摘要：\n用户在问退货')
+        self.assertEqual(messages[2]['content'], '答' * 20)
+        self.assertEqual(messages[-1], {'role': 'user', 'content': '当前问题'})
+        # 历史与回复预留合计不超过模型上下文上限
+        self.assertLessEqual(count_message_tokens(messages) + 20, self.model.max_tokens_limit)
+
+        # 回复预留占满上下文时只发送固定部分
+        messages = build_messages(self.application, self.conversation, history, '当前问题', max_tokens=100)
+        self.assertEqual([msg['role'] for msg in messages], ['system', 'system', 'user'])
+
+
+class FakeSummaryClient:
+    """摘要模型客户端替身，on_call 在返回结果前执行，用于模拟并发写入"""
+
+    def __init__(self, summary='摘要内容', on_call=None):
+        self.summary = summary
+        self.on_call = on_call
+        self.calls = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.on_call:
+            self.on_call()
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=self.summary))],
+            usage=SimpleNamespace(prompt_tokens=100, completion_tokens=20, total_tokens=120)
+        )
+
+
+@override_settings(CHAT_SUMMARY={'TRIGGER_TOKENS': 50, 'KEEP_RECENT': 2})
+class ConversationSummaryTests(TestCase):
+    def setUp(self):
+        self.buffer = UsageBuffer(enabled=False)
+        patcher = mock.patch('chat.usage._buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.model = AIModel.objects.create(name='llm', model_type='LLM', api_url='http://llm.local/v1/')
+        self.summary_model = AIModel.objects.create(name='mini', model_type='LLM', api_url='http://llm.local/v1/')
+        self.application = Application.objects.create(name='app', model=self.model, summary_model=self.summary_model)
+        self.conversation = ChatConversation.objects.create(conversation_id='c1', application=self.application)
+        self.messages = [
+            ChatMessage.objects.create(conversation=self.conversation, role=role, content=f'第{i}条', tokens=10)
+            for i, role in enumerate(['user', 'assistant'] * 3)
+        ]
+
+    def summarize(self, client):
+        with mock.patch('chat.summary.get_openai_client', return_value=client):
+            return summarize_conversation(self.conversation.pk)
+
+    def test_below_threshold_does_nothing(self):
+        client = FakeSummaryClient()
+        with override_settings(CHAT_SUMMARY={'TRIGGER_TOKENS': 61}):
+            self.assertFalse(self.summarize(client))
+        self.assertEqual(client.calls, [])
+
+    def test_older_turns_are_summarized(self):
+        client = FakeSummaryClient()
+        self.assertTrue(self.summarize(client))
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary, '摘要内容')
+        # 最近 KEEP_RECENT 条保持原文
+        self.assertEqual(self.conversation.summary_until, self.messages[3].id)
+        transcript = client.calls[0]['messages'][1]['content']
+        self.assertIn('助手: 第3条', transcript)
+        self.assertNotIn('第4条', transcript)
+        stat = ModelUsageStat.objects.get(model=self.summary_model)
+        self.assertEqual((stat.call_count, stat.total_tokens), (1, 120))
+
+        # 已摘要的消息不再计入阈值
+        self.assertFalse(self.summarize(FakeSummaryClient()))
+
+    def test_concurrent_newer_summary_is_not_overwritten(self):
+        def newer_summary_written():
+            ChatConversation.objects.filter(pk=self.conversation.pk).update(
+                summary='另一进程的摘要', summary_until=self.messages[4].id
+            )
+
+        self.assertFalse(self.summarize(FakeSummaryClient(on_call=newer_summary_written)))
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.summary, self.conversation.summary_until),
+                         ('另一进程的摘要', self.messages[4].id))
+
+    def test_one_job_per_conversation(self):
+        executor = mock.Mock()
+        with mock.patch('chat.summary._get_executor', return_value=executor), \
+                mock.patch('chat.summary._running', set()):
+            schedule_summary(self.application, self.conversation)
+            schedule_summary(self.application, self.conversation)
+        executor.submit.assert_called_once()
+
+
+class SQLiteWALBackendTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'db.sqlite3')
+
+    def wrapper(self, **options):
+        wrapper = DatabaseWrapper({**connection.settings_dict, 'NAME': self.path, 'OPTIONS': options}, alias='wal')
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def pragma(self, wrapper, name):
+        with wrapper.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_pragmas_are_applied_to_new_connections(self):
+        wrapper = self.wrapper(timeout=2, pragmas={'cache_size': -1000})
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(wrapper, 'busy_timeout'), 2000)
+        self.assertEqual(self.pragma(wrapper, 'cache_size'), -1000)
+        self.assertEqual(self.pragma(wrapper, 'synchronous'), 1)  # NORMAL
+
+    def test_transactions_take_the_write_lock_immediately(self):
+        wrapper = self.wrapper(timeout=0.1)
+        with wrapper.cursor() as cursor:
+            cursor.execute('CREATE TABLE t (id INTEGER)')
+        statements = []
+
+        def collect(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+
+        with wrapper.execute_wrapper(collect):
+            wrapper.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+        self.addCleanup(wrapper.set_autocommit, True)
+        self.assertEqual(statements, ['BEGIN IMMEDIATE'])
+        # 尚未写入任何数据，其他连接已无法开始写事务
+        other = sqlite3.connect(self.path, timeout=0)
+        self.addCleanup(other.close)
+        with self.assertRaisesMessage(sqlite3.OperationalError, 'database is locked'):
+            other.execute('BEGIN IMMEDIATE')
+        wrapper.rollback()
+
+    def test_invalid_transaction_mode(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.wrapper(transaction_mode='LAZY').get_connection_params()
+
+
+class DemoFixtureTests(TestCase):
+    def test_demo_data_loads_without_recounting_stats(self):
+        with mock.patch('embeddings.services.schedule_missing_embeddings') as schedule:
+            call_command('loaddata', 'demo', verbosity=0)
+        schedule.assert_not_called()
+        self.assertTrue(Application.objects.filter(pk=2).exists())
+        self.assertEqual(AIModel.objects.count(), 4)
+        self.assertEqual(Knowledge.objects.count(), 2)
+        # 导入的消息不会重复累加会话与模型统计
+        conversation = ChatConversation.objects.filter(messages__isnull=False).first()
+        total = conversation.total_tokens
+        conversation.update_stats()
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.total_tokens, total)
+        self.assertEqual(ModelUsageStat.objects.count(), 9)
+
+
+class DirectAnswerTests(ChatTestMixin, TransactionTestCase):
+    """检索与保存用户消息在线程池中进行，需要真正提交的数据"""
+
+    def setUp(self):
+        super().setUp()
+        self.use_knowledge_base(direct_answer_threshold=0.9)
+        self.model.requests_per_minute = 1
+        self.model.save()
+
+    def test_threshold(self):
+        results = [(1, '答案', 0.9), (2, '其他', 0.8)]
+        self.assertEqual(direct_answer(self.application, results), results[0])
+        self.assertIsNone(direct_answer(self.application, [(1, '答案', 0.89)]))
+        self.assertIsNone(direct_answer(self.application, []))
+        self.application.direct_answer_threshold = None
+        self.assertIsNone(direct_answer(self.application, results))
+
+    def test_retrieval_reports_direct_answer(self):
+        with mock.patch('chat.services.embed_query', return_value=self.vectors[3]):
+            retrieval = retrieve_knowledge(self.application, '问题3')
+        self.assertEqual(retrieval.direct_answer[:2], (self.knowledge[3].pk, '答案3'))
+        self.assertEqual(retrieval.prompt, '问题3')
+
+    def test_answers_from_knowledge_without_calling_model(self):
+        with mock.patch('chat.services.embed_query', return_value=self.vectors[3]):
+            # 直接回答不占用模型的限流额度
+            for _ in range(3):
+                status, events = self.post('问题3')
+                self.assertEqual(status, 200)
+                self.assertEqual(self.answer(events), '答案3')
+        self.assertEqual(self.fake.requests, [])
+        self.assertEqual(self.limiter.backend._leases.get(self.model.pk, {}), {})
+        reply = self.last_reply()
+        self.assertIsNone(reply.model_used)
+        self.assertEqual(reply.cost, 0)
+        self.assertEqual(reply.api_response['direct_answer']['knowledge_id'], self.knowledge[3].pk)
+        self.assertEqual(reply.api_response['direct_answer']['similarity'], 1.0)
+
+    def test_below_threshold_calls_model_with_knowledge(self):
+        query = (self.vectors[0] + self.vectors[1]) / 2
+        with mock.patch('chat.services.embed_query', return_value=query):
+            status, events = self.post('问题')
+            self.assertEqual(self.answer(events), '模型回答')
+            prompt = self.fake.requests[0][1][-1]['content']
+            self.assertIn('答案0', prompt)
+            self.assertIn('答案1', prompt)
+            self.assertEqual(self.last_reply().model_used, self.model)
+            # 需要调用模型时才排队取得额度，第二次超出每分钟请求数
+            status, events = self.post('问题')
+        self.assertEqual(events[-1]['code'], 'RATE_LIMITED')
+        self.assertEqual(len(self.fake.requests), 1)
+
+
+class ResponseCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache(LocMemBackend(), similarity_threshold=0.95, group_size=2)
+
+    def test_exact_question_hits_without_embedding(self):
+        self.assertIsNone(self.cache.lookup('key', '你好'))
+        self.cache.store('key', '你好', None, '回答')
+        self.assertEqual(self.cache.lookup('key', ' 你好 '), ('回答', 1.0))
+        self.assertIsNone(self.cache.lookup('other', '你好'))
+
+    def test_similar_question_hits_by_embedding(self):
+        self.cache.store('key', '问题一', np.array([1, 0, 0], dtype=np.float32), '回答')
+        answer, similarity = self.cache.lookup('key', '问题二', np.array([1, 0.1, 0], dtype=np.float32))
+        self.assertEqual(answer, '回答')
+        self.assertGreater(similarity, 0.95)
+        self.assertIsNone(self.cache.lookup('key', '问题三', np.array([1, 1, 0], dtype=np.float32)))
+
+    def test_group_keeps_latest_answers(self):
+        for question in ('一', '二', '三'):
+            self.cache.store('key', question, None, question)
+        self.assertIsNone(self.cache.lookup('key', '一'))
+        self.assertEqual(self.cache.lookup('key', '三'), ('三', 1.0))
+
+    def test_expired_answer_misses(self):
+        self.cache.store('key', '你好', None, '回答')
+        self.cache.ttl = -1
+        self.assertIsNone(self.cache.lookup('key', '你好'))
+
+    def test_key_depends_on_retrieved_knowledge(self):
+        model = AIModel(pk=1, name='llm', api_url='http://llm.invalid/v1', api_key='k')
+        application = Application(pk=1, model=model, response_cache_enabled=True)
+        conversation = SimpleNamespace(summary='')
+        retrieval = Retrieval('问题', [(1, '答案', 0.8)])
+        key = response_cache_key(application, conversation, [], retrieval)
+        self.assertEqual(key, make_key(application, [(1, '答案', 0.5)]))
+        self.assertNotEqual(key, make_key(application, [(2, '答案', 0.8)]))
+        # 默认只缓存单轮问答
+        self.assertIsNone(response_cache_key(application, conversation, [object()], retrieval))
+        self.assertIsNone(response_cache_key(application, SimpleNamespace(summary='摘要'), [], retrieval))
+        application.response_cache_enabled = False
+        self.assertIsNone(response_cache_key(application, conversation, [], retrieval))
+
+
+class ResponseCacheViewTests(ChatTestMixin, TransactionTestCase):
+    """检索与保存用户消息在线程池中进行，需要真正提交的数据"""
+
+    def setUp(self):
+        super().setUp()
+        self.application.response_cache_enabled = True
+        self.application.save()
+        self.model.requests_per_minute = 1
+        self.model.save()
+
+    def test_miss_then_hit(self):
+        status, events = self.post('你好')
+        self.assertEqual((status, self.answer(events)), (200, '模型回答'))
+        self.assertEqual(self.last_reply().api_response['response_cache'], 'miss')
+        # 回放缓存不调用模型，也不占用限流额度
+        for _ in range(2):
+            status, events = self.post('你好')
+            self.assertEqual((status, self.answer(events)), (200, '模型回答'))
+            reply = self.last_reply()
+            self.assertEqual(reply.api_response['response_cache'], 'hit')
+            self.assertIsNone(reply.model_used)
+        self.assertEqual(len(self.fake.requests), 1)
+        stats = response_cache_stats()
+        self.assertEqual([(row['hits'], row['misses']) for row in stats], [(2, 1)])
+
+    def test_follow_up_turn_is_not_cached(self):
+        conversation = self.conversation()
+        self.post('你好', conversation)
+        self.limiter.backend._leases.clear()
+        self.post('你好', conversation)
+        self.assertEqual(len(self.fake.requests), 2)
+        self.assertNotIn('response_cache', self.last_reply().api_response)
+
+    def test_disabled_cache_always_calls_model(self):
+        self.application.response_cache_enabled = False
+        self.application.save()
+        self.post('你好')
+        self.limiter.backend._leases.clear()
+        self.post('你好')
+        self.assertEqual(len(self.fake.requests), 2)
+        self.assertNotIn('response_cache', self.last_reply().api_response)
+
+    def test_rate_limited_before_stream_when_cache_disabled(self):
+        self.application.response_cache_enabled = False
+        self.application.save()
+        self.assertEqual(self.post('你好')[0], 200)
+        status, body = self.post('你好')
+        self.assertEqual((status, body['code']), (429, 'RATE_LIMITED'))
+
+
+class ChatStreamViewTests(ChatTestMixin, TransactionTestCase):
+    """检索与保存用户消息在线程池中进行，需要真正提交的数据"""
+
+    def chat(self, **fields):
+        request = RequestFactory().post(
+            '/', data=json.dumps({'application_id': self.application.pk, 'session_id': 's', 'message': '你好',
+                                  **fields}),
+            content_type='application/json'
+        )
+        response = ChatStreamView.as_view()(request)
+        if response.status_code != 200:
+            return response.status_code, json.loads(response.content)
+        return 200, self.events(b''.join(response.streaming_content))
+
+    def test_parse_max_tokens(self):
+        self.model.max_tokens_limit = 4096
+        self.assertEqual(parse_max_tokens(None, self.model), 2000)
+        self.assertEqual(parse_max_tokens('300', self.model), 300)
+        # 超过模型上下文上限时截断
+        self.assertEqual(parse_max_tokens(10 ** 9, self.model), 4096)
+        for value in ('abc', '1.5', 1.5, 0, -1, True, [100]):
+            with self.assertRaises(ValueError):
+                parse_max_tokens(value, self.model)
+
+    def test_invalid_max_tokens_is_rejected(self):
+        for value in ('abc', -1, 0, {'n': 1}):
+            status, body = self.chat(max_tokens=value)
+            self.assertEqual(status, 400)
+            self.assertIn('max_tokens', body['error'])
+        self.assertEqual(self.fake.requests, [])
+        self.assertFalse(ChatConversation.objects.exists())
+
+    def test_large_max_tokens_is_clamped(self):
+        self.model.max_tokens_limit = 4096
+        self.model.save()
+        status, events = self.chat(max_tokens=10 ** 9)
+        self.assertEqual((status, self.answer(events)), (200, '模型回答'))
+        self.assertEqual(self.last_reply().max_tokens, 4096)
+
+
+class RetrievalEventsTests(ChatTestMixin, TransactionTestCase):
+    """检索与保存用户消息在线程池中进行，需要真正提交的数据"""
+
+    def setUp(self):
+        super().setUp()
+        self.use_knowledge_base(direct_answer_threshold=0.9)
+
+    def test_stream_starts_before_retrieval(self):
+        conversation = self.conversation()
+        with mock.patch('chat.services.embed_query', return_value=self.vectors[3]) as embed_query:
+            response = self.client.post(
+                self.stream_url(conversation),
+                data=json.dumps({'session_id': 's', 'message': '问题3'}), content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 200)
+            # 检索与保存用户消息都在读取响应流时才进行
+            self.assertFalse(conversation.messages.exists())
+            embed_query.assert_not_called()
+            content = iter(response.streaming_content)
+            self.assertEqual(self.events(next(content)), [{'event': 'retrieval_started'}])
+            embed_query.assert_not_called()
+            events = self.events(b''.join(content))
+        embed_query.assert_called_once()
+        self.assertTrue(conversation.messages.filter(role='user', content='问题3').exists())
+        self.assertEqual(events[0]['event'], 'retrieval_done')
+        self.assertEqual(events[0]['hits'], 1)
+        self.assertGreaterEqual(events[0]['elapsed'], 0)
+        self.assertEqual(self.answer(events[1:]), '答案3')
+
+    def test_model_answer_follows_retrieval_done(self):
+        self.application.direct_answer_threshold = None
+        self.application.save()
+        with mock.patch('chat.services.embed_query', return_value=self.vectors[0]):
+            status, events = self.post('问题0')
+        self.assertEqual([event.get('event') for event in events[:2]], ['retrieval_started', 'retrieval_done'])
+        self.assertEqual(self.answer(events[2:]), '模型回答')
+
+    def test_no_progress_events_without_knowledge_base(self):
+        self.application.embedding_model = None
+        self.application.save()
+        status, events = self.post('你好')
+        self.assertFalse([event for event in events if 'event' in event])
+        self.assertEqual(self.answer(events), '模型回答')
+
+
+class AsyncRetrievalEventsTests(ChatTestMixin, TransactionTestCase):
+    """异步ORM在其他线程中执行，需要真正提交的数据"""
+
+    def test_async_stream_reports_retrieval(self):
+        self.use_knowledge_base(direct_answer_threshold=0.9)
+        conversation = self.conversation()
+
+        async def aembed_query(embedding_model, text, *args, **kwargs):
+            return self.vectors[3]
+
+        with mock.patch('chat.services.aembed_query', aembed_query):
+            status, events = asyncio.run(self.apost('问题3', conversation))
+        self.assertEqual(status, 200)
+        self.assertEqual(events[0], {'event': 'retrieval_started'})
+        self.assertEqual((events[1]['event'], events[1]['hits']), ('retrieval_done', 1))
+        self.assertEqual(self.answer(events[2:]), '答案3')
+        self.assertEqual(self.last_reply().api_response['direct_answer']['knowledge_id'], self.knowledge[3].pk)
+
+
+class PregenerationTests(ChatTestMixin, TransactionTestCase):
+    """保存用户消息与读取历史在不同线程中进行，需要真正提交的数据"""
+    delay = 0.3
+
+    def setUp(self):
+        super().setUp()
+        self.use_knowledge_base()
+        self.conv = self.conversation()
+        for index in range(3):
+            ChatMessage.objects.create(conversation=self.conv, role='user', content=f'旧问题{index}')
+
+    def slow_history(self, conversation, before_id=None):
+        time.sleep(self.delay)
+        return history_queryset(conversation, before_id)
+
+    def test_exclude_message(self):
+        history = [{'id': 3, 'role': 'user', 'content': '新'}, {'id': 2, 'role': 'user', 'content': '旧'}]
+        self.assertEqual(exclude_message(history, 3), history[1:])
+        with override_settings(CHAT_HISTORY_WINDOW={'MAX_MESSAGES': 1}):
+            self.assertEqual(exclude_message(history, 9), history[:1])
+
+    def test_stages_run_concurrently(self):
+        def slow_retrieval(application, content, *args):
+            time.sleep(self.delay)
+            return Retrieval('提示词')
+
+        start = time.time()
+        with mock.patch('chat.services.retrieve_knowledge', slow_retrieval), \
+                mock.patch('chat.services.history_queryset', self.slow_history):
+            prep = prepare_generation(self.application, self.conv, '新问题', retrieve=True)
+        self.assertLess(time.time() - start, self.delay * 1.8)
+        self.assertEqual(prep.retrieval.prompt, '提示词')
+        self.assertEqual(prep.user_message.content, '新问题')
+        self.assertTrue(ChatMessage.objects.filter(pk=prep.user_message.pk).exists())
+        self.assertEqual([msg['content'] for msg in prep.history], ['旧问题2', '旧问题1', '旧问题0'])
+        self.assertEqual(set(prep.timings), {'save_user_message', 'history', 'retrieval', 'pregeneration'})
+
+    def test_history_never_contains_current_message(self):
+        with override_settings(CHAT_HISTORY_WINDOW={'MAX_MESSAGES': 2}):
+            prep = prepare_generation(self.application, self.conv, '新问题')
+        self.assertEqual([msg['content'] for msg in prep.history], ['旧问题2', '旧问题1'])
+        self.assertEqual(prep.retrieval.prompt, '新问题')
+
+    def test_async_stages_run_concurrently(self):
+        async def slow_retrieval(application, content):
+            await asyncio.sleep(self.delay)
+            return Retrieval('提示词')
+
+        application = Application.objects.select_related('model', 'embedding_model').get(pk=self.application.pk)
+        start = time.time()
+        with mock.patch('chat.services.aretrieve_knowledge', slow_retrieval), \
+                mock.patch('chat.services.history_queryset', self.slow_history):
+            prep = asyncio.run(aprepare_generation(application, self.conv, '新问题', retrieve=True))
+        self.assertLess(time.time() - start, self.delay * 1.8)
+        self.assertEqual(prep.retrieval.prompt, '提示词')
+        self.assertEqual([msg['content'] for msg in prep.history], ['旧问题2', '旧问题1', '旧问题0'])
+        self.assertTrue(ChatMessage.objects.filter(pk=prep.user_message.pk, content='新问题').exists())
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker('emb', failure_threshold=2, cool_down=0.05)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open)
+        self.assertFalse(self.breaker.allow())
+
+    def test_single_probe_after_cool_down(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        # 试探失败重新计时，成功则恢复
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertFalse(self.breaker.is_open)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_call_records_outcome(self):
+        self.assertEqual(self.breaker.call(lambda: 1), 1)
+        with self.assertRaises(RuntimeError):
+            self.breaker.call(mock.Mock(side_effect=RuntimeError('超时')))
+        self.assertEqual(self.breaker.failures, 1)
+        self.breaker.record_failure()
+        func = mock.Mock()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(func)
+        func.assert_not_called()
+
+    def test_cancelled_async_call_counts_as_failure(self):
+        async def run():
+            task = asyncio.ensure_future(self.breaker.acall(lambda: asyncio.sleep(1)))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        self.assertEqual(self.breaker.failures, 1)
+
+
+class RetrievalTests(ChatTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.use_knowledge_base()
+        lexical = mock.patch('chat.services.search_lexical', return_value=[(1, '关键词答案', 1.0)])
+        self.search_lexical = lexical.start()
+        self.addCleanup(lexical.stop)
+        self.breaker = get_breaker(self.embedding_model)
+
+    def embed_texts(self, vector):
+        return mock.patch('embeddings.services.embed_texts', return_value=np.asarray([vector]))
+
+    def open_breaker(self):
+        for _ in range(self.breaker.failure_threshold):
+            self.breaker.record_failure()
+
+    def test_vector_search(self):
+        with self.embed_texts(self.vectors[2]):
+            retrieval = retrieve_knowledge(self.application, '问题2')
+        self.assertEqual(retrieval.mode, 'vector')
+        self.assertEqual(retrieval.results[0][:2], (self.knowledge[2].pk, '答案2'))
+        self.search_lexical.assert_not_called()
+
+    def test_embedding_timeout_is_remaining_budget(self):
+        with self.embed_texts(self.vectors[2]) as embed_texts:
+            retrieve_knowledge(self.application, '问题2', deadline=time.time() + 2)
+        timeout = embed_texts.call_args[0][2]
+        self.assertTrue(1.5 < timeout <= 2)
+
+    def test_embedding_error_falls_back_to_lexical(self):
+        with mock.patch('embeddings.services.embed_texts', side_effect=RuntimeError('超时')):
+            retrieval = retrieve_knowledge(self.application, '问题')
+        self.assertEqual(retrieval.mode, 'lexical')
+        self.assertEqual(retrieval.results, [(1, '关键词答案', 1.0)])
+        self.assertIn('关键词答案', retrieval.prompt)
+        self.assertEqual(self.breaker.failures, 1)
+
+    def test_open_breaker_skips_embedding(self):
+        self.open_breaker()
+        with self.embed_texts(self.vectors[2]) as embed_texts:
+            retrieval = retrieve_knowledge(self.application, '问题')
+        embed_texts.assert_not_called()
+        self.assertEqual(retrieval.mode, 'breaker')
+        self.assertEqual(retrieval.results, [(1, '关键词答案', 1.0)])
+
+    def test_cached_query_bypasses_breaker(self):
+        get_query_cache().get_or_compute(self.embedding_model, '问题2', lambda: self.vectors[2])
+        self.open_breaker()
+        failures = self.breaker.failures
+        with self.embed_texts(self.vectors[0]) as embed_texts:
+            retrieval = retrieve_knowledge(self.application, '问题2')
+        embed_texts.assert_not_called()
+        self.assertEqual(retrieval.mode, 'vector')
+        self.assertEqual(retrieval.results[0][0], self.knowledge[2].pk)
+        # 缓存命中不算试探调用，熔断状态不变
+        self.assertTrue(self.breaker.is_open)
+        self.assertEqual(self.breaker.failures, failures)
+
+
+class RetrievalTimeoutTests(ChatTestMixin, TransactionTestCase):
+    """检索在线程池或其他线程中进行，需要真正提交的数据"""
+
+    def setUp(self):
+        super().setUp()
+        self.use_knowledge_base(retrieval_timeout=0.2, max_knowledge_items=2)
+        lexical = mock.patch('chat.services.search_lexical', return_value=[(1, '关键词答案', 1.0)])
+        self.search_lexical = lexical.start()
+        self.addCleanup(lexical.stop)
+
+    def test_sync_retrieval_over_budget_is_cancelled(self):
+        stopped = threading.Event()
+
+        def slow_retrieval(application, user_message, deadline, cancelled):
+            if cancelled.wait(1):
+                stopped.set()
+            return Retrieval(user_message)
+
+        conversation = self.conversation()
+        start = time.time()
+        with mock.patch('chat.services.retrieve_knowledge', slow_retrieval):
+            prep = prepare_generation(self.application, conversation, '问题', retrieve=True)
+        self.assertLess(time.time() - start, 0.8)
+        self.assertEqual(prep.retrieval.mode, 'timeout')
+        self.assertIn('关键词答案', prep.retrieval.prompt)
+        # 超时路径不重排，只取 max_knowledge_items 条
+        self.search_lexical.assert_called_once_with(self.application, '问题', top_k=2)
+        self.assertEqual(prep.user_message.content, '问题')
+        self.assertTrue(ChatMessage.objects.filter(pk=prep.user_message.pk).exists())
+        # 放弃等待后通知检索线程停止，不再继续占用线程池
+        self.assertTrue(stopped.wait(1))
+
+    def test_retrievals_are_bounded(self):
+        services._get_pregeneration_executor()
+        slots = threading.BoundedSemaphore(1)
+        slots.acquire()
+        with mock.patch('chat.services._retrieval_slots', slots), \
+                mock.patch('chat.services.retrieve_knowledge') as retrieve:
+            prep = prepare_generation(self.application, self.conversation(), '问题', retrieve=True)
+        retrieve.assert_not_called()
+        self.assertEqual(prep.retrieval.mode, 'timeout')
+        self.assertIn('关键词答案', prep.retrieval.prompt)
+
+    def test_slot_is_released_after_retrieval(self):
+        services._get_pregeneration_executor()
+        slots = threading.BoundedSemaphore(1)
+        with mock.patch('chat.services._retrieval_slots', slots), \
+                mock.patch('chat.services.retrieve_knowledge', return_value=Retrieval('提示词', mode='vector')):
+            for _ in range(2):
+                prep = prepare_generation(self.application, self.conversation(), '问题', retrieve=True)
+                self.assertEqual(prep.retrieval.mode, 'vector')
+
+    def test_async_retrieval_over_budget_counts_as_failure(self):
+        async def slow_embedding(embedding_model, texts, timeout=None):
+            await asyncio.sleep(1)
+
+        conversation = self.conversation()
+        application = Application.objects.select_related('model', 'embedding_model').get(pk=self.application.pk)
+        start = time.time()
+        with mock.patch('embeddings.services.aembed_texts', slow_embedding):
+            prep = asyncio.run(aprepare_generation(application, conversation, '问题', retrieve=True))
+        self.assertLess(time.time() - start, 0.8)
+        self.assertEqual(prep.retrieval.mode, 'timeout')
+        self.search_lexical.assert_called_once_with(application, '问题', top_k=2)
+        self.assertEqual(get_breaker(self.embedding_model).failures, 1)
+        self.assertEqual(set(prep.timings), {'save_user_message', 'history', 'retrieval', 'pregeneration'})
+
+    def test_retrieval_mode_is_saved_on_reply(self):
+        with mock.patch('embeddings.services.embed_texts', return_value=np.asarray([self.vectors[0]])):
+            status, events = self.post('问题0')
+        done = [event for event in events if event.get('event') == 'retrieval_done'][0]
+        self.assertEqual(done['mode'], 'vector')
+        self.assertEqual(self.last_reply().retrieval_mode, 'vector')
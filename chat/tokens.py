@@ -0,0 +1,50 @@
+"""本地token计数
+
+模型接口未返回 usage 时用于估算token数，历史消息裁剪时也用它计算长度。
+安装了 tiktoken 时使用 cl100k_base 编码；否则按字符类别估算：
+中日韩字符每个约1个token，其余文本约每4个字符1个token。
+同一文本的计数结果会被缓存，历史消息在多轮对话中只需计算一次。
+"""
+import re
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken 为可选依赖
+    tiktoken = None
+
+# 每条消息的格式开销（role、分隔符等）与回复起始的固定开销
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 2
+
+_cjk_re = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]')
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception:
+        # 离线环境下编码文件可能无法下载
+        return None
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """估算一段文本的token数"""
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(_cjk_re.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(messages) -> int:
+    """估算一组对话消息作为输入时的token数"""
+    return sum(
+        count_tokens(msg.get('content') or '') + MESSAGE_OVERHEAD for msg in messages
+    ) + REPLY_OVERHEAD
@@ -1,8 +1,15 @@
+from django.conf import settings
 from django.urls import path
 from . import views
-from . import views
+from . import async_views
 app_name = 'chat'
 
+# ASGI 部署时使用异步流式视图，uWSGI 部署时使用同步视图
+if settings.CHAT_ASYNC_STREAMING:
+    MessageStreamView = async_views.AsyncMessageStreamView
+else:
+    MessageStreamView = views.MessageStreamView
+
 urlpatterns = [
     # UI 路由
 
@@ -34,7 +41,12 @@ urlpatterns = [
          views.MessageListView.as_view(), 
          name='message_list'),
     path('applications/<int:application_id>/conversations/<str:conversation_id>/messages/stream/', 
-         views.MessageStreamView.as_view(), 
+         MessageStreamView.as_view(), 
          name='message_stream'),
 
+    # 统计
+    path('response-cache/stats/',
+         views.ResponseCacheStatsView.as_view(),
+         name='response_cache_stats'),
+
 ]
\ No newline at end of file
@@ -0,0 +1,191 @@
+"""模型使用统计的写缓冲
+
+每条消息不再直接更新 ModelUsageStat，而是先在进程内按 (模型, 日期, 应用) 累加，
+再定时或在累计条数达到上限时批量写入数据库，一次事务内每个键只执行一条UPDATE/INSERT，
+避免高并发时所有请求争抢同一行的写锁。配置见 settings.USAGE_STATS_BUFFER::
+
+    USAGE_STATS_BUFFER = {
+        'ENABLED': True,       # 关闭后每条记录立即写入
+        'FLUSH_INTERVAL': 5,   # 定时写入间隔（秒）
+        'MAX_PENDING': 200,    # 累计记录条数达到该值时立即写入
+    }
+
+worker 退出（包括 uWSGI --max-requests 回收）时会写入剩余数据；
+进程被强制杀死（harakiri、SIGKILL）时最多丢失一个写入周期内的统计。
+"""
+import atexit
+import logging
+import threading
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_CONFIG = {
+    'ENABLED': True,
+    'FLUSH_INTERVAL': 5,
+    'MAX_PENDING': 200,
+}
+
+
+def buffer_config():
+    return {**DEFAULT_BUFFER_CONFIG, **getattr(settings, 'USAGE_STATS_BUFFER', {})}
+
+
+class UsageBuffer:
+    """进程内的使用统计累加器"""
+
+    def __init__(self, flush_interval=5, max_pending=200, enabled=True):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.enabled = enabled
+        self._pending = {}
+        self._records = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def record(self, model_id, date, application_id=None, calls=0, tokens=0, cost=0):
+        """累加一条使用记录"""
+        key = (model_id, date, application_id)
+        with self._lock:
+            entry = self._pending.setdefault(key, [0, 0, Decimal(0)])
+            entry[0] += calls
+            entry[1] += tokens
+            entry[2] += Decimal(str(cost)) if cost else Decimal(0)
+            self._records += 1
+            full = self._records >= self.max_pending
+
+        if not self.enabled:
+            self.flush()
+        elif full:
+            self._wakeup.set()
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            # 线程在 worker 内首次记录时启动，uWSGI 预加载应用后 fork 也不会丢失
+            self._thread = threading.Thread(target=self._run, name='usage-stats-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"写入模型使用统计失败: {str(e)}")
+            finally:
+                from django.db import connection
+                connection.close()
+
+    def flush(self) -> int:
+        """把累计的统计写入数据库，返回写入的键数量；失败时数据放回缓冲区"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._records = 0
+            if not pending:
+                return 0
+            try:
+                self._write(pending)
+            except Exception:
+                self._restore(pending)
+                raise
+            return len(pending)
+
+    def _restore(self, pending):
+        with self._lock:
+            for key, (calls, tokens, cost) in pending.items():
+                entry = self._pending.setdefault(key, [0, 0, Decimal(0)])
+                entry[0] += calls
+                entry[1] += tokens
+                entry[2] += cost
+                self._records += 1
+
+    @staticmethod
+    def _write(pending):
+        from .models import ModelUsageStat
+
+        with transaction.atomic():
+            for (model_id, date, application_id), (calls, tokens, cost) in pending.items():
+                lookup = {'model_id': model_id, 'date': date, 'application_id': application_id}
+                increments = {
+                    'call_count': F('call_count') + calls,
+                    'total_tokens': F('total_tokens') + tokens,
+                    'total_cost': F('total_cost') + cost,
+                }
+                if ModelUsageStat.objects.filter(**lookup).update(**increments):
+                    continue
+                try:
+                    with transaction.atomic():
+                        ModelUsageStat.objects.create(
+                            call_count=calls, total_tokens=tokens, total_cost=cost, **lookup
+                        )
+                except IntegrityError:
+                    # 其他 worker 同时创建了该行
+                    ModelUsageStat.objects.filter(**lookup).update(**increments)
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def _flush_on_exit():
+    if _buffer is None:
+        return
+    try:
+        written = _buffer.flush()
+        if written:
+            logger.info(f"退出前写入模型使用统计 {written} 条")
+    except Exception as e:
+        logger.warning(f"退出前写入模型使用统计失败: {str(e)}")
+
+
+def _register_exit_hook():
+    atexit.register(_flush_on_exit)
+    try:
+        import uwsgi
+    except ImportError:
+        return
+    # uWSGI 回收 worker 时调用 uwsgi.atexit，保留已有的钩子
+    previous = getattr(uwsgi, 'atexit', None)
+
+    def hook():
+        _flush_on_exit()
+        if previous:
+            previous()
+    uwsgi.atexit = hook
+
+
+def get_usage_buffer() -> UsageBuffer:
+    """按 settings.USAGE_STATS_BUFFER 创建进程级写缓冲"""
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                config = buffer_config()
+                _buffer = UsageBuffer(
+                    flush_interval=config['FLUSH_INTERVAL'],
+                    max_pending=config['MAX_PENDING'],
+                    enabled=config['ENABLED'],
+                )
+                _register_exit_hook()
+    return _buffer
+
+
+def record_usage(model_id, date, application_id=None, calls=0, tokens=0, cost=0):
+    get_usage_buffer().record(model_id, date, application_id, calls=calls, tokens=tokens, cost=cost)
@@ -3,6 +3,7 @@ from django.http import StreamingHttpResponse, JsonResponse, HttpResponse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.authentication import SessionAuthentication
 from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.decorators import action
@@ -12,6 +13,11 @@ from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.views import View
 from .models import ChatConversation, ChatMessage, AIModel, Application
+from .clients import get_openai_client
+from .failover import ModelRouter, candidate_models
+from .ratelimit import (
+    PermitReleasingStream, RateLimitExceeded, get_rate_limiter, rate_limited_payload, rate_limited_response
+)
 from .serializers import (
     ChatRequestSerializer, ApplicationSerializer, 
     ApplicationCreateSerializer, ChatConversationSerializer,
@@ -33,6 +39,14 @@ from django.http import Http404
 from django.template import Template, Context
 import numpy as np
 from embeddings.models import Knowledge  # 添加这行导入
+from .services import (
+    SSE_DONE, assistant_accounting, build_messages, chunk_delta, direct_answer_fields, may_skip_model,
+    parse_max_tokens, prepare_generation, progress_event, replay_events, resolve_usage, sse_event,
+    uses_knowledge_base
+)
+from .response_cache import cached_answer_fields, get_response_cache, response_cache_key, response_cache_stats
+from .summary import schedule_summary
+from .tokens import count_tokens
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
@@ -55,6 +69,7 @@ class ChatStreamView(View):
         print("\n" + "="*50)
         print(f"开始处理请求: {time.strftime('%Y-%m-%d %H:%M:%S')}")
         print("="*50)
+        permit = None
         
         try:
             # 解析请求数据
@@ -92,6 +107,18 @@ class ChatStreamView(View):
                     status=404
                 )
             
+            try:
+                max_tokens = parse_max_tokens(data.get('max_tokens'), application.model)
+            except ValueError as e:
+                return JsonResponse({"error": str(e)}, status=400)
+
+            # 按模型限流：排队取得请求额度，超过等待时间直接返回 429，不创建对话
+            models = candidate_models(application)
+            try:
+                permit = get_rate_limiter().acquire(models, count_tokens(data.get('message') or '') + max_tokens)
+            except RateLimitExceeded as e:
+                return rate_limited_response(e)
+
             # 获取或创建对话
             conv_start = time.time()
             conversation_id = data.get('conversation_id')
@@ -106,6 +133,7 @@ class ChatStreamView(View):
                     print(f"对话ID: {conversation.conversation_id}")
                     print(f"对话标题: {conversation.title}")
                 except ChatConversation.DoesNotExist:
+                    permit.release()
                     return JsonResponse(
                         {"error": "会话不存在"},
                         status=404
@@ -124,68 +152,24 @@ class ChatStreamView(View):
                 print(f"对话ID: {conversation.conversation_id}")
                 print(f"对话标题: {conversation.title}")
             
-            # 保存用户消息
-            msg_start = time.time()
-            user_message = ChatMessage.objects.create(
-                conversation=conversation,
-                role='user',
-                content=data['message'],
-                tokens=len(data['message']) // 2,
-                model_used=application.model
-            )
-            print(f"\n[4/7] 保存用户消息: {time.time() - msg_start:.3f}秒")
-            print(f"消息ID: {user_message.id}")
-            print(f"消息内容: {data['message'][:50]}...")
-            
             def event_stream():
                 stream_start = time.time()
-                print(f"\n[5/7] 开始流式处理: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+                print(f"\n[4/7] 开始流式处理: {time.strftime('%Y-%m-%d %H:%M:%S')}")
                 
                 try:
-                    # 初始化OpenAI客户端
-                    client_start = time.time()
-                    client = OpenAI(
-                        base_url=application.model.api_url,
-                        api_key=application.model.api_key
-                    )
-                    print(f"初始化OpenAI客户端: {time.time() - client_start:.3f}秒")
-                    
-                    # 准备消息
+                    # 保存用户消息与读取历史并发进行
+                    prep = prepare_generation(application, conversation, data['message'])
+                    print(f"\n[5/7] 保存用户消息并读取历史: {prep.timings}")
+                    print(f"消息ID: {prep.user_message.id}")
+                    print(f"消息内容: {data['message'][:50]}...")
+
+                    # 准备消息：系统角色 + 会话摘要 + 预算内的最近历史 + 当前问题
                     msg_prep_start = time.time()
-                    messages = []
-                    if application.system_role:
-                        # 确保系统角色不包含应用名称
-                        system_role = application.system_role.replace(application.name, "").strip()
-                        if not system_role:
-                            system_role = "你是一个智能助手，可以帮助用户解答问题。请保持友好和专业的态度。"
-                        messages.append({
-                            "role": "system",
-                            "content": system_role
-                        })
-                    
-                    # 获取历史消息（只获取用户和助手的消息）
-                    history_start = time.time()
-                    history_messages = conversation.messages.filter(
-                        role__in=['user', 'assistant'],
-                        conversation=conversation,  # 确保只获取当前对话的消息
-                        id__lt=user_message.id  # 只获取当前消息之前的消息
-                    ).order_by('timestamp')  # 按时间正序排列
-                    
-                    # 添加历史消息
-                    for msg in history_messages:
-                        messages.append({
-                            "role": msg.role,
-                            "content": msg.content
-                        })
-                    
-                    # 添加当前用户消息（确保不重复添加）
-                    if not messages or messages[-1]['role'] != 'user' or messages[-1]['content'] != data['message']:
-                        messages.append({
-                            "role": "user",
-                            "content": data['message']
-                        })
-                    
-                    print(f"准备历史消息: {time.time() - history_start:.3f}秒")
+                    temperature = data.get('temperature', 0.7)
+                    history_messages = prep.history
+                    messages = build_messages(
+                        application, conversation, history_messages, data['message'], max_tokens
+                    )
                     print(f"总消息准备: {time.time() - msg_prep_start:.3f}秒")
                     print(f"历史消息数量: {len(history_messages)}")
                     
@@ -199,24 +183,17 @@ class ChatStreamView(View):
                     assistant_message = ChatMessage(
                         conversation=conversation,
                         role='assistant',
-                        model_used=application.model,
-                        temperature=request.data.get('temperature', 0.7),
-                        max_tokens=request.data.get('max_tokens', 2000)
+                        temperature=temperature,
+                        max_tokens=max_tokens
                     )
                     print(f"创建助手消息对象: {time.time() - assistant_start:.3f}秒")
                     
                     # 调用OpenAI API
                     api_start = time.time()
                     print(f"\n[6/7] 开始调用OpenAI API: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-                    response = client.chat.completions.create(
-                        model=application.model.name,
-                        messages=messages,
-                        stream=True,
-                        temperature=0.7,  # 使用默认值
-                        max_tokens=2000   # 使用默认值
-                    )
-                    print(f"API调用耗时: {time.time() - api_start:.3f}秒")
+                    router = ModelRouter(application, models, messages, temperature, max_tokens, permit)
                     
+                    usage = None
                     full_response = ""
                     first_chunk_time = None
                     chunk_count = 0
@@ -225,8 +202,9 @@ class ChatStreamView(View):
                     # 处理流式响应
                     stream_process_start = time.time()
                     print("\n[7/7] 开始接收流式响应:")
-                    for chunk in response:
+                    for chunk in router.stream():
                         chunk_start = time.time()
+                        usage = getattr(chunk, 'usage', None) or usage
                         if not chunk.choices:
                             continue
                             
@@ -255,37 +233,44 @@ class ChatStreamView(View):
                     # 保存助手消息
                     save_start = time.time()
                     assistant_message.content = full_response
-                    assistant_message.tokens = len(full_response) // 2
+                    assistant_message.model_used = router.model
+                    usage = resolve_usage(usage, messages, full_response)
+                    for field, value in assistant_accounting(
+                        router.model, usage, time.time() - api_start,
+                        first_chunk_time - api_start if first_chunk_time else None,
+                        prep.timings
+                    ).items():
+                        setattr(assistant_message, field, value)
+                    router.annotate(assistant_message.api_response)
                     assistant_message.save()
+                    schedule_summary(application, conversation)
                     print(f"保存助手消息: {time.time() - save_start:.3f}秒")
                     
-                    # 更新对话统计
-                    stats_start = time.time()
-                    conversation.update_stats()
-                    print(f"更新对话统计: {time.time() - stats_start:.3f}秒")
-                    
                     print(f"\n流式处理完成:")
                     print(f"总耗时: {time.time() - stream_start:.3f}秒")
                     print(f"总响应长度: {len(full_response)} 字符")
                     print(f"总响应块数: {chunk_count}")
+                    print(f"token用量: {usage}")
                     
                     yield "data: [DONE]\n\n"
                     
                 except Exception as e:
                     print(f"\n流式处理出错: {str(e)}")
                     yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                finally:
+                    permit.release()
                 
-                response = StreamingHttpResponse(
-                    event_stream(),
-                    content_type='text/event-stream'
-                )
-                response['Cache-Control'] = 'no-cache'
-                response['X-Accel-Buffering'] = 'no'
-                
-                print(f"\n请求处理完成:")
-                print(f"总耗时: {time.time() - stream_start:.3f}秒")
-                print("="*50 + "\n")
-                return response
+            response = StreamingHttpResponse(
+                PermitReleasingStream(event_stream(), permit),
+                content_type='text/event-stream'
+            )
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            
+            print(f"\n请求处理完成:")
+            print(f"总耗时: {time.time() - start_time:.3f}秒")
+            print("="*50 + "\n")
+            return response
                 
         except json.JSONDecodeError:
             print("\nJSON解析错误")
@@ -295,6 +280,8 @@ class ChatStreamView(View):
             )
         except Exception as e:
             print(f"\n请求处理错误: {str(e)}")
+            if permit is not None:
+                permit.release()
             return JsonResponse(
                 {"error": str(e)},
                 status=500
@@ -390,10 +377,7 @@ class ChatMessageView(APIView):
                 print("\n[yellow]开始调用对话API...[/]")
                 chat_start = time.time()
                 
-                chat_client = OpenAI(
-                    base_url=application.model.api_url,
-                    api_key=application.model.api_key
-                )
+                chat_client = get_openai_client(application.model.api_url, application.model.api_key)
                 
                 response = chat_client.chat.completions.create(
                     model=application.model.model_name,
@@ -755,165 +739,104 @@ class MessageStreamView(View):
             if application.embedding_model:
                 print(f"[dim]向量模型API: {application.embedding_model.api_url}[/]")
                 print(f"[dim]向量模型状态: {'启用' if application.embedding_model.is_active else '禁用'}[/]")
-            
-            # 如果启用了向量模型，先获取向量
-            if application.embedding_model and application.embedding_model.is_active:
-                print("\n[yellow]开始处理对话请求...[/]")
-                print("[yellow]开始获取向量...[/]")
-                
-                try:
-                    # 初始化向量模型客户端
-                    embedding_client = OpenAI(
-                        base_url=application.embedding_model.api_url,
-                        api_key=application.embedding_model.api_key
-                    )
-                    
-                    # 获取查询的向量表示
-                    embedding_response = embedding_client.embeddings.create(
-                        model=application.embedding_model.model_name,
-                        input=user_message
-                    )
-                    
-                    query_embedding = embedding_response.data[0].embedding
-                    print(f"获取到向量，维度: {len(query_embedding)}")
-                    
-                    # 从数据库获取知识
-                    knowledge_items = application.embedding_model.knowledge_set.filter(
-                        is_valid=True
-                    )
-                    print(f"找到 {knowledge_items.count()} 条知识")
-                    
-                    # 计算相似度并排序
-                    results = []
-                    for item in knowledge_items:
-                        try:
-                            # 获取知识文本的向量表示
-                            item_embedding_response = embedding_client.embeddings.create(
-                                model=application.embedding_model.model_name,
-                                input=item.question  # 使用问题作为向量生成的输入
-                            )
-                            item_embedding = item_embedding_response.data[0].embedding
-                            
-                            # 计算余弦相似度
-                            dot_product = np.dot(query_embedding, item_embedding)
-                            norm_query = np.linalg.norm(query_embedding)
-                            norm_vec = np.linalg.norm(item_embedding)
-                            
-                            if norm_query == 0 or norm_vec == 0:
-                                print(f"知识项 {item.id} 的向量范数为0")
-                                continue
-                                
-                            similarity = dot_product / (norm_query * norm_vec)
-                            print(f"知识项 {item.id} 相似度: {similarity:.4f}")
-                            
-                            # 添加相似度阈值判断的日志
-                            print(f"当前相似度阈值: {application.knowledge_similarity_threshold}")
-                            if similarity >= application.knowledge_similarity_threshold:
-                                print(f"知识项 {item.id} 相似度 {similarity:.4f} 超过阈值 {application.knowledge_similarity_threshold}，将被使用")
-                                results.append((item.id, item.answer, similarity))  # 使用答案作为上下文
-                            else:
-                                print(f"知识项 {item.id} 相似度 {similarity:.4f} 未达到阈值 {application.knowledge_similarity_threshold}，将被忽略")
-                        except Exception as e:
-                            print(f"处理知识项 {item.id} 时出错: {str(e)}")
-                            continue
-                    
-                    # 按相似度排序并获取前N个结果
-                    results.sort(key=lambda x: x[2], reverse=True)
-                    results = results[:application.max_knowledge_items]
-                    
-                    if results:
-                        print("\n[yellow]找到的相关知识：[/]")
-                        for item in results:
-                            print(f"[dim]相似度: {item[2]:.4f} - {item[1]}[/]")
-                        
-                        # 构建带上下文的提示词
-                        context = "\n".join([f"- {item[1]}" for item in results])
-                        prompt = f"""基于以下上下文信息回答问题：
-
-上下文信息：
-{context}
-
-用户问题：{user_message}
 
-请基于上述上下文信息回答问题。如果问题与上下文无关，请明确告知用户。"""
-                    else:
-                        print("[yellow]未找到相关知识，将直接回答问题...[/]")
-                        prompt = user_message
-                except Exception as e:
-                    print(f"处理向量时出错: {str(e)}")
-                    prompt = user_message
-            else:
-                prompt = user_message
-            
-            # 保存用户消息
-            user_message_obj = ChatMessage.objects.create(
-                conversation=conversation,
-                role='user',
-                content=user_message,
-                tokens=len(user_message) // 2,
-                model_used=application.model
-            )
+            # 按模型限流：排队取得请求额度，超过等待时间直接返回 429；
+            # 可能直接回答或回放缓存的应用在流内确定需要调用模型后才排队，不调用模型的请求不占额度
+            max_tokens = 2000  # 使用默认值
+            models = candidate_models(application)
+            request_tokens = count_tokens(user_message or '') + max_tokens
+            permit = None
+            if not may_skip_model(application):
+                try:
+                    permit = get_rate_limiter().acquire(models, request_tokens)
+                except RateLimitExceeded as e:
+                    return rate_limited_response(e)
+
+            def direct_answer_stream(prep):
+                # 命中直接回答：按块输出知识答案，不调用模型
+                direct = prep.retrieval.direct_answer
+                yield from replay_events(direct[1])
+                ChatMessage.objects.create(
+                    conversation=conversation,
+                    role='assistant',
+                    retrieval_mode=prep.retrieval.mode,
+                    **direct_answer_fields(direct, time.time() - start_time, prep.timings)
+                )
+                schedule_summary(application, conversation)
+                print(f"[bold green]直接回答完成，总执行时间: {round(time.time() - start_time, 3)} 秒[/]")
+                yield SSE_DONE
 
             def event_stream():
+                nonlocal permit
                 try:
-                    # 初始化OpenAI客户端
-                    client_init_start = time.time()
-                    client = OpenAI(
-                        base_url=application.model.api_url,
-                        api_key=application.model.api_key
+                    # 先发出响应头与进度事件，检索在流内进行，首字节时间与知识库大小无关
+                    knowledge_base = uses_knowledge_base(application)
+                    if knowledge_base:
+                        yield progress_event('retrieval_started')
+                    # 保存用户消息、读取历史与检索知识并发进行
+                    prep = prepare_generation(application, conversation, user_message, retrieve=knowledge_base)
+                    retrieval = prep.retrieval
+                    prompt = retrieval.prompt
+                    if knowledge_base:
+                        yield progress_event(
+                            'retrieval_done',
+                            hits=len(retrieval.results),
+                            elapsed=prep.timings['retrieval'],
+                            mode=retrieval.mode
+                        )
+                    if retrieval.direct_answer:
+                        yield from direct_answer_stream(prep)
+                        return
+
+                    history = prep.history
+
+                    # 语义相同的问题回放缓存的回答，不调用模型
+                    cache_key = response_cache_key(application, conversation, history, retrieval)
+                    cached = cache_key and get_response_cache().lookup(
+                        cache_key, user_message, retrieval.query_embedding
+                    )
+                    if cached:
+                        print(f"[green]命中回答缓存，相似度: {cached[1]:.4f}，不调用模型[/]")
+                        yield from replay_events(cached[0])
+                        ChatMessage.objects.create(
+                            conversation=conversation,
+                            role='assistant',
+                            retrieval_mode=prep.retrieval.mode,
+                            **cached_answer_fields(cached, time.time() - start_time, prep.timings)
+                        )
+                        schedule_summary(application, conversation)
+                        yield SSE_DONE
+                        return
+
+                    # 准备消息：系统角色 + 会话摘要 + 预算内的最近历史 + 当前问题
+                    messages = build_messages(
+                        application,
+                        conversation,
+                        history,
+                        prompt,  # 使用处理后的prompt
+                        max_tokens
                     )
-                    print(f"客户端初始化耗时: {time.time() - client_init_start:.3f}秒")
-
-                    # 准备消息
-                    messages = []
-                    # 添加系统角色消息
-                    if application.system_role:
-                        print(f"使用系统角色: {application.system_role}")
-                        # 确保系统角色不包含应用名称
-                        system_role = application.system_role.replace(application.name, "").strip()
-                        if not system_role:
-                            system_role = "你是一个智能助手，可以帮助用户解答问题。请保持友好和专业的态度。"
-                        messages.append({
-                            "role": "system",
-                            "content": system_role
-                        })
-                    
-                    # 获取历史消息（只获取用户和助手的消息）
-                    history_start = time.time()
-                    history_messages = conversation.messages.filter(
-                        role__in=['user', 'assistant'],
-                        conversation=conversation,  # 确保只获取当前对话的消息
-                        id__lt=user_message_obj.id  # 只获取当前消息之前的消息
-                    ).order_by('timestamp')  # 按时间正序排列
-                    
-                    # 添加历史消息
-                    for msg in history_messages:
-                        messages.append({
-                            "role": msg.role,
-                            "content": msg.content
-                        })
-                    
-                    # 添加当前用户消息（确保不重复添加）
-                    if not messages or messages[-1]['role'] != 'user' or messages[-1]['content'] != user_message:
-                        messages.append({
-                            "role": "user",
-                            "content": prompt  # 使用处理后的prompt
-                        })
 
                     # 打印完整的消息列表，用于调试
                     print("\n发送给AI的消息列表:")
                     for msg in messages:
                         print(f"{msg['role']}: {msg['content'][:100]}...")
 
-                    # 调用OpenAI API
+                    if permit is None:
+                        try:
+                            permit = get_rate_limiter().acquire(models, request_tokens)
+                        except RateLimitExceeded as e:
+                            yield sse_event(rate_limited_payload(e))
+                            return
+
+                    # 调用OpenAI API（主模型出错或响应慢时使用备用模型）
                     api_start = time.time()
                     print(f"\n[6/7] 开始调用OpenAI API: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-                    response = client.chat.completions.create(
-                        model=application.model.name,
-                        messages=messages,
-                        stream=True,
+                    router = ModelRouter(
+                        application, models, messages,
                         temperature=0.7,  # 使用默认值
-                        max_tokens=2000   # 使用默认值
+                        max_tokens=max_tokens,
+                        permit=permit
                     )
 
                     # 记录第一个响应块的时间
@@ -922,10 +845,12 @@ class MessageStreamView(View):
                     total_content_length = 0
                     full_response = ""
                     full_reasoning = ""
+                    usage = None
 
                     # 逐步接收并处理响应
                     print("[yellow]开始接收响应...[/]")
-                    for chunk in response:
+                    for chunk in router.stream():
+                        usage = getattr(chunk, 'usage', None) or usage
                         if not chunk.choices:
                             continue
                         
@@ -935,51 +860,68 @@ class MessageStreamView(View):
                             print(f"第一个响应块耗时: {first_chunk_time - api_start:.3f}秒")
                         
                         total_chunks += 1
-                        if chunk.choices[0].delta.content:
-                            content = chunk.choices[0].delta.content
+                        content, reasoning = chunk_delta(chunk)
+                        if content:
                             total_content_length += len(content)
                             full_response += content
                             # 直接yield数据
-                            yield f"data: {json.dumps({'content': content})}\n\n"
-                        if chunk.choices[0].delta.reasoning_content:
-                            content = chunk.choices[0].delta.reasoning_content
-                            total_content_length += len(content)
-                            full_reasoning += content
-                            yield f"data: {json.dumps({'reasoning_content': content})}\n\n"
+                            yield sse_event({'content': content})
+                        if reasoning:
+                            total_content_length += len(reasoning)
+                            full_reasoning += reasoning
+                            yield sse_event({'reasoning_content': reasoning})
 
                     # 保存助手消息
-                    assistant_message = ChatMessage.objects.create(
+                    end_time = time.time()
+                    usage = resolve_usage(usage, messages, full_response, full_reasoning)
+                    accounting = assistant_accounting(
+                        router.model, usage, end_time - api_start,
+                        first_chunk_time - api_start if first_chunk_time else None,
+                        prep.timings
+                    )
+                    router.annotate(accounting['api_response'])
+                    if cache_key and full_response:
+                        accounting['api_response']['response_cache'] = 'miss'
+                        get_response_cache().store(cache_key, user_message, retrieval.query_embedding, full_response)
+                    ChatMessage.objects.create(
                         conversation=conversation,
                         role='assistant',
                         content=full_response,
                         reasoning=full_reasoning,
-                        tokens=len(full_response) // 2,
-                        model_used=application.model
+                        model_used=router.model,
+                        temperature=0.7,
+                        max_tokens=max_tokens,
+                        retrieval_mode=prep.retrieval.mode,
+                        **accounting
                     )
 
-                    # 更新对话统计
-                    conversation.update_stats()
+                    # 后台更新会话摘要，不阻塞当前响应
+                    schedule_summary(application, conversation)
 
-                    # 记录结束时间和统计信息
-                    end_time = time.time()
+                    # 记录统计信息
                     print(f"\n[bold green]执行完成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}[/]")
                     print(f"[bold cyan]性能统计:[/]")
                     print(f"[dim]总执行时间: {round(end_time - start_time, 3)} 秒[/]")
                     print(f"[dim]API请求总耗时: {round(end_time - api_start, 3)} 秒[/]")
                     print(f"[dim]总响应块数: {total_chunks}[/]")
                     print(f"[dim]总内容长度: {total_content_length} 字符[/]")
+                    print(f"[dim]token用量: {usage}[/]")
                     if total_chunks > 0:
                         print(f"[dim]平均每块耗时: {round((end_time - first_chunk_time) / total_chunks, 3)} 秒[/]")
-                        print(f"[dim]平均每字符耗时: {round((end_time - first_chunk_time) / total_content_length, 3)} 秒[/]")
+                        print(f"[dim]平均每字符耗时: {round((end_time - first_chunk_time) / max(total_content_length, 1), 3)} 秒[/]")
 
-                    yield "data: [DONE]\n\n"
+                    yield SSE_DONE
 
                 except Exception as e:
                     print(f"\n流式处理出错: {str(e)}")
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                    yield sse_event({'error': str(e)})
+                finally:
+                    # 出错时没有调用模型，同样释放额度
+                    if permit is not None:
+                        permit.release()
 
             response = StreamingHttpResponse(
-                event_stream(),
+                PermitReleasingStream(event_stream(), permit),
                 content_type='text/event-stream'
             )
             response['Cache-Control'] = 'no-cache'
@@ -995,6 +937,19 @@ class MessageStreamView(View):
             )
 
 
+class ResponseCacheStatsView(APIView):
+    """各应用回答缓存的命中率（仅管理员，使用后台登录的会话）"""
+    authentication_classes = [SessionAuthentication]
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        try:
+            days = max(int(request.query_params.get('days', 7)), 1)
+        except ValueError:
+            return Response({"error": "days 必须是整数"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'days': days, 'applications': response_cache_stats(days)})
+
+
 class DesignView(TemplateView):
     """设计页面视图"""
     template_name = 'chat/design.html'
@@ -163,42 +163,44 @@ class KnowledgeBase:
         cursor.execute("SELECT id, text, embedding FROM knowledge")
         results = []
         
+        rows = cursor.fetchall()
+
         similarity_start = time.time()
-        for row in cursor.fetchall():
-            try:
-                # 从字节数据重建numpy数组
-                vec = np.frombuffer(row[2], dtype=np.float32)
-                
-                # 确保向量维度匹配
-                if vec.shape != query_embedding.shape:
-                    console.print(f"[red]警告：向量维度不匹配 - 查询: {query_embedding.shape}, 知识: {vec.shape}[/]")
-                    continue
-                    
-                # 计算余弦相似度
-                dot_product = np.dot(query_embedding, vec)
-                norm_query = np.linalg.norm(query_embedding)
-                norm_vec = np.linalg.norm(vec)
-                
-                # 避免除以零
-                if norm_query == 0 or norm_vec == 0:
-                    similarity = 0.0
-                else:
-                    similarity = dot_product / (norm_query * norm_vec)
-                
-                console.print(f"[dim]ID {row[0]} 相似度: {similarity:.4f}[/]")
-                
-                if not np.isnan(similarity):
-                    results.append((row[0], row[1], similarity))
-            except Exception as e:
-                console.print(f"[red]警告：处理向量时出错 - {str(e)}[/]")
+        # 过滤维度不匹配的向量后拼成一个矩阵，一次矩阵向量乘法得到全部相似度
+        valid_rows = []
+        vectors = []
+        for row in rows:
+            vec = np.frombuffer(row[2], dtype=np.float32)
+            if vec.shape != query_embedding.shape:
+                console.print(f"[red]警告：向量维度不匹配 - 查询: {query_embedding.shape}, 知识: {vec.shape}[/]")
                 continue
-        
+            valid_rows.append(row)
+            vectors.append(vec)
+
+        if vectors:
+            matrix = np.vstack(vectors)
+            norms = np.linalg.norm(matrix, axis=1)
+            norm_query = np.linalg.norm(query_embedding)
+            # 避免除以零
+            denominators = norms * norm_query
+            similarities = np.divide(
+                matrix @ query_embedding, denominators,
+                out=np.zeros(len(valid_rows), dtype=np.float32), where=denominators != 0
+            )
+            # 只取前top_k条：argpartition选出候选后再对这几条排序，避免全量排序
+            similarities = np.nan_to_num(similarities, nan=-np.inf)
+            count = min(top_k, len(similarities))
+            top_rows = np.argpartition(-similarities, count - 1)[:count]
+            top_rows = top_rows[np.argsort(-similarities[top_rows], kind='stable')]
+            for position in top_rows:
+                row, similarity = valid_rows[position], similarities[position]
+                if np.isfinite(similarity):
+                    console.print(f"[dim]ID {row[0]} 相似度: {similarity:.4f}[/]")
+                    results.append((row[0], row[1], float(similarity)))
+
         log_time("相似度计算耗时", similarity_start)
         log_time("数据库查询耗时", db_start)
         
-        # 按相似度排序
-        results.sort(key=lambda x: x[2], reverse=True)
-        
         # 如果没有找到任何结果，返回所有知识
         if not results:
             console.print("[yellow]没有找到相似度大于0的结果，返回所有知识[/]")
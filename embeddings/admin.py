@@ -1,12 +1,15 @@
 from django.contrib import admin
 
 # Register your models here.
-from django.contrib import admin
-from .models import EmbeddingModel, Knowledge
+from django.contrib import admin, messages
+from django.shortcuts import redirect, render
+from django.urls import reverse
+from .importer import detect_format, fail_stale_import_jobs, reembed_knowledge, start_import_job
+from .models import EmbeddingModel, Knowledge, KnowledgeImport
 
 @admin.register(EmbeddingModel)
 class EmbeddingModelAdmin(admin.ModelAdmin):
-    list_display = ('name', 'model_name', 'api_url', 'dimension', 'is_active', 'created_at')
+    list_display = ('name', 'model_name', 'api_url', 'dimension', 'vector_precision', 'is_active', 'created_at')
     list_filter = ('is_active', 'created_at')
     search_fields = ('name', 'model_name', 'description')
     readonly_fields = ('created_at', 'updated_at')
@@ -15,16 +18,50 @@ class EmbeddingModelAdmin(admin.ModelAdmin):
             'fields': ('name', 'model_name', 'description')
         }),
         ('API配置', {
-            'fields': ('api_key', 'dimension', 'api_url', 'encoding_format')
+            'fields': ('api_key', 'dimension', 'api_url', 'encoding_format', 'vector_precision')
         }),
         ('状态信息', {
             'fields': ('is_active', 'created_at', 'updated_at')
         }),
     )
+    actions = ['import_knowledge_file']
+
+    @admin.action(description='从CSV/JSONL文件导入知识')
+    def import_knowledge_file(self, request, queryset):
+        """上传问答文件，保存为导入任务后在后台批量生成向量并导入到所选向量模型"""
+        if queryset.count() != 1:
+            self.message_user(request, '请只选择一个向量模型', messages.ERROR)
+            return None
+
+        embedding_model = queryset.get()
+        upload = request.FILES.get('knowledge_file')
+        if 'apply' in request.POST and upload:
+            try:
+                job = KnowledgeImport.objects.create(
+                    model=embedding_model,
+                    file=upload,
+                    file_format=detect_format(upload.name),
+                    batch_size=int(request.POST.get('batch_size') or 64),
+                    concurrency=int(request.POST.get('concurrency') or 4),
+                )
+            except Exception as e:
+                self.message_user(request, f'导入失败: {str(e)}', messages.ERROR)
+                return None
+            start_import_job(job)
+            self.message_user(request, f'{embedding_model.name}: 已在后台开始导入，进度见知识导入列表', messages.SUCCESS)
+            return redirect(reverse('admin:embeddings_knowledgeimport_changelist'))
+
+        return render(request, 'admin/embeddings/import_knowledge.html', {
+            **self.admin_site.each_context(request),
+            'title': '导入知识',
+            'opts': self.model._meta,
+            'embedding_model': embedding_model,
+            'action_checkbox_name': admin.helpers.ACTION_CHECKBOX_NAME,
+        })
 
 @admin.register(Knowledge)
 class KnowledgeAdmin(admin.ModelAdmin):
-    list_display = ('id', 'question', 'answer_preview', 'model', 'is_valid', 'created_at')
+    list_display = ('id', 'question', 'answer_preview', 'model', 'is_valid', 'has_embedding', 'created_at')
     list_filter = ('model', 'is_valid', 'created_at')
     search_fields = ('question', 'answer')
     readonly_fields = ('created_at', 'updated_at')
@@ -36,8 +73,43 @@ class KnowledgeAdmin(admin.ModelAdmin):
             'fields': ('is_valid', 'created_at', 'updated_at')
         }),
     )
+    actions = ['regenerate_embeddings']
+
+    @admin.action(description='重新生成问题向量')
+    def regenerate_embeddings(self, request, queryset):
+        """按向量模型分组，批量并发重新生成所选知识的问题向量"""
+        for embedding_model in EmbeddingModel.objects.filter(knowledge__in=queryset).distinct():
+            result = reembed_knowledge(embedding_model, queryset)
+            level = messages.WARNING if result.failed_batches else messages.SUCCESS
+            self.message_user(request, f'{embedding_model.name}: {result}', level)
 
     def answer_preview(self, obj):
         """显示答案预览"""
         return obj.answer[:100] + '...' if len(obj.answer) > 100 else obj.answer
-    answer_preview.short_description = '答案预览'
\ No newline at end of file
+    answer_preview.short_description = '答案预览'
+
+    def has_embedding(self, obj):
+        """是否已生成问题向量"""
+        return obj.embedding is not None
+    has_embedding.short_description = '已生成向量'
+    has_embedding.boolean = True
+
+
+@admin.register(KnowledgeImport)
+class KnowledgeImportAdmin(admin.ModelAdmin):
+    """知识导入任务及进度（在向量模型列表中通过"从CSV/JSONL文件导入知识"创建）"""
+    list_display = ('id', 'model', 'file', 'status', 'created', 'embedded', 'skipped', 'failed_batches', 'updated_at')
+    list_filter = ('status', 'model')
+    readonly_fields = (
+        'model', 'file', 'file_format', 'batch_size', 'concurrency', 'status', 'created', 'embedded',
+        'skipped', 'failed_batches', 'message', 'created_at', 'updated_at'
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        stale = fail_stale_import_jobs()
+        if stale:
+            self.message_user(request, f'{stale} 个导入任务所在进程已退出，已标记为失败', messages.WARNING)
+        return super().changelist_view(request, extra_context)
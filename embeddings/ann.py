@@ -0,0 +1,182 @@
+"""知识向量的近似最近邻索引（IVF，倒排文件）
+
+用球面 k-means 把归一化后的知识向量划分为 nlist 个簇，检索时只计算与查询最接近的
+NPROBE 个簇内的向量，计算量约为精确检索的 NPROBE / nlist。
+索引（簇中心、按簇排列的知识ID、各簇偏移）与知识向量一样通过 GenerationStore 写入
+<KNOWLEDGE_VECTOR_STORE['DIRECTORY']>/<向量模型ID>/ann/，由各 worker 只读映射共享，只需一个进程构建。
+
+知识增删后，未进入索引的新知识在检索时单独精确计算，已删除的知识被过滤；
+变化比例超过 REBUILD_RATIO 时重建：知识总数与训练时相差不到一倍时沿用原簇中心，
+只重新分配向量（相当于一轮 k-means），否则重新训练。
+配置见 settings.KNOWLEDGE_ANN::
+
+    KNOWLEDGE_ANN = {
+        'ENABLED': True,
+        'MIN_SIZE': 20000,       # 知识条数少于该值时直接精确检索
+        'NPROBE': 16,            # 每次检索计算的簇数
+        'REBUILD_RATIO': 0.1,    # 未索引的新增与已删除知识占比超过该值时重建
+    }
+"""
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ANN_CONFIG = {
+    'ENABLED': True,
+    'MIN_SIZE': 20000,
+    'NPROBE': 16,
+    'REBUILD_RATIO': 0.1,
+}
+
+KMEANS_ITERATIONS = 10
+# 每个簇用于训练的样本数
+SAMPLES_PER_LIST = 64
+ASSIGN_BATCH_SIZE = 4096
+
+
+def ann_config() -> dict:
+    return {**DEFAULT_ANN_CONFIG, **getattr(settings, 'KNOWLEDGE_ANN', {})}
+
+
+def list_count(size: int) -> int:
+    """簇数取知识条数的平方根"""
+    return int(np.clip(np.sqrt(size), 8, 4096))
+
+
+def assign(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """把每个向量分配到内积最大的簇中心，分批计算以限制临时内存"""
+    labels = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), ASSIGN_BATCH_SIZE):
+        batch = np.asarray(matrix[start:start + ASSIGN_BATCH_SIZE], dtype=np.float32)
+        labels[start:start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return labels
+
+
+def train_centroids(matrix: np.ndarray, nlist: int, seed: int = 0) -> np.ndarray:
+    """在抽样向量上训练球面 k-means，返回归一化的簇中心"""
+    from .index import normalize
+
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(matrix), nlist * SAMPLES_PER_LIST)
+    sample = np.asarray(matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        labels = assign(sample, centroids)
+        counts = np.bincount(labels, minlength=nlist)
+        empty = counts == 0
+        # 按簇排序后分段求和，比 np.add.at 快得多
+        order = np.argsort(labels, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        sums[~empty] = np.add.reduceat(sample[order], starts[~empty], axis=0)
+        # 空簇重新取随机样本作为中心
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+
+def build_ivf(ids: np.ndarray, matrix: np.ndarray, synced_until: int,
+              previous: Optional['IVFIndex'] = None) -> Dict[str, np.ndarray]:
+    """构建IVF索引数组；规模与上次训练时相近则沿用簇中心
+
+    synced_until 为矩阵对应的知识最后更新时间（Unix 微秒），之后更新的向量不在索引中。
+    """
+    size = len(ids)
+    if (previous is not None and previous.dimension == matrix.shape[1]
+            and previous.trained_size / 2 <= size <= previous.trained_size * 2):
+        centroids = np.asarray(previous.centroids)
+        trained_size = previous.trained_size
+    else:
+        centroids = train_centroids(matrix, list_count(size))
+        trained_size = size
+    labels = assign(matrix, centroids)
+    order = np.argsort(labels, kind='stable')
+    offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=len(centroids)), out=offsets[1:])
+    return {
+        'centroids': centroids.astype(np.float32),
+        'list_ids': np.asarray(ids, dtype=np.int64)[order],
+        'offsets': offsets,
+        'trained_size': np.array([trained_size], dtype=np.int64),
+        'synced_until': np.array([synced_until], dtype=np.int64),
+    }
+
+
+@dataclass
+class IVFIndex:
+    generation: int
+    centroids: np.ndarray
+    list_ids: np.ndarray
+    offsets: np.ndarray
+    trained_size: int
+    synced_until: int
+
+    @classmethod
+    def from_arrays(cls, generation: int, arrays: Dict[str, np.ndarray]) -> 'IVFIndex':
+        return cls(
+            generation=generation,
+            centroids=arrays['centroids'],
+            list_ids=arrays['list_ids'],
+            offsets=arrays['offsets'],
+            trained_size=int(arrays['trained_size'][0]),
+            synced_until=int(arrays['synced_until'][0]),
+        )
+
+    @property
+    def dimension(self) -> int:
+        return self.centroids.shape[1]
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """与查询最接近的 nprobe 个簇内的全部知识ID"""
+        nprobe = min(nprobe, len(self.centroids))
+        scores = self.centroids @ query
+        probes = np.argpartition(-scores, nprobe - 1)[:nprobe]
+        return np.concatenate([
+            self.list_ids[self.offsets[probe]:self.offsets[probe + 1]] for probe in probes
+        ])
+
+
+@dataclass
+class AnnMapping:
+    """IVF索引与某一版本内存矩阵之间的行号映射"""
+    ann: IVFIndex
+    ids: np.ndarray            # 对应的 KnowledgeIndex.ids（用于判断是否仍是同一版本）
+    sorted_ids: np.ndarray
+    sorted_rows: np.ndarray
+    delta_rows: np.ndarray     # 不在IVF索引中的行（新增知识），检索时精确计算
+    removed: int               # IVF索引中已不存在的知识数
+
+    @classmethod
+    def build(cls, ann: IVFIndex, ids: np.ndarray, updated_ids: Optional[np.ndarray] = None) -> 'AnnMapping':
+        """updated_ids 为索引构建后更新过的知识ID，其向量可能已变化，按新增处理"""
+        in_ann = np.isin(ids, ann.list_ids)
+        indexed = in_ann
+        if updated_ids is not None and len(updated_ids):
+            indexed = in_ann & ~np.isin(ids, updated_ids)
+        rows = np.flatnonzero(indexed)
+        order = rows[np.argsort(ids[rows], kind='stable')]
+        return cls(
+            ann=ann,
+            ids=ids,
+            sorted_ids=ids[order],
+            sorted_rows=order,
+            delta_rows=np.flatnonzero(~indexed),
+            removed=len(ann.list_ids) - int(in_ann.sum()),
+        )
+
+    @property
+    def stale_ratio(self) -> float:
+        return (len(self.delta_rows) + self.removed) / max(len(self.ids), 1)
+
+    def candidate_rows(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        candidates = self.ann.candidates(query, nprobe)
+        if len(self.sorted_ids) == 0:
+            return self.delta_rows
+        positions = np.minimum(np.searchsorted(self.sorted_ids, candidates), len(self.sorted_ids) - 1)
+        found = self.sorted_ids[positions] == candidates
+        return np.concatenate([self.sorted_rows[positions[found]], self.delta_rows])
@@ -0,0 +1,117 @@
+"""向量接口熔断
+
+向量模型的接口连续多次出错或超出应用的检索时间预算后，在冷却期内不再调用，
+对话直接改用关键词检索；冷却期结束后放行一次试探调用，成功则恢复，失败则重新计时。
+只统计真正发出的接口调用：命中查询向量缓存的请求不经过熔断器，熔断中也照常命中缓存。
+状态保存在进程内，各 worker 分别统计。配置见 settings.EMBEDDING_CIRCUIT_BREAKER::
+
+    EMBEDDING_CIRCUIT_BREAKER = {
+        'FAILURE_THRESHOLD': 3,   # 连续失败（出错或超时）次数达到该值时熔断
+        'COOL_DOWN': 30,          # 熔断持续时间（秒）
+    }
+"""
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, Dict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BREAKER_CONFIG = {
+    'FAILURE_THRESHOLD': 3,
+    'COOL_DOWN': 30,
+}
+
+
+def breaker_config() -> dict:
+    return {**DEFAULT_BREAKER_CONFIG, **getattr(settings, 'EMBEDDING_CIRCUIT_BREAKER', {})}
+
+
+class CircuitOpenError(Exception):
+    """熔断中，未调用向量接口"""
+
+
+class CircuitBreaker:
+    """连续失败计数熔断器"""
+
+    def __init__(self, name: str, failure_threshold: int = 3, cool_down: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cool_down = cool_down
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        """是否可以调用；熔断中且冷却期已过时只放行一次试探调用"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._probing or time.time() - self.opened_at < self.cool_down:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f"向量接口恢复，结束熔断: {self.name}")
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+                logger.warning(f"向量接口连续 {self.failures} 次失败，熔断 {self.cool_down} 秒: {self.name}")
+                self.opened_at = time.time()
+            self._probing = False
+
+    def call(self, func: Callable):
+        """在熔断保护下调用 func：熔断中抛出 CircuitOpenError，出错（含超时）计为一次失败"""
+        if not self.allow():
+            raise CircuitOpenError(f"向量接口熔断中: {self.name}")
+        try:
+            result = func()
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    async def acall(self, func: Callable):
+        """call 的异步版本，func 为协程函数；超出时间预算被取消也计为一次失败"""
+        if not self.allow():
+            raise CircuitOpenError(f"向量接口熔断中: {self.name}")
+        try:
+            result = await func()
+        except (Exception, asyncio.CancelledError):
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+_breakers: Dict[int, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(embedding_model) -> CircuitBreaker:
+    """该向量模型的熔断器（进程内按向量模型ID复用）"""
+    breaker = _breakers.get(embedding_model.pk)
+    if breaker is None:
+        with _breakers_lock:
+            config = breaker_config()
+            breaker = _breakers.setdefault(embedding_model.pk, CircuitBreaker(
+                embedding_model.name, config['FAILURE_THRESHOLD'], config['COOL_DOWN']
+            ))
+    return breaker
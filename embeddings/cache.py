@@ -0,0 +1,276 @@
+"""查询向量缓存
+
+以 (向量接口地址, 向量模型标识, 维度, 规范化后的查询文本) 为键缓存查询向量，支持 LRU + TTL。
+后端可在 settings.EMBEDDING_QUERY_CACHE 中配置::
+
+    EMBEDDING_QUERY_CACHE = {
+        'BACKEND': 'locmem',   # locmem / django / sqlite，或后端类的完整路径
+        'MAX_SIZE': 10000,     # 最大条数（locmem、sqlite）
+        'TTL': 86400,          # 过期时间（秒）
+        'CACHE_ALIAS': 'default',  # django 后端使用的缓存别名
+        'PATH': BASE_DIR / 'embedding_cache.sqlite3',  # sqlite 后端文件路径
+    }
+
+locmem 只在当前进程内有效；django 与 sqlite 后端可在多个 worker 之间共享。
+"""
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL = 24 * 60 * 60
+
+_whitespace_re = re.compile(r'\s+')
+
+
+def normalize_query(text: str) -> str:
+    """规范化查询文本：全半角统一、去除首尾及重复空白、小写"""
+    text = unicodedata.normalize('NFKC', text or '')
+    return _whitespace_re.sub(' ', text).strip().lower()
+
+
+def make_key(api_url: str, model_name: str, dimension: int, text: str) -> str:
+    # 不同接口地址下同名模型的向量不通用（如自建服务与云端服务）
+    raw = f"{api_url}\x00{model_name}\x00{dimension}\x00{normalize_query(text)}"
+    return 'qemb:' + hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class LocMemBackend:
+    """进程内 LRU + TTL 缓存"""
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL, **kwargs):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class DjangoCacheBackend:
+    """基于 Django 缓存框架，淘汰策略由所配置的缓存决定"""
+
+    def __init__(self, ttl=DEFAULT_TTL, cache_alias='default', **kwargs):
+        from django.core.cache import caches
+        self.ttl = ttl
+        self.cache = caches[cache_alias]
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.cache.get(key)
+
+    def set(self, key: str, value: bytes) -> None:
+        self.cache.set(key, value, self.ttl)
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+
+class SQLiteBackend:
+    """基于本地 SQLite 文件，同一主机上的多个 worker 共享"""
+
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL, table='query_embedding', **kwargs):
+        self.path = str(path or settings.BASE_DIR / 'embedding_cache.sqlite3')
+        self.max_size = max_size
+        self.ttl = ttl
+        # 同一文件中可按表名存放多个缓存（如重排结果），容量分别计算
+        self.table = table
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                " key TEXT PRIMARY KEY,"
+                " vector BLOB NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " used_at REAL NOT NULL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_used_at ON {self.table} (used_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute(
+            f"SELECT vector FROM {self.table} WHERE key = ? AND expires_at >= ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        with conn:
+            conn.execute(f"UPDATE {self.table} SET used_at = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def set(self, key: str, value: bytes) -> None:
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, vector, expires_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now)
+            )
+        with self._writes_lock:
+            self._writes += 1
+            evict = self._writes % 100 == 0
+        # 每写入一定次数清理一次过期与超出容量的条目
+        if evict:
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute(f"DELETE FROM {self.table} WHERE expires_at < ?", (now,))
+            conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f" SELECT key FROM {self.table} ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_size,)
+            )
+
+    def clear(self) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute(f"DELETE FROM {self.table}")
+
+
+BACKENDS = {
+    'locmem': LocMemBackend,
+    'django': DjangoCacheBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+def build_backend(config: dict, table: str = 'query_embedding'):
+    """按配置字典创建缓存后端，sqlite 后端可用 TABLE 指定表名"""
+    backend_name = config.get('BACKEND', 'locmem')
+    backend_class = BACKENDS.get(backend_name) or import_string(backend_name)
+    return backend_class(
+        path=config.get('PATH'),
+        max_size=config.get('MAX_SIZE', DEFAULT_MAX_SIZE),
+        ttl=config.get('TTL', DEFAULT_TTL),
+        cache_alias=config.get('CACHE_ALIAS', 'default'),
+        table=config.get('TABLE', table),
+    )
+
+
+class QueryEmbeddingCache:
+    """查询向量缓存，记录当前进程的命中与未命中次数"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def _count(self, hit: bool) -> None:
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _lookup(self, key: str) -> Optional[np.ndarray]:
+        try:
+            cached = self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"读取查询向量缓存失败: {str(e)}")
+            cached = None
+        self._count(cached is not None)
+        if cached is None:
+            return None
+        return np.frombuffer(cached, dtype=np.float32)
+
+    def _store(self, key: str, vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        try:
+            self.backend.set(key, vector.tobytes())
+        except Exception as e:
+            logger.warning(f"写入查询向量缓存失败: {str(e)}")
+        return vector
+
+    @staticmethod
+    def _key(embedding_model, text: str) -> str:
+        return make_key(embedding_model.api_url, embedding_model.model_name, embedding_model.dimension, text)
+
+    def get_or_compute(self, embedding_model, text: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        key = self._key(embedding_model, text)
+        vector = self._lookup(key)
+        if vector is None:
+            vector = self._store(key, compute())
+        return vector
+
+    async def aget_or_compute(self, embedding_model, text: str, compute) -> np.ndarray:
+        """get_or_compute 的异步版本，compute 为返回向量的协程函数
+
+        缓存后端（如 SQLite 文件）的读写会阻塞，放到线程中执行，不占用事件循环。
+        """
+        key = self._key(embedding_model, text)
+        vector = await asyncio.to_thread(self._lookup, key)
+        if vector is None:
+            vector = await asyncio.to_thread(self._store, key, await compute())
+        return vector
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / total, 4) if total else 0.0,
+        }
+
+
+_cache: Optional[QueryEmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> QueryEmbeddingCache:
+    """按 settings.EMBEDDING_QUERY_CACHE 创建进程级缓存实例"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = QueryEmbeddingCache(build_backend(getattr(settings, 'EMBEDDING_QUERY_CACHE', {})))
+    return _cache
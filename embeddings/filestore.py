@@ -0,0 +1,94 @@
+"""按代（generation）发布的只读数组文件
+
+一组 NumPy 数组以 .npy 文件写入 <目录>/gen-<代号>/，写完后整体 rename 到位，
+再原子替换 <目录>/CURRENT 指向新的代号。各进程读取 CURRENT 发现新代后以
+np.load(mmap_mode='r') 映射文件，同一主机上的多个 worker 共享操作系统页缓存中的同一份数据。
+旧代的文件在发布新代后删除；已映射它们的进程在切换前仍可继续读取（Linux 下删除不影响已打开的映射）。
+"""
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FILE = 'CURRENT'
+LOCK_FILE = 'LOCK'
+# 保留的历史代数，给仍在读取旧代的进程留出切换时间
+KEEP_GENERATIONS = 2
+
+
+class GenerationStore:
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def _generation_dir(self, generation: int) -> Path:
+        return self.directory / f'gen-{generation:08d}'
+
+    def current(self) -> Optional[int]:
+        """当前发布的代号，尚未发布时为None"""
+        try:
+            return int((self.directory / CURRENT_FILE).read_text().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def load(self, generation: int) -> Dict[str, np.ndarray]:
+        """以只读内存映射方式加载指定代的全部数组"""
+        path = self._generation_dir(generation)
+        return {
+            file.stem: np.load(file, mmap_mode='r')
+            for file in path.glob('*.npy')
+        }
+
+    def publish(self, arrays: Dict[str, np.ndarray]) -> int:
+        """写入一组数组作为新的一代并切换 CURRENT，返回新代号；调用方应持有 lock()"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        generation = (self.current() or 0) + 1
+        tmp_dir = Path(tempfile.mkdtemp(prefix='.tmp-', dir=self.directory))
+        try:
+            for name, array in arrays.items():
+                with open(tmp_dir / f'{name}.npy', 'wb') as f:
+                    np.save(f, np.ascontiguousarray(array))
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.rename(tmp_dir, self._generation_dir(generation))
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        tmp_current = self.directory / f'.{CURRENT_FILE}.tmp'
+        tmp_current.write_text(str(generation))
+        os.replace(tmp_current, self.directory / CURRENT_FILE)
+        self._cleanup(generation)
+        return generation
+
+    def _cleanup(self, generation: int) -> None:
+        for path in self.directory.glob('gen-*'):
+            try:
+                old = int(path.name[4:])
+            except ValueError:
+                continue
+            if old <= generation - KEEP_GENERATIONS:
+                shutil.rmtree(path, ignore_errors=True)
+
+    @contextmanager
+    def lock(self, blocking: bool = False):
+        """跨进程互斥（flock），非阻塞模式下未获得锁时返回False"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / LOCK_FILE, 'a') as f:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(f, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,282 @@
+"""知识批量导入
+
+流式读取 CSV / JSONL 问答文件，按批调用向量接口（多个批次并发、失败重试），
+再批量写入 Knowledge 及其问题向量。数据库写入只在调用线程中进行。
+后台管理上传的文件作为 KnowledgeImport 任务在后台线程中导入，进度写回任务记录；
+导入期间定时刷新任务的更新时间，进程退出（如 worker 重启）后任务不再刷新，查看任务列表时标记为失败。
+"""
+import csv
+import io
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import timedelta
+from itertools import islice
+from typing import Iterable, Iterator, List, Tuple
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import EmbeddingModel, Knowledge, KnowledgeImport
+from .services import embed_texts
+
+logger = logging.getLogger(__name__)
+
+# 导入任务刷新更新时间的间隔（秒），超过 JOB_STALE_AFTER 未刷新的任务视为已中断
+JOB_HEARTBEAT_INTERVAL = 30
+JOB_STALE_AFTER = timedelta(seconds=JOB_HEARTBEAT_INTERVAL * 4)
+
+QUESTION_KEYS = ('question', '问题')
+ANSWER_KEYS = ('answer', '答案')
+
+
+@dataclass
+class ImportResult:
+    """导入结果统计"""
+    created: int = 0
+    embedded: int = 0
+    skipped: int = 0
+    failed_batches: int = 0
+    errors: List[str] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    def __str__(self):
+        return (
+            f"新增 {self.created} 条（已生成向量 {self.embedded} 条），跳过 {self.skipped} 条，"
+            f"向量生成失败 {self.failed_batches} 批，耗时 {self.elapsed:.1f} 秒"
+        )
+
+
+def _pick(record: dict, keys) -> str:
+    for key in keys:
+        value = record.get(key)
+        if value:
+            return str(value).strip()
+    return ''
+
+
+def iter_records(stream: Iterable[str], file_format: str) -> Iterator[Tuple[str, str]]:
+    """逐行解析文本流，产出 (问题, 答案)，缺少问题或答案的行会被跳过"""
+    if file_format == 'csv':
+        rows = csv.DictReader(stream)
+    elif file_format == 'jsonl':
+        rows = (json.loads(line) for line in stream if line.strip())
+    else:
+        raise ValueError(f"不支持的文件格式: {file_format}")
+    for row in rows:
+        question, answer = _pick(row, QUESTION_KEYS), _pick(row, ANSWER_KEYS)
+        if question and answer:
+            yield question[:500], answer
+
+
+def detect_format(filename: str) -> str:
+    """根据扩展名判断文件格式"""
+    name = filename.lower()
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    raise ValueError(f"无法识别文件格式: {filename}（支持 .csv / .jsonl）")
+
+
+def open_text(binary_file) -> io.TextIOWrapper:
+    """把上传文件等二进制流包装为逐行读取的文本流（兼容带BOM的UTF-8）"""
+    return io.TextIOWrapper(binary_file, encoding='utf-8-sig', newline='')
+
+
+def embed_with_retry(embedding_model: EmbeddingModel, texts: List[str],
+                     max_retries: int = 5, backoff: float = 1.0):
+    """调用向量接口，失败时按指数退避（带抖动）重试"""
+    for attempt in range(max_retries + 1):
+        try:
+            return embed_texts(embedding_model, texts)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff * (2 ** attempt) * (0.5 + random.random())
+            logger.warning(f"向量接口调用失败，{delay:.1f}秒后第{attempt + 1}次重试: {str(e)}")
+            time.sleep(delay)
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _embed_batches(embedding_model: EmbeddingModel, batches, texts_of, handle,
+                   concurrency: int, max_retries: int, result: ImportResult) -> None:
+    """并发为各批次生成向量，最多 concurrency 个批次同时在途；
+    handle(batch, vectors) 在调用线程中执行，失败批次的 vectors 为 None"""
+    pending = {}
+
+    def collect(done):
+        for future in done:
+            batch = pending.pop(future)
+            try:
+                vectors = future.result()
+            except Exception as e:
+                result.failed_batches += 1
+                result.errors.append(str(e))
+                logger.error(f"一批 {len(batch)} 条知识向量生成失败: {str(e)}")
+                vectors = None
+            handle(batch, vectors)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch in batches:
+            if len(pending) >= concurrency:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(
+                embed_with_retry, embedding_model, [texts_of(item) for item in batch], max_retries
+            )
+            pending[future] = batch
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+
+
+def import_knowledge(embedding_model: EmbeddingModel, records: Iterable[Tuple[str, str]],
+                     batch_size: int = 64, concurrency: int = 4, max_retries: int = 5,
+                     skip_existing: bool = True, progress=None) -> ImportResult:
+    """批量导入问答，返回导入结果
+
+    同时在途的批次不超过 concurrency 个，读取文件与写库都不会一次性占用全部内存。
+    向量生成最终失败的批次仍会写入（不带向量），检索时会自动补齐。
+    """
+    result = ImportResult()
+    start = time.time()
+    existing = set()
+    if skip_existing:
+        existing = set(Knowledge.objects.filter(model=embedding_model).values_list('question', flat=True))
+
+    def unique_records():
+        for question, answer in records:
+            if question in existing:
+                result.skipped += 1
+                continue
+            existing.add(question)
+            yield question, answer
+
+    def save(batch, vectors):
+        items = [Knowledge(question=q, answer=a, model=embedding_model) for q, a in batch]
+        if vectors is not None:
+            for item, vector in zip(items, vectors):
+                item.set_embedding(vector)
+            result.embedded += len(items)
+        # bulk_create不触发post_save信号，不会再逐条调用向量接口
+        Knowledge.objects.bulk_create(items)
+        result.created += len(items)
+        if progress:
+            progress(result)
+
+    _embed_batches(
+        embedding_model, _chunks(unique_records(), batch_size), lambda record: record[0],
+        save, concurrency, max_retries, result
+    )
+
+    result.elapsed = time.time() - start
+    logger.info(f"知识导入完成 (向量模型: {embedding_model.name}): {result}")
+    return result
+
+
+def reembed_knowledge(embedding_model: EmbeddingModel, queryset, batch_size: int = 64,
+                      concurrency: int = 4, max_retries: int = 5) -> ImportResult:
+    """并发批量重新生成已有知识的问题向量"""
+    result = ImportResult()
+    start = time.time()
+    # 先整体取出，避免在同一SQLite连接上边读游标边写
+    items = list(queryset.filter(model=embedding_model).only('id', 'question'))
+
+    def save(batch, vectors):
+        if vectors is None:
+            return
+        now = timezone.now()
+        for item, vector in zip(batch, vectors):
+            item.set_embedding(vector)
+            item.updated_at = now
+        Knowledge.objects.bulk_update(batch, ['embedding', 'updated_at'])
+        result.embedded += len(batch)
+
+    _embed_batches(
+        embedding_model, _chunks(items, batch_size), lambda item: item.question,
+        save, concurrency, max_retries, result
+    )
+
+    result.elapsed = time.time() - start
+    return result
+
+
+def run_import_job(job_id: int) -> ImportResult:
+    """执行一个导入任务，每写入一批更新一次任务进度"""
+    job = KnowledgeImport.objects.select_related('model').get(pk=job_id)
+    jobs = KnowledgeImport.objects.filter(pk=job_id)
+    jobs.update(status='running', updated_at=timezone.now())
+
+    def progress(result):
+        # update() 不会自动刷新 auto_now 字段
+        jobs.update(
+            created=result.created, embedded=result.embedded, skipped=result.skipped,
+            failed_batches=result.failed_batches, updated_at=timezone.now()
+        )
+
+    stopped = threading.Event()
+
+    def heartbeat():
+        # 一批向量生成（含重试）可能远长于刷新间隔，单独刷新以免被误判为中断
+        try:
+            while not stopped.wait(JOB_HEARTBEAT_INTERVAL):
+                jobs.filter(status='running').update(updated_at=timezone.now())
+        finally:
+            close_old_connections()
+
+    threading.Thread(target=heartbeat, name=f'knowledge-import-{job_id}-heartbeat', daemon=True).start()
+    try:
+        with job.file.open('rb') as f:
+            result = import_knowledge(
+                job.model,
+                iter_records(open_text(f), job.file_format),
+                batch_size=job.batch_size,
+                concurrency=job.concurrency,
+                progress=progress,
+            )
+    except Exception as e:
+        logger.error(f"知识导入任务 {job_id} 失败: {str(e)}")
+        jobs.update(status='failed', message=str(e), updated_at=timezone.now())
+        raise
+    finally:
+        stopped.set()
+    progress(result)
+    jobs.update(status='done', message=str(result), updated_at=timezone.now())
+    return result
+
+
+def start_import_job(job: KnowledgeImport) -> None:
+    """在后台线程中执行导入任务，立即返回"""
+    def run():
+        try:
+            run_import_job(job.pk)
+        except Exception:
+            pass  # 已记录在任务中
+        finally:
+            close_old_connections()
+
+    threading.Thread(target=run, name=f'knowledge-import-{job.pk}', daemon=True).start()
+
+
+def fail_stale_import_jobs() -> int:
+    """把超过 JOB_STALE_AFTER 没有刷新的等待中/导入中任务标记为失败（所在进程已退出），返回条数"""
+    return KnowledgeImport.objects.filter(
+        status__in=['pending', 'running'], updated_at__lt=timezone.now() - JOB_STALE_AFTER
+    ).update(
+        status='failed',
+        message='导入进程已退出（如服务重启），任务中断。已写入的知识会保留，重新上传文件即可继续（已存在的问题会被跳过）',
+        updated_at=timezone.now()
+    )
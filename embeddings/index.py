@@ -0,0 +1,434 @@
+"""按向量模型划分的知识向量索引
+
+每个向量模型的知识向量（已归一化的 float32 矩阵）、知识ID与答案以 .npy 文件保存在
+<DIRECTORY>/<向量模型ID>/vectors/，通过 GenerationStore 按代发布，各进程（uWSGI worker）
+只读内存映射同一组文件，操作系统页缓存中只保留一份向量数据。
+
+向量模型配置了量化存储（vector_precision）时同时写出量化矩阵，检索先扫描量化矩阵再按原始精度重排，
+见 quantization.py。
+
+各进程检索前通过 (知识条数, 最后更新时间) 指纹发现数据库中的变化：其他进程已发布包含该变化的
+新一代时直接切换映射；否则由取得文件锁的进程增量拉取变动的知识，写出新一代文件后原子切换，
+其余进程在此期间继续使用当前一代。
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+
+from .ann import AnnMapping, IVFIndex, ann_config, build_ivf
+from .filestore import GenerationStore
+from .models import Knowledge
+from .quantization import approximate_scores, precision_of, quantize
+
+logger = logging.getLogger(__name__)
+
+# 增量同步时回看的时间窗口，覆盖并发写入时 updated_at 与提交时间的偏差
+SYNC_LOOKBACK = timedelta(seconds=1)
+# 新增知识过多（如批量导入）时直接全量重建，避免超长的 IN 查询
+FULL_RELOAD_THRESHOLD = 500
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+DEFAULT_STORE_CONFIG = {
+    'BACKEND': 'memory',
+    'DIRECTORY': None,
+    # 量化存储时按原始精度重排的候选数为 top_k 的倍数
+    'RESCORE_FACTOR': 4,
+    'DATABASE': 'vectors',
+    'INDEX_TYPE': 'hnsw',
+    'HNSW_M': 16,
+    'HNSW_EF_CONSTRUCTION': 64,
+    'HNSW_EF_SEARCH': 40,
+    'IVFFLAT_LISTS': 100,
+    'IVFFLAT_PROBES': 10,
+}
+
+
+def store_config() -> dict:
+    config = {**DEFAULT_STORE_CONFIG, **getattr(settings, 'KNOWLEDGE_VECTOR_STORE', {})}
+    if not config['DIRECTORY']:
+        config['DIRECTORY'] = os.path.join(settings.MEDIA_ROOT, 'knowledge_index')
+    return config
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """按行做L2归一化，零向量保持为零"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def to_micros(value: Optional[datetime]) -> int:
+    return -1 if value is None else (value - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(value: int) -> Optional[datetime]:
+    return None if value < 0 else EPOCH + timedelta(microseconds=int(value))
+
+
+class AnswerTable:
+    """UTF-8 编码后首尾相接的答案文本，按行号取出；可直接使用内存映射的数组"""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def pack(cls, answers: Sequence[str]) -> Dict[str, np.ndarray]:
+        encoded = [answer.encode('utf-8') for answer in answers]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(item) for item in encoded], out=offsets[1:])
+        return {
+            'answers': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            'answer_offsets': offsets,
+        }
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row: int) -> str:
+        return bytes(self.blob[self.offsets[row]:self.offsets[row + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        return (self[row] for row in range(len(self)))
+
+
+class KnowledgeIndex:
+    """单个向量模型的知识向量矩阵（已归一化、连续float32，内存映射自共享文件）"""
+
+    def __init__(self, embedding_model_id: int, directory: Optional[str] = None, precision: str = 'float32'):
+        self.embedding_model_id = embedding_model_id
+        # 向量模型要求的存储精度；当前一代的量化矩阵与之不符时重新发布
+        self.precision = precision
+        directory = directory or os.path.join(store_config()['DIRECTORY'], str(embedding_model_id))
+        self.store = GenerationStore(os.path.join(directory, 'vectors'))
+        self.generation: Optional[int] = None
+        self.dimension = 0
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.answers = AnswerTable(np.empty(0, dtype=np.uint8), np.zeros(1, dtype=np.int64))
+        self.quantized: Optional[np.ndarray] = None
+        self.scales: Optional[np.ndarray] = None
+        self._fingerprint: Optional[Tuple[int, object]] = None
+        self._lock = threading.Lock()
+        self.ann_store = GenerationStore(os.path.join(directory, 'ann'))
+        self._ann_mapping: Optional[AnnMapping] = None
+        self._ann_building = False
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _queryset(self):
+        return Knowledge.objects.filter(model_id=self.embedding_model_id)
+
+    def _current_fingerprint(self):
+        stats = self._queryset().aggregate(count=Count('id'), last_updated=Max('updated_at'))
+        return stats['count'], stats['last_updated']
+
+    def sync(self) -> None:
+        """与数据库同步：优先切换到其他进程已发布的新一代，仍落后时自行发布"""
+        fingerprint = self._current_fingerprint()
+        if fingerprint != self._fingerprint or self._precision_stale():
+            with self._lock:
+                self._attach(self.store.current())
+                if fingerprint != self._fingerprint or self._precision_stale():
+                    self._publish()
+        self._refresh_ann()
+
+    def _precision_stale(self) -> bool:
+        return self.generation is not None and precision_of(self.quantized) != self.precision
+
+    # ---- 共享文件 ----
+
+    def _attach(self, generation: Optional[int]) -> None:
+        """映射指定代的文件；读取期间该代可能已被清理，此时改为映射最新一代"""
+        for _ in range(3):
+            if generation is None or generation == self.generation:
+                return
+            try:
+                arrays = self.store.load(generation)
+                self._swap(
+                    arrays['ids'], AnswerTable(arrays['answers'], arrays['answer_offsets']), arrays['matrix'],
+                    arrays.get('quantized'), arrays.get('scales')
+                )
+            except (OSError, KeyError, ValueError) as e:
+                logger.warning(f"映射向量模型 {self.embedding_model_id} 的知识向量第 {generation} 代失败: {str(e)}")
+                generation = self.store.current()
+                continue
+            count, last_updated = arrays['fingerprint'].tolist()
+            self.generation = generation
+            self._fingerprint = (count, from_micros(last_updated))
+            return
+
+    def _publish(self) -> None:
+        """取得文件锁后写出新一代；其他进程正在发布时沿用当前一代（尚无任何一代时等待）"""
+        with self.store.lock(blocking=self.generation is None) as locked:
+            if not locked:
+                return
+            self._attach(self.store.current())
+            # 持锁后重新读取，期间可能有新的写入
+            fingerprint = self._current_fingerprint()
+            if fingerprint != self._fingerprint:
+                if self.generation is None or self._fingerprint[1] is None or not len(self.ids):
+                    arrays = self._load()
+                else:
+                    arrays = self._apply_changes(self._fingerprint[1] - SYNC_LOOKBACK)
+            elif self._precision_stale():
+                # 只有存储精度变化，沿用当前一代的向量重新量化
+                arrays = self._arrays(self.ids, [], self.matrix)
+                arrays.update({'answers': self.answers.blob, 'answer_offsets': self.answers.offsets})
+            else:
+                return
+            arrays['fingerprint'] = np.array([fingerprint[0], to_micros(fingerprint[1])], dtype=np.int64)
+            arrays.update(quantize(arrays['matrix'], self.precision))
+            self._attach(self.store.publish(arrays))
+
+    @staticmethod
+    def _arrays(ids, answers: Sequence[str], matrix) -> Dict[str, np.ndarray]:
+        return {
+            'ids': np.asarray(ids, dtype=np.int64),
+            'matrix': np.asarray(matrix, dtype=np.float32),
+            **AnswerTable.pack(answers),
+        }
+
+    def _rows(self, queryset):
+        return queryset.filter(
+            is_valid=True, embedding__isnull=False
+        ).values_list('id', 'answer', 'embedding')
+
+    def _decode(self, rows, dimension: int):
+        """把数据库行解码为 (ids, answers, vectors, 跳过条数)，跳过维度不一致的向量"""
+        ids, answers, vectors, skipped = [], [], [], 0
+        for knowledge_id, answer, embedding in rows:
+            vector = np.frombuffer(bytes(embedding), dtype=np.float32)
+            if vector.shape[0] != dimension:
+                skipped += 1
+                continue
+            ids.append(knowledge_id)
+            answers.append(answer)
+            vectors.append(vector)
+        if vectors:
+            matrix = normalize(np.vstack(vectors))
+        else:
+            matrix = np.empty((0, dimension), dtype=np.float32)
+        return np.asarray(ids, dtype=np.int64), answers, matrix, skipped
+
+    def _load(self) -> Dict[str, np.ndarray]:
+        rows = list(self._rows(self._queryset()))
+        # 向量模型变更期间可能新旧维度并存，以多数为准
+        dimensions = [len(embedding) // 4 for _, _, embedding in rows]
+        dimension = max(set(dimensions), key=dimensions.count) if dimensions else 0
+        ids, answers, matrix, skipped = self._decode(rows, dimension)
+        if skipped:
+            logger.warning(f"向量模型 {self.embedding_model_id} 有 {skipped} 条知识向量维度与索引维度 {dimension} 不一致，已跳过")
+        logger.info(f"已加载向量模型 {self.embedding_model_id} 的知识索引: {len(ids)} 条")
+        return self._arrays(ids, answers, matrix)
+
+    def _apply_changes(self, since) -> Dict[str, np.ndarray]:
+        live_ids = set(self._rows(self._queryset()).values_list('id', flat=True))
+        known_ids = self.ids.tolist()
+        # 本地没有的有效知识（新增、重新生效或同步窗口外补齐了向量）一并拉取
+        missing = live_ids.difference(known_ids)
+        if len(missing) > FULL_RELOAD_THRESHOLD:
+            return self._load()
+        changed_ids, changed_answers, changed_matrix, skipped = self._decode(
+            self._rows(self._queryset().filter(Q(updated_at__gte=since) | Q(id__in=missing))),
+            self.dimension
+        )
+        if skipped:
+            # 维度变化（向量模型配置变更后重新生成），整体重建
+            return self._load()
+        changed = set(changed_ids.tolist())
+        # 去掉已删除、失效以及需要替换的行
+        keep = np.fromiter(
+            (knowledge_id in live_ids and knowledge_id not in changed for knowledge_id in known_ids),
+            dtype=bool, count=len(known_ids)
+        )
+        answers = [self.answers[row] for row in np.flatnonzero(keep)] + changed_answers
+        logger.info(
+            f"增量同步向量模型 {self.embedding_model_id} 的知识索引: "
+            f"更新 {len(changed_ids)} 条, 移除 {int((~keep).sum())} 条, "
+            f"当前 {int(keep.sum()) + len(changed_ids)} 条"
+        )
+        return self._arrays(
+            np.concatenate([self.ids[keep], changed_ids]),
+            answers,
+            np.vstack([self.matrix[keep], changed_matrix])
+        )
+
+    def _swap(self, ids, answers, matrix, quantized=None, scales=None) -> None:
+        # 整体替换引用，检索线程看到的始终是一致的快照
+        self.ids, self.answers, self.matrix, self.quantized, self.scales = ids, answers, matrix, quantized, scales
+        self.dimension = matrix.shape[1]
+
+    # ---- 近似最近邻索引 ----
+
+    def _load_ann(self, generation: int) -> Optional[IVFIndex]:
+        try:
+            return IVFIndex.from_arrays(generation, self.ann_store.load(generation))
+        except (OSError, KeyError, ValueError) as e:
+            # 读取期间该代可能已被新一代替换并清理
+            logger.warning(f"加载向量模型 {self.embedding_model_id} 的ANN索引第 {generation} 代失败: {str(e)}")
+            return None
+
+    def _map_ann(self, ann: IVFIndex, ids: np.ndarray) -> AnnMapping:
+        """建立行号映射；索引构建后在数据库中更新过的知识不使用索引中的旧位置"""
+        since = from_micros(ann.synced_until)
+        updated_ids = np.fromiter(
+            self._queryset().filter(updated_at__gt=since).values_list('id', flat=True), dtype=np.int64
+        )
+        return AnnMapping.build(ann, ids, updated_ids)
+
+    def _refresh_ann(self) -> None:
+        """知识条数达到 MIN_SIZE 时启用ANN索引：加载其他进程发布的新一代，过期时后台重建"""
+        config = ann_config()
+        ids, mapping = self.ids, self._ann_mapping
+        if not config['ENABLED'] or len(ids) < config['MIN_SIZE']:
+            self._ann_mapping = None
+            return
+        ann = mapping.ann if mapping else None
+        generation = self.ann_store.current()
+        if generation is not None and (ann is None or ann.generation != generation):
+            ann = self._load_ann(generation) or ann
+        if ann is None or ann.dimension != self.dimension:
+            self._ann_mapping = mapping = None
+        elif mapping is None or mapping.ann is not ann or mapping.ids is not ids:
+            self._ann_mapping = mapping = self._map_ann(ann, ids)
+        if mapping is None or mapping.stale_ratio > config['REBUILD_RATIO']:
+            self._schedule_ann_build()
+
+    def _schedule_ann_build(self) -> None:
+        with self._lock:
+            if self._ann_building:
+                return
+            self._ann_building = True
+
+        def run():
+            try:
+                self.build_ann()
+            except Exception as e:
+                logger.warning(f"构建向量模型 {self.embedding_model_id} 的ANN索引失败: {str(e)}")
+            finally:
+                self._ann_building = False
+
+        threading.Thread(target=run, name=f'knowledge-ann-{self.embedding_model_id}', daemon=True).start()
+
+    def build_ann(self) -> Optional[IVFIndex]:
+        """构建并发布ANN索引；其他进程正在构建时返回None"""
+        with self.ann_store.lock() as locked:
+            if not locked:
+                return None
+            with self._lock:
+                ids, matrix, fingerprint = self.ids, self.matrix, self._fingerprint
+            if not len(ids):
+                return None
+            synced_until = to_micros(fingerprint[1] if fingerprint and fingerprint[1] else timezone.now())
+            previous = self._ann_mapping.ann if self._ann_mapping else None
+            generation = self.ann_store.current()
+            if generation is not None and (previous is None or previous.generation != generation):
+                previous = self._load_ann(generation)
+                # 其他进程刚发布的一代可能已足够新
+                if previous is not None and previous.dimension == self.dimension:
+                    mapping = self._map_ann(previous, ids)
+                    if mapping.stale_ratio <= ann_config()['REBUILD_RATIO']:
+                        self._ann_mapping = mapping
+                        return previous
+            started = time.time()
+            generation = self.ann_store.publish(build_ivf(ids, matrix, synced_until, previous))
+            ann = self._load_ann(generation)
+            if ann is None:
+                return None
+            self._ann_mapping = self._map_ann(ann, ids)
+            logger.info(
+                f"已发布向量模型 {self.embedding_model_id} 的ANN索引第 {generation} 代: "
+                f"{len(ids)} 条, {len(ann.centroids)} 个簇, 耗时 {time.time() - started:.2f}秒"
+            )
+            return ann
+
+    def search(self, query_embedding, top_k: int, threshold: float,
+               exact: bool = False) -> List[Tuple[int, str, float]]:
+        """返回相似度不低于阈值的前top_k条知识 (知识ID, 答案, 相似度)
+
+        启用ANN索引时只计算候选簇内及尚未进入索引的知识；有量化矩阵时先在其上取出
+        top_k * RESCORE_FACTOR 个候选，再按原始精度重排。exact=True 时强制精确检索。
+        """
+        ids, answers, matrix, quantized, scales = self.ids, self.answers, self.matrix, self.quantized, self.scales
+        mapping = self._ann_mapping
+        if len(ids) == 0 or top_k <= 0:
+            return []
+        query = normalize(query_embedding)
+        if query.shape[0] != matrix.shape[1]:
+            logger.warning(f"查询向量维度 {query.shape[0]} 与索引维度 {matrix.shape[1]} 不一致")
+            return []
+        rows = None
+        if not exact and mapping is not None and mapping.ids is ids:
+            rows = mapping.candidate_rows(query, ann_config()['NPROBE'])
+        if not exact and quantized is not None and len(quantized) == len(ids):
+            approximate = approximate_scores(quantized, scales, query, rows)
+            rescore = top_k * store_config()['RESCORE_FACTOR']
+            if rescore < len(approximate):
+                picked = np.argpartition(-approximate, rescore - 1)[:rescore]
+                rows = picked if rows is None else rows[picked]
+        if rows is not None:
+            # 按行号排序后读取，内存映射时访问更连续
+            rows = np.sort(rows)
+            scores = matrix[rows] @ query
+        else:
+            scores = matrix @ query
+        if top_k < len(scores):
+            candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(len(scores))
+        candidates = candidates[np.argsort(-scores[candidates])]
+        if rows is not None:
+            return [
+                (int(ids[rows[i]]), answers[rows[i]], float(scores[i]))
+                for i in candidates if scores[i] >= threshold
+            ]
+        return [
+            (int(ids[i]), answers[i], float(scores[i]))
+            for i in candidates if scores[i] >= threshold
+        ]
+
+
+    def similarities(self, query_embedding, knowledge_ids: Sequence[int]) -> Dict[int, float]:
+        """按原始精度计算指定知识与查询的相似度，不在索引中的知识不返回"""
+        ids, matrix = self.ids, self.matrix
+        if len(ids) == 0 or not knowledge_ids:
+            return {}
+        query = normalize(query_embedding)
+        if query.shape[0] != matrix.shape[1]:
+            return {}
+        rows = np.flatnonzero(np.isin(ids, np.asarray(knowledge_ids, dtype=np.int64)))
+        scores = matrix[rows] @ query
+        return {int(ids[row]): float(score) for row, score in zip(rows, scores)}
+
+_indexes: Dict[int, KnowledgeIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_knowledge_index(embedding_model):
+    """获取（必要时创建并同步）该向量模型的知识索引
+
+    settings.KNOWLEDGE_VECTOR_STORE['BACKEND'] 为 pgvector 时返回 PgVectorIndex，
+    否则为当前进程中的 KnowledgeIndex，两者的 search 接口相同。
+    """
+    config = store_config()
+    if config['BACKEND'] == 'pgvector':
+        from .pgvector import get_pgvector_index
+        return get_pgvector_index(embedding_model, config)
+    index = _indexes.get(embedding_model.pk)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.setdefault(embedding_model.pk, KnowledgeIndex(embedding_model.pk))
+    index.precision = embedding_model.vector_precision
+    index.sync()
+    return index
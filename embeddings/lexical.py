@@ -0,0 +1,286 @@
+"""基于 SQLite FTS5 的知识关键词检索
+
+知识的问题与答案在应用侧切分为词元后写入 FTS5 虚拟表 knowledge_fts（rowid 为知识ID）：
+中日韩文字按相邻两字切分（单字成段时保留单字），字母数字按连续串切分，
+因此 FTS5 使用默认的 unicode61 分词器即可，无需编译中文分词扩展。
+检索时查询按同样方式切分，各词元以 OR 连接后按 BM25（问题权重高于答案）排序。
+
+两张表由迁移 embeddings/0012_knowledge_fts 创建（仅 SQLite）。与向量索引相同，通过
+(知识条数, 最后更新时间) 指纹发现变化并增量同步，同步进度保存在 knowledge_fts_state 表中，由所有 worker 共享。
+检索请求只读：发现索引落后时安排后台线程同步，同步完成前沿用现有索引；
+尚未建立索引的向量模型在后台全量写入（也可运行 sync_knowledge_vectors），完成前关键词检索结果为空。
+
+用途：
+- 应用检索方式为 hybrid 时，与向量检索结果做倒数排名融合（RRF）；
+  只被关键词命中的知识还需向量相似度不低于 MIN_SIMILARITY 才参与融合
+- 向量接口出错时退回纯关键词检索
+
+只在默认数据库为 SQLite、支持 FTS5 且已执行迁移时可用，否则检索结果为空。配置见 settings.KNOWLEDGE_LEXICAL::
+
+    KNOWLEDGE_LEXICAL = {
+        'ENABLED': True,
+        'CANDIDATES': 20,      # 关键词检索取出的候选数
+        'MIN_OVERLAP': 0.3,    # 查询词元在知识中出现的比例低于该值时丢弃
+        'MIN_SIMILARITY': 0.3, # hybrid 时只被关键词命中的知识，向量相似度低于该值时丢弃
+        'RRF_K': 60,           # 倒数排名融合的平滑常数
+    }
+"""
+import logging
+import re
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.db.models import Count, Max
+
+from .cache import normalize_query
+from .index import SYNC_LOOKBACK, from_micros, to_micros
+from .models import Knowledge
+
+logger = logging.getLogger(__name__)
+
+Result = Tuple[int, str, float]
+
+DEFAULT_LEXICAL_CONFIG = {
+    'ENABLED': True,
+    'CANDIDATES': 20,
+    'MIN_OVERLAP': 0.3,
+    'MIN_SIMILARITY': 0.3,
+    'RRF_K': 60,
+}
+
+FTS_TABLE = 'knowledge_fts'
+STATE_TABLE = 'knowledge_fts_state'
+INSERT_BATCH_SIZE = 500
+# BM25 中问题、答案两列的权重
+QUESTION_WEIGHT = 2.0
+ANSWER_WEIGHT = 1.0
+
+# 假名、中日韩统一表意文字（含扩展A与兼容区）、韩文音节
+_cjk = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_token_re = re.compile(f'[{_cjk}]+|[0-9a-z]+')
+_cjk_re = re.compile(f'[{_cjk}]')
+
+
+def lexical_config() -> dict:
+    return {**DEFAULT_LEXICAL_CONFIG, **getattr(settings, 'KNOWLEDGE_LEXICAL', {})}
+
+
+def tokenize(text: str) -> List[str]:
+    """切分为词元：中日韩文字取相邻两字，字母数字取连续串"""
+    tokens = []
+    for run in _token_re.findall(normalize_query(text)):
+        if _cjk_re.match(run) and len(run) > 1:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def match_expression(tokens: Sequence[str]) -> str:
+    # 词元只含文字与字母数字，加引号后可安全用于 MATCH
+    return ' OR '.join(f'"{token}"' for token in dict.fromkeys(tokens))
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Result]], k: int) -> List[Result]:
+    """按 RRF（各列表中 1 / (k + 名次) 之和）合并多个检索结果，按融合分数降序，得分为融合分数"""
+    scores: Dict[int, float] = {}
+    answers: Dict[int, str] = {}
+    for ranking in rankings:
+        for rank, (knowledge_id, answer, _) in enumerate(ranking, start=1):
+            scores[knowledge_id] = scores.get(knowledge_id, 0.0) + 1.0 / (k + rank)
+            answers[knowledge_id] = answer
+    ordered = sorted(scores.items(), key=lambda item: -item[1])
+    return [(knowledge_id, answers[knowledge_id], score) for knowledge_id, score in ordered]
+
+
+_fts5_available: Optional[bool] = None
+
+
+def fts5_available() -> bool:
+    """默认数据库是否为支持 FTS5 的 SQLite 且已由迁移建好关键词索引表（进程内只检测一次）"""
+    global _fts5_available
+    if _fts5_available is None:
+        if connection.vendor != 'sqlite':
+            _fts5_available = False
+        else:
+            try:
+                _fts5_available = {FTS_TABLE, STATE_TABLE} <= set(connection.introspection.table_names())
+            except DatabaseError:
+                _fts5_available = False
+    return _fts5_available
+
+
+class LexicalIndex:
+    """单个向量模型下知识的 FTS5 关键词索引"""
+
+    def __init__(self, embedding_model_id: int):
+        self.embedding_model_id = embedding_model_id
+        self._fingerprint: Optional[Tuple[int, object]] = None
+        self._lock = threading.Lock()
+        self._syncing = False
+
+    def _queryset(self):
+        return Knowledge.objects.filter(model_id=self.embedding_model_id)
+
+    def _current_fingerprint(self):
+        stats = self._queryset().aggregate(count=Count('id'), last_updated=Max('updated_at'))
+        return stats['count'], stats['last_updated']
+
+    def _write_rows(self, cursor, queryset) -> int:
+        written, batch = 0, []
+        for knowledge_id, question, answer in queryset.values_list('id', 'question', 'answer').iterator():
+            batch.append((knowledge_id, ' '.join(tokenize(question)), ' '.join(tokenize(answer)),
+                          self.embedding_model_id))
+            if len(batch) >= INSERT_BATCH_SIZE:
+                written += self._insert(cursor, batch)
+                batch = []
+        if batch:
+            written += self._insert(cursor, batch)
+        return written
+
+    @staticmethod
+    def _insert(cursor, batch) -> int:
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE} (rowid, question, answer, model_id) VALUES (%s, %s, %s, %s)", batch
+        )
+        return len(batch)
+
+    def _read_state(self) -> Optional[Tuple[int, object]]:
+        """共享的同步进度 (知识条数, 最后更新时间)，尚未建立索引时为None"""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT row_count, last_updated FROM {STATE_TABLE} WHERE model_id = %s", [self.embedding_model_id]
+            )
+            state = cursor.fetchone()
+        return (state[0], from_micros(state[1])) if state else None
+
+    def check(self) -> Tuple[bool, bool]:
+        """只读检查索引状态，返回 (已建立, 与知识表一致)"""
+        fingerprint = self._current_fingerprint()
+        if fingerprint == self._fingerprint:
+            return True, True
+        state = self._read_state()
+        if state == fingerprint:
+            # 其他 worker 已完成同步
+            self._fingerprint = fingerprint
+        return state is not None, state == fingerprint
+
+    def sync(self) -> None:
+        """与知识表同步：无同步记录时全量写入，否则只替换变动的知识并清理已删除的
+
+        会写入数据库，只在后台线程或管理命令中调用，不在检索请求中执行。
+        """
+        with self._lock, transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT row_count, last_updated FROM {STATE_TABLE} WHERE model_id = %s",
+                [self.embedding_model_id]
+            )
+            state = cursor.fetchone()
+            # 事务内重新读取，其他 worker 可能刚完成同步
+            fingerprint = self._current_fingerprint()
+            if state and (state[0], from_micros(state[1])) == fingerprint:
+                self._fingerprint = fingerprint
+                return
+            if not state or state[1] < 0:
+                cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE model_id = %s", [self.embedding_model_id])
+                changed = self._queryset()
+            else:
+                changed = self._queryset().filter(updated_at__gte=from_micros(state[1]) - SYNC_LOOKBACK)
+                ids = list(changed.values_list('id', flat=True))
+                for start in range(0, len(ids), INSERT_BATCH_SIZE):
+                    batch = ids[start:start + INSERT_BATCH_SIZE]
+                    cursor.execute(
+                        f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({', '.join(['%s'] * len(batch))})", batch
+                    )
+                # 已删除的知识
+                cursor.execute(
+                    f"DELETE FROM {FTS_TABLE} WHERE model_id = %s AND rowid NOT IN"
+                    f" (SELECT id FROM {Knowledge._meta.db_table} WHERE model_id = %s)",
+                    [self.embedding_model_id, self.embedding_model_id]
+                )
+            written = self._write_rows(cursor, changed)
+            cursor.execute(
+                f"INSERT OR REPLACE INTO {STATE_TABLE} (model_id, row_count, last_updated) VALUES (%s, %s, %s)",
+                [self.embedding_model_id, fingerprint[0], to_micros(fingerprint[1])]
+            )
+            self._fingerprint = fingerprint
+        logger.info(f"同步向量模型 {self.embedding_model_id} 的关键词索引: 写入 {written} 条")
+
+    def schedule_sync(self) -> None:
+        """在后台线程中同步索引，已在进行时忽略"""
+        with self._lock:
+            if self._syncing:
+                return
+            self._syncing = True
+
+        def run():
+            try:
+                self.sync()
+            except Exception as e:
+                logger.warning(f"同步向量模型 {self.embedding_model_id} 的关键词索引失败: {str(e)}")
+            finally:
+                self._syncing = False
+                close_old_connections()
+
+        threading.Thread(target=run, name=f'knowledge-fts-{self.embedding_model_id}', daemon=True).start()
+
+    def search(self, query: str, top_k: int) -> List[Result]:
+        """返回 (知识ID, 答案, 查询词元覆盖率)，按 BM25 排序"""
+        tokens = tokenize(query)
+        if not tokens or top_k <= 0:
+            return []
+        config = lexical_config()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT f.rowid, k.question, k.answer FROM {FTS_TABLE} f"
+                f" JOIN {Knowledge._meta.db_table} k ON k.id = f.rowid"
+                f" WHERE {FTS_TABLE} MATCH %s AND f.model_id = %s AND k.is_valid"
+                f" ORDER BY bm25({FTS_TABLE}, %s, %s) LIMIT %s",
+                [match_expression(tokens), self.embedding_model_id, QUESTION_WEIGHT, ANSWER_WEIGHT, top_k]
+            )
+            rows = cursor.fetchall()
+        query_tokens = set(tokens)
+        results = []
+        for knowledge_id, question, answer in rows:
+            # BM25 只保证排序，用词元覆盖率过滤只命中个别常见字的知识
+            matched = query_tokens.intersection(tokenize(question)) | query_tokens.intersection(tokenize(answer))
+            overlap = len(matched) / len(query_tokens)
+            if overlap >= config['MIN_OVERLAP']:
+                results.append((knowledge_id, answer, overlap))
+        return results
+
+
+_indexes: Dict[int, LexicalIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def _lexical_index(embedding_model) -> LexicalIndex:
+    index = _indexes.get(embedding_model.pk)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.setdefault(embedding_model.pk, LexicalIndex(embedding_model.pk))
+    return index
+
+
+def get_lexical_index(embedding_model) -> Optional[LexicalIndex]:
+    """获取该向量模型的关键词索引（只读），不可用时返回None
+
+    索引落后于知识表时安排后台同步并先使用现有索引；尚未建立时返回None。
+    """
+    if not lexical_config()['ENABLED'] or not fts5_available():
+        return None
+    index = _lexical_index(embedding_model)
+    built, current = index.check()
+    if not current:
+        index.schedule_sync()
+    return index if built else None
+
+
+def sync_lexical_index(embedding_model) -> bool:
+    """在当前线程中同步（必要时全量建立）该向量模型的关键词索引，供管理命令使用；不可用时返回False"""
+    if not lexical_config()['ENABLED'] or not fts5_available():
+        return False
+    _lexical_index(embedding_model).sync()
+    return True
@@ -0,0 +1,113 @@
+import statistics
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from embeddings.index import KnowledgeIndex, normalize
+from embeddings.models import EmbeddingModel
+from embeddings.quantization import PRECISION_CHOICES, quantize
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = '对比ANN索引、量化存储与精确检索的 recall@k 与单次检索耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', help='向量模型ID或名称，使用该模型已有的知识向量')
+        parser.add_argument('--synthetic', type=int, default=0, help='不读取数据库，生成指定条数的随机聚簇向量')
+        parser.add_argument('--dimension', type=int, default=1024, help='随机向量的维度')
+        parser.add_argument('--queries', type=int, default=200, help='查询次数')
+        parser.add_argument('--k', type=int, default=10, help='recall@k 的 k')
+        parser.add_argument('--nprobe', type=int, action='append', help='要测试的 NPROBE，可重复，默认 4/8/16/32')
+        parser.add_argument('--noise', type=float, default=0.3, help='查询向量相对知识向量的扰动幅度')
+        parser.add_argument('--precision', choices=[value for value, _ in PRECISION_CHOICES],
+                            help='存储精度，默认为 float32（--model 时为向量模型的配置）')
+
+    def handle(self, *args, **options):
+        # 向量与索引文件总是写入临时目录，评测不会替换线上正在使用的文件
+        with tempfile.TemporaryDirectory() as directory:
+            self.benchmark(directory, options)
+
+    def benchmark(self, directory, options):
+        rng = np.random.default_rng(0)
+        if options['synthetic']:
+            index = KnowledgeIndex(0, directory=directory, precision=options['precision'] or 'float32')
+            size, dimension = options['synthetic'], options['dimension']
+            # 随机向量近似均匀分布，检索不出近邻结构，这里生成带簇结构的数据更接近真实语料
+            centers = rng.standard_normal((max(size // 100, 1), dimension)).astype(np.float32)
+            matrix = centers[rng.integers(len(centers), size=size)]
+            matrix += rng.standard_normal((size, dimension)).astype(np.float32)
+            arrays = KnowledgeIndex._arrays(np.arange(size), [''] * size, normalize(matrix))
+            arrays['fingerprint'] = np.array([size, -1], dtype=np.int64)
+            arrays.update(quantize(arrays['matrix'], index.precision))
+            index._attach(index.store.publish(arrays))
+        elif options['model']:
+            model_ref = options['model']
+            lookup = {'pk': int(model_ref)} if model_ref.isdigit() else {'name': model_ref}
+            try:
+                embedding_model = EmbeddingModel.objects.get(**lookup)
+            except EmbeddingModel.DoesNotExist:
+                raise CommandError(f"向量模型不存在: {model_ref}")
+            # 单独加载一份，不使用进程内共享的索引
+            with override_settings(KNOWLEDGE_ANN={'ENABLED': False}):
+                index = KnowledgeIndex(
+                    embedding_model.pk, directory=directory,
+                    precision=options['precision'] or embedding_model.vector_precision
+                )
+                index.sync()
+        else:
+            raise CommandError('需要指定 --model 或 --synthetic')
+
+        if len(index) < options['k']:
+            raise CommandError(f"知识条数 {len(index)} 少于 k={options['k']}")
+
+        picks = rng.integers(len(index), size=options['queries'])
+        queries = np.asarray(index.matrix[picks], dtype=np.float32)
+        queries += options['noise'] * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(index.dimension)
+        k = options['k']
+
+        exact_results, exact_times = [], []
+        for query in queries:
+            t = time.perf_counter()
+            exact_results.append({item[0] for item in index.search(query, k, -1.0, exact=True)})
+            exact_times.append(time.perf_counter() - t)
+        self.stdout.write(
+            f"精确检索      p50 {statistics.median(exact_times) * 1000:.2f}ms / "
+            f"p95 {_percentile(exact_times, 0.95) * 1000:.2f}ms"
+        )
+
+        if index.quantized is not None:
+            # ANN索引尚未构建，此时为量化矩阵全量扫描 + 原始精度重排
+            self._report(index, f"{index.precision}全量 ", queries, exact_results, k)
+
+        started = time.time()
+        ann = index.build_ann()
+        if ann is None:
+            raise CommandError('其他进程正在构建该向量模型的ANN索引，请稍后重试')
+        self.stdout.write(
+            f"知识 {len(index)} 条, 维度 {index.dimension}, 簇数 {len(ann.centroids)}, "
+            f"构建耗时 {time.time() - started:.2f}秒"
+        )
+
+        for nprobe in options['nprobe'] or [4, 8, 16, 32]:
+            with override_settings(KNOWLEDGE_ANN={'NPROBE': nprobe}):
+                self._report(index, f"ANN nprobe={nprobe:<4}", queries, exact_results, k)
+
+    def _report(self, index, label, queries, exact_results, k):
+        recalls, times = [], []
+        for query, expected in zip(queries, exact_results):
+            t = time.perf_counter()
+            found = {item[0] for item in index.search(query, k, -1.0)}
+            times.append(time.perf_counter() - t)
+            recalls.append(len(found & expected) / len(expected))
+        self.stdout.write(
+            f"{label} recall@{k} {statistics.mean(recalls):.4f}, "
+            f"p50 {statistics.median(times) * 1000:.2f}ms / p95 {_percentile(times, 0.95) * 1000:.2f}ms"
+        )
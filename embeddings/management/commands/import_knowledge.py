@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from embeddings.importer import detect_format, import_knowledge, iter_records
+from embeddings.models import EmbeddingModel
+
+
+class Command(BaseCommand):
+    help = '从 CSV / JSONL 文件批量导入问答知识并生成问题向量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='问答文件路径，CSV需包含 question/answer（或 问题/答案）列，JSONL每行一个对象')
+        parser.add_argument('--model', required=True, help='向量模型ID或名称')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='文件格式，默认按扩展名判断')
+        parser.add_argument('--batch-size', type=int, default=64, help='每次请求向量接口的问题条数')
+        parser.add_argument('--concurrency', type=int, default=4, help='同时在途的批次数')
+        parser.add_argument('--retries', type=int, default=5, help='单批次失败后的最大重试次数')
+        parser.add_argument('--allow-duplicates', action='store_true', help='不跳过该向量模型下已存在的问题')
+
+    def handle(self, *args, **options):
+        model_ref = options['model']
+        try:
+            if model_ref.isdigit():
+                embedding_model = EmbeddingModel.objects.get(pk=int(model_ref))
+            else:
+                embedding_model = EmbeddingModel.objects.get(name=model_ref)
+        except EmbeddingModel.DoesNotExist:
+            raise CommandError(f"向量模型不存在: {model_ref}")
+
+        try:
+            file_format = options['format'] or detect_format(options['path'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        def progress(result):
+            self.stdout.write(f"\r已导入 {result.created} 条", ending='')
+            self.stdout.flush()
+
+        with open(options['path'], encoding='utf-8-sig', newline='') as f:
+            result = import_knowledge(
+                embedding_model,
+                iter_records(f, file_format),
+                batch_size=options['batch_size'],
+                concurrency=options['concurrency'],
+                max_retries=options['retries'],
+                skip_existing=not options['allow_duplicates'],
+                progress=progress,
+            )
+
+        self.stdout.write('')
+        if result.failed_batches:
+            self.stdout.write(self.style.WARNING(f"部分批次向量生成失败，将在检索时补齐: {result.errors[-1]}"))
+        self.stdout.write(self.style.SUCCESS(str(result)))
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from embeddings.index import store_config
+from embeddings.lexical import sync_lexical_index
+from embeddings.models import EmbeddingModel
+from embeddings.pgvector import get_pgvector_index
+from embeddings.services import ensure_knowledge_embeddings
+
+
+class Command(BaseCommand):
+    help = (
+        '补齐尚未生成的知识向量并同步关键词索引；KNOWLEDGE_VECTOR_STORE 的 BACKEND 为 pgvector 时'
+        '再把主数据库中的知识向量回填 / 同步到 pgvector'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append', help='向量模型ID或名称，可重复，默认全部启用的向量模型')
+        parser.add_argument('--rebuild', action='store_true', help='删除并全量重建 pgvector 向量表与索引，而不是增量同步')
+        parser.add_argument('--skip-missing', action='store_true', help='不为尚未生成向量的知识调用向量接口')
+
+    def handle(self, *args, **options):
+        config = store_config()
+        pgvector = config['BACKEND'] == 'pgvector'
+        if options['rebuild'] and not pgvector:
+            raise CommandError("--rebuild 需要 KNOWLEDGE_VECTOR_STORE['BACKEND'] 为 pgvector")
+
+        if options['model']:
+            embedding_models = []
+            for model_ref in options['model']:
+                lookup = {'pk': int(model_ref)} if model_ref.isdigit() else {'name': model_ref}
+                try:
+                    embedding_models.append(EmbeddingModel.objects.get(**lookup))
+                except EmbeddingModel.DoesNotExist:
+                    raise CommandError(f"向量模型不存在: {model_ref}")
+        else:
+            embedding_models = list(EmbeddingModel.objects.filter(is_active=True))
+
+        for embedding_model in embedding_models:
+            if not options['skip_missing']:
+                filled = ensure_knowledge_embeddings(embedding_model)
+                if filled:
+                    self.stdout.write(f"{embedding_model.name}: 补齐向量 {filled} 条")
+            if sync_lexical_index(embedding_model):
+                self.stdout.write(f"{embedding_model.name}: 关键词索引已同步")
+            if not pgvector:
+                self.stdout.write(self.style.SUCCESS(f"{embedding_model.name}: 向量已补齐"))
+                continue
+            index = get_pgvector_index(embedding_model, config)
+            if options['rebuild']:
+                written = index.rebuild()
+                self.stdout.write(self.style.SUCCESS(f"{embedding_model.name}: 已重建，写入 {written} 条"))
+            else:
+                self.stdout.write(self.style.SUCCESS(f"{embedding_model.name}: 已同步 (维度 {index.dimension})"))
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('embeddings', '0007_remove_knowledge_text_knowledge_answer_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='knowledge',
+            name='embedding',
+            field=models.BinaryField(blank=True, null=True, verbose_name='问题向量'),
+        ),
+    ]
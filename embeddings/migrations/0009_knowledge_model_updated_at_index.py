@@ -0,0 +1,17 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('embeddings', '0008_knowledge_embedding'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='knowledge',
+            index=models.Index(fields=['model', 'updated_at'], name='embeddings__model_i_19b29b_idx'),
+        ),
+    ]
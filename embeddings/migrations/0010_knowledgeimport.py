@@ -0,0 +1,38 @@
+# Generated by Django 4.2.5 on 2026-10-18 15:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('embeddings', '0009_knowledge_model_updated_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KnowledgeImport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(upload_to='knowledge_imports/', verbose_name='问答文件')),
+                ('file_format', models.CharField(max_length=10, verbose_name='文件格式')),
+                ('batch_size', models.PositiveIntegerField(default=64, verbose_name='每批条数')),
+                ('concurrency', models.PositiveIntegerField(default=4, verbose_name='并发批次数')),
+                ('status', models.CharField(choices=[('pending', '等待中'), ('running', '导入中'), ('done', '已完成'), ('failed', '失败')], default='pending', max_length=10, verbose_name='状态')),
+                ('created', models.PositiveIntegerField(default=0, verbose_name='已新增')),
+                ('embedded', models.PositiveIntegerField(default=0, verbose_name='已生成向量')),
+                ('skipped', models.PositiveIntegerField(default=0, verbose_name='已跳过')),
+                ('failed_batches', models.PositiveIntegerField(default=0, verbose_name='失败批次')),
+                ('message', models.TextField(blank=True, verbose_name='结果')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('model', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='embeddings.embeddingmodel', verbose_name='向量模型')),
+            ],
+            options={
+                'verbose_name': '知识导入',
+                'verbose_name_plural': '知识导入',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
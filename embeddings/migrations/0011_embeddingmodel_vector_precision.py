@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('embeddings', '0010_knowledgeimport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='embeddingmodel',
+            name='vector_precision',
+            field=models.CharField(choices=[('float32', 'float32（原始精度）'), ('float16', 'float16（常驻内存约1/2，全量扫描约慢3倍）'), ('int8', 'int8（按向量缩放，常驻内存约1/4）')], default='float32', help_text='float16/int8 时检索先扫描量化副本，再读取 float32 原始向量重排候选。只减少常驻内存（float32 文件中未被读取的页不进入内存）：float32 文件照常写出，磁盘占用增加约1/2（float16）或1/4（int8）；不使用ANN索引时 float16 全量扫描约为 float32 的3倍耗时', max_length=10, verbose_name='向量存储精度'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# 关键词检索（embeddings.lexical）使用的 FTS5 虚拟表与同步进度表，仅在支持 FTS5 的 SQLite 上创建
+
+from django.db import migrations
+
+
+def fts5_supported(schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return False
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def create_fts_tables(apps, schema_editor):
+    if not fts5_supported(schema_editor):
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_fts USING fts5("
+        " question, answer, model_id UNINDEXED, tokenize='unicode61')"
+    )
+    schema_editor.execute(
+        "CREATE TABLE IF NOT EXISTS knowledge_fts_state ("
+        " model_id integer PRIMARY KEY,"
+        " row_count integer NOT NULL,"
+        " last_updated integer NOT NULL)"
+    )
+
+
+def drop_fts_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS knowledge_fts")
+    schema_editor.execute("DROP TABLE IF EXISTS knowledge_fts_state")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('embeddings', '0011_embeddingmodel_vector_precision'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_tables, drop_fts_tables),
+    ]
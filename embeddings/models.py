@@ -5,6 +5,14 @@ from typing import List, Dict, Any, Optional, Tuple
 import json
 import requests
 import time
+import logging
+from django.dispatch import receiver
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save
+
+from .quantization import PRECISION_CHOICES
+
+logger = logging.getLogger(__name__)
 
 class EmbeddingModel(models.Model):
     """向量模型配置"""
@@ -15,6 +23,14 @@ class EmbeddingModel(models.Model):
     api_key = models.CharField('API密钥', max_length=200, blank=True)
     dimension = models.IntegerField('向量维度', default=1024)
     encoding_format = models.CharField('编码格式', max_length=50, default='float')
+    vector_precision = models.CharField(
+        '向量存储精度', max_length=10, choices=PRECISION_CHOICES, default='float32',
+        help_text=(
+            'float16/int8 时检索先扫描量化副本，再读取 float32 原始向量重排候选。'
+            '只减少常驻内存（float32 文件中未被读取的页不进入内存）：float32 文件照常写出，'
+            '磁盘占用增加约1/2（float16）或1/4（int8）；不使用ANN索引时 float16 全量扫描约为 float32 的3倍耗时'
+        )
+    )
     is_active = models.BooleanField('是否启用', default=True)
     created_at = models.DateTimeField('创建时间', auto_now_add=True)
     updated_at = models.DateTimeField('更新时间', auto_now=True)
@@ -33,6 +49,7 @@ class Knowledge(models.Model):
     answer = models.TextField('答案')
     model = models.ForeignKey(EmbeddingModel, on_delete=models.CASCADE, verbose_name='向量模型')
     is_valid = models.BooleanField('是否有效', default=True)
+    embedding = models.BinaryField('问题向量', null=True, blank=True, editable=False)
     created_at = models.DateTimeField('创建时间', auto_now_add=True)
     updated_at = models.DateTimeField('更新时间', auto_now=True)
 
@@ -43,10 +60,101 @@ class Knowledge(models.Model):
         indexes = [
             models.Index(fields=['model', 'is_valid']),
             models.Index(fields=['question']),
+            models.Index(fields=['model', 'updated_at']),
         ]
 
     def __str__(self):
         return self.question
 
+    def get_embedding(self) -> Optional[np.ndarray]:
+        """读取已存储的问题向量(float32)"""
+        if self.embedding is None:
+            return None
+        return np.frombuffer(bytes(self.embedding), dtype=np.float32)
+
+    def set_embedding(self, vector) -> None:
+        """以float32字节形式存储问题向量"""
+        self.embedding = np.asarray(vector, dtype=np.float32).tobytes()
+
+
+class KnowledgeImport(models.Model):
+    """后台管理中上传的知识导入任务，导入在后台线程中进行，进度随批次更新"""
+    STATUS_CHOICES = [
+        ('pending', '等待中'),
+        ('running', '导入中'),
+        ('done', '已完成'),
+        ('failed', '失败'),
+    ]
+
+    model = models.ForeignKey(EmbeddingModel, on_delete=models.CASCADE, verbose_name='向量模型')
+    file = models.FileField('问答文件', upload_to='knowledge_imports/')
+    file_format = models.CharField('文件格式', max_length=10)
+    batch_size = models.PositiveIntegerField('每批条数', default=64)
+    concurrency = models.PositiveIntegerField('并发批次数', default=4)
+    status = models.CharField('状态', max_length=10, choices=STATUS_CHOICES, default='pending')
+    created = models.PositiveIntegerField('已新增', default=0)
+    embedded = models.PositiveIntegerField('已生成向量', default=0)
+    skipped = models.PositiveIntegerField('已跳过', default=0)
+    failed_batches = models.PositiveIntegerField('失败批次', default=0)
+    message = models.TextField('结果', blank=True)
+    created_at = models.DateTimeField('创建时间', auto_now_add=True)
+    updated_at = models.DateTimeField('更新时间', auto_now=True)
+
+    class Meta:
+        verbose_name = '知识导入'
+        verbose_name_plural = verbose_name
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.model.name} - {self.file.name}"
+
+# 信号处理
+# 影响向量结果的向量模型字段，变更后需要重新生成该模型下所有知识的向量
+VECTOR_FIELDS = ('model_name', 'api_url', 'dimension', 'encoding_format')
+
+@receiver(pre_save, sender=EmbeddingModel)
+def check_embedding_model_change(sender, instance, **kwargs):
+    """记录更新前的API配置，向量相关配置变更时标记已存储的知识向量失效"""
+    instance._vectors_stale = False
+    instance._old_endpoint = None
+    if not instance.pk:
+        return
+    old = sender.objects.filter(pk=instance.pk).values('api_key', *VECTOR_FIELDS).first()
+    if old:
+        instance._old_endpoint = (old['api_url'], old['api_key'])
+        instance._vectors_stale = any(old[field] != getattr(instance, field) for field in VECTOR_FIELDS)
+
+@receiver(post_save, sender=EmbeddingModel)
+def invalidate_knowledge_embeddings(sender, instance, **kwargs):
+    """清空失效的知识向量，提交后由后台线程按新配置重新生成"""
+    if getattr(instance, '_vectors_stale', False):
+        Knowledge.objects.filter(model=instance).update(embedding=None, updated_at=timezone.now())
+        _schedule_embeddings(instance)
+
+@receiver(post_save, sender=EmbeddingModel)
+def drop_embedding_clients(sender, instance, **kwargs):
+    """向量模型配置更新后移除复用的旧客户端"""
+    from chat.clients import invalidate_clients
+    if getattr(instance, '_old_endpoint', None):
+        invalidate_clients(*instance._old_endpoint)
+
+@receiver(pre_save, sender=Knowledge)
+def reset_knowledge_embedding(sender, instance, **kwargs):
+    """问题或向量模型变化时丢弃旧向量"""
+    if not instance.pk or instance.embedding is None:
+        return
+    old = sender.objects.filter(pk=instance.pk).values('question', 'model_id').first()
+    if old and (old['question'] != instance.question or old['model_id'] != instance.model_id):
+        instance.embedding = None
 
+@receiver(post_save, sender=Knowledge)
+def schedule_knowledge_embedding(sender, instance, raw=False, **kwargs):
+    """新增或修改知识后由后台线程生成问题向量，不在保存请求中调用向量接口"""
+    if raw or instance.embedding is not None or not instance.is_valid:
+        return
+    _schedule_embeddings(instance.model)
 
+def _schedule_embeddings(embedding_model):
+    # 事务提交后再补齐，后台线程才能读到刚保存的知识
+    from .services import schedule_missing_embeddings
+    transaction.on_commit(lambda: schedule_missing_embeddings(embedding_model, force=True))
@@ -0,0 +1,285 @@
+"""PostgreSQL + pgvector 知识向量存储
+
+知识本身仍保存在主数据库，向量同步到 PostgreSQL 中按向量模型划分的表
+knowledge_vector_<向量模型ID>，并建立 HNSW 或 IVFFlat 余弦索引，检索在数据库中完成，
+各进程无需把全部向量载入内存。与内存索引相同，通过 (知识条数, 最后更新时间)
+指纹发现变化并增量同步；同步进度记录在 knowledge_vector_state 表中，由所有 worker 共享。
+
+启用方式见 settings.KNOWLEDGE_VECTOR_STORE::
+
+    KNOWLEDGE_VECTOR_STORE = {
+        'BACKEND': 'pgvector',   # memory（默认）/ pgvector
+        'DATABASE': 'vectors',   # settings.DATABASES 中 PostgreSQL 连接的别名
+        'INDEX_TYPE': 'hnsw',    # hnsw / ivfflat
+        'HNSW_M': 16,
+        'HNSW_EF_CONSTRUCTION': 64,
+        'HNSW_EF_SEARCH': 40,
+        'IVFFLAT_LISTS': 100,
+        'IVFFLAT_PROBES': 10,
+    }
+
+需要安装 psycopg2（或 psycopg），数据库中需可执行 CREATE EXTENSION vector。
+已有知识可用 ``python manage.py sync_knowledge_vectors`` 一次性回填。
+"""
+import logging
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from django.db import connections, transaction
+from django.db.models import Count, Max
+
+from .index import SYNC_LOOKBACK, normalize
+from .models import Knowledge
+
+logger = logging.getLogger(__name__)
+
+UPSERT_BATCH_SIZE = 500
+
+STATE_TABLE = 'knowledge_vector_state'
+
+
+def _vector_literal(vector) -> str:
+    return '[' + ','.join(f'{value:.7g}' for value in vector) + ']'
+
+
+class PgVectorIndex:
+    """单个向量模型在 pgvector 中的知识向量表，与 KnowledgeIndex 提供相同的 sync / search 接口"""
+
+    def __init__(self, embedding_model_id: int, config: dict):
+        self.embedding_model_id = embedding_model_id
+        self.alias = config['DATABASE']
+        self.config = config
+        self.table = f'knowledge_vector_{int(embedding_model_id)}'
+        self.dimension = 0
+        self._fingerprint: Optional[Tuple[int, object]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        return connections[self.alias]
+
+    def _queryset(self):
+        return Knowledge.objects.filter(model_id=self.embedding_model_id)
+
+    def _current_fingerprint(self):
+        stats = self._queryset().aggregate(count=Count('id'), last_updated=Max('updated_at'))
+        return stats['count'], stats['last_updated']
+
+    def _rows(self, queryset):
+        return queryset.filter(
+            is_valid=True, embedding__isnull=False
+        ).values_list('id', 'answer', 'embedding')
+
+    # ---- 表结构 ----
+
+    def _ensure_schema(self, cursor):
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {STATE_TABLE} ("
+            " model_id integer PRIMARY KEY,"
+            " dimension integer NOT NULL,"
+            " row_count integer NOT NULL,"
+            " last_updated timestamptz)"
+        )
+
+    def _read_state(self, cursor):
+        cursor.execute(
+            f"SELECT dimension, row_count, last_updated FROM {STATE_TABLE} WHERE model_id = %s",
+            [self.embedding_model_id]
+        )
+        return cursor.fetchone()
+
+    def _write_state(self, cursor, fingerprint):
+        cursor.execute(
+            f"INSERT INTO {STATE_TABLE} (model_id, dimension, row_count, last_updated)"
+            " VALUES (%s, %s, %s, %s)"
+            " ON CONFLICT (model_id) DO UPDATE SET dimension = EXCLUDED.dimension,"
+            " row_count = EXCLUDED.row_count, last_updated = EXCLUDED.last_updated",
+            [self.embedding_model_id, self.dimension, fingerprint[0], fingerprint[1]]
+        )
+
+    def _create_table(self, cursor):
+        cursor.execute(f"DROP TABLE IF EXISTS {self.table}")
+        cursor.execute(
+            f"CREATE TABLE {self.table} ("
+            " knowledge_id bigint PRIMARY KEY,"
+            " answer text NOT NULL,"
+            f" embedding vector({self.dimension}) NOT NULL)"
+        )
+
+    def _create_vector_index(self, cursor):
+        """在数据写入后建立向量索引（先导入后建索引更快，IVFFlat 也需要已有数据来聚类）"""
+        if self.config['INDEX_TYPE'] == 'ivfflat':
+            options = f"lists = {int(self.config['IVFFLAT_LISTS'])}"
+            method = 'ivfflat'
+        else:
+            options = (f"m = {int(self.config['HNSW_M'])}, "
+                       f"ef_construction = {int(self.config['HNSW_EF_CONSTRUCTION'])}")
+            method = 'hnsw'
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.table}_embedding ON {self.table}"
+            f" USING {method} (embedding vector_cosine_ops) WITH ({options})"
+        )
+
+    # ---- 同步 ----
+
+    def _upsert(self, cursor, rows) -> Tuple[int, int]:
+        """写入 (id, answer, embedding) 行，返回 (写入条数, 维度不一致跳过条数)"""
+        batch, written, skipped = [], 0, 0
+        for knowledge_id, answer, embedding in rows:
+            vector = np.frombuffer(bytes(embedding), dtype=np.float32)
+            if vector.shape[0] != self.dimension:
+                skipped += 1
+                continue
+            batch.append((knowledge_id, answer, _vector_literal(normalize(vector))))
+            if len(batch) >= UPSERT_BATCH_SIZE:
+                written += self._write_batch(cursor, batch)
+                batch = []
+        if batch:
+            written += self._write_batch(cursor, batch)
+        return written, skipped
+
+    def _write_batch(self, cursor, batch) -> int:
+        cursor.executemany(
+            f"INSERT INTO {self.table} (knowledge_id, answer, embedding) VALUES (%s, %s, %s::vector)"
+            " ON CONFLICT (knowledge_id) DO UPDATE SET answer = EXCLUDED.answer, embedding = EXCLUDED.embedding",
+            batch
+        )
+        return len(batch)
+
+    def rebuild(self) -> int:
+        """全量重建向量表与索引，返回写入条数"""
+        with self._lock:
+            fingerprint = self._current_fingerprint()
+            with transaction.atomic(using=self.alias), self.connection.cursor() as cursor:
+                self._ensure_schema(cursor)
+                written = self._rebuild(cursor)
+                self._write_state(cursor, fingerprint)
+            self._fingerprint = fingerprint
+            return written
+
+    def _rebuild(self, cursor) -> int:
+        rows = list(self._rows(self._queryset()))
+        # 向量模型变更期间可能新旧维度并存，以多数为准
+        dimensions = [len(embedding) // 4 for _, _, embedding in rows]
+        self.dimension = max(set(dimensions), key=dimensions.count) if dimensions else 0
+        if not self.dimension:
+            cursor.execute(f"DROP TABLE IF EXISTS {self.table}")
+            return 0
+        self._create_table(cursor)
+        written, skipped = self._upsert(cursor, rows)
+        self._create_vector_index(cursor)
+        if skipped:
+            logger.warning(f"向量模型 {self.embedding_model_id} 有 {skipped} 条知识向量维度与 {self.dimension} 不一致，已跳过")
+        logger.info(f"已重建向量模型 {self.embedding_model_id} 的 pgvector 表: {written} 条")
+        return written
+
+    def sync(self) -> None:
+        """与主数据库同步；其他 worker 正在同步时直接使用当前数据"""
+        fingerprint = self._current_fingerprint()
+        if fingerprint == self._fingerprint:
+            return
+        with self._lock, transaction.atomic(using=self.alias), self.connection.cursor() as cursor:
+            self._ensure_schema(cursor)
+            state = self._read_state(cursor)
+            if state:
+                self.dimension = state[0]
+            cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", [self.table])
+            if not cursor.fetchone()[0]:
+                return
+            # 加锁后重新读取，其他 worker 可能刚完成同步
+            state = self._read_state(cursor)
+            if state and (state[1], state[2]) == fingerprint:
+                self.dimension = state[0]
+            elif not state or state[2] is None or not state[0]:
+                self._rebuild(cursor)
+            else:
+                self.dimension = state[0]
+                if not self._apply_changes(cursor, state[2] - SYNC_LOOKBACK):
+                    self._rebuild(cursor)
+            self._write_state(cursor, fingerprint)
+            self._fingerprint = fingerprint
+
+    def _apply_changes(self, cursor, since) -> bool:
+        """增量同步，出现维度变化时返回False由调用方全量重建"""
+        live_ids = set(self._rows(self._queryset()).values_list('id', flat=True))
+        cursor.execute(f"SELECT knowledge_id FROM {self.table}")
+        stored_ids = {row[0] for row in cursor.fetchall()}
+        missing = live_ids - stored_ids
+        written, skipped = self._upsert(
+            cursor, self._rows(self._queryset().filter(updated_at__gte=since))
+        )
+        if skipped:
+            return False
+        if missing:
+            written_missing, skipped = self._upsert(
+                cursor, self._rows(self._queryset().filter(id__in=list(missing)))
+            )
+            if skipped:
+                return False
+            written += written_missing
+        removed = list(stored_ids - live_ids)
+        if removed:
+            cursor.execute(f"DELETE FROM {self.table} WHERE knowledge_id = ANY(%s)", [removed])
+        logger.info(
+            f"增量同步向量模型 {self.embedding_model_id} 的 pgvector 表: "
+            f"更新 {written} 条, 移除 {len(removed)} 条"
+        )
+        return True
+
+    # ---- 检索 ----
+
+    def search(self, query_embedding, top_k: int, threshold: float) -> List[Tuple[int, str, float]]:
+        """返回相似度不低于阈值的前top_k条知识 (知识ID, 答案, 相似度)"""
+        if not self.dimension or top_k <= 0:
+            return []
+        query = normalize(query_embedding)
+        if query.shape[0] != self.dimension:
+            logger.warning(f"查询向量维度 {query.shape[0]} 与索引维度 {self.dimension} 不一致")
+            return []
+        literal = _vector_literal(query)
+        with transaction.atomic(using=self.alias), self.connection.cursor() as cursor:
+            if self.config['INDEX_TYPE'] == 'ivfflat':
+                cursor.execute(f"SET LOCAL ivfflat.probes = {int(self.config['IVFFLAT_PROBES'])}")
+            else:
+                cursor.execute(f"SET LOCAL hnsw.ef_search = {int(self.config['HNSW_EF_SEARCH'])}")
+            cursor.execute(
+                f"SELECT knowledge_id, answer, 1 - (embedding <=> %s::vector) AS score FROM {self.table}"
+                " ORDER BY embedding <=> %s::vector LIMIT %s",
+                [literal, literal, top_k]
+            )
+            rows = cursor.fetchall()
+        return [
+            (int(knowledge_id), answer, float(score))
+            for knowledge_id, answer, score in rows if score >= threshold
+        ]
+
+
+    def similarities(self, query_embedding, knowledge_ids: Sequence[int]) -> Dict[int, float]:
+        """计算指定知识与查询的相似度，不在表中的知识不返回"""
+        if not self.dimension or not knowledge_ids:
+            return {}
+        query = normalize(query_embedding)
+        if query.shape[0] != self.dimension:
+            return {}
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT knowledge_id, 1 - (embedding <=> %s::vector) FROM {self.table}"
+                " WHERE knowledge_id = ANY(%s)",
+                [_vector_literal(query), list(knowledge_ids)]
+            )
+            return {int(knowledge_id): float(score) for knowledge_id, score in cursor.fetchall()}
+
+_indexes: Dict[int, PgVectorIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_pgvector_index(embedding_model, config: dict) -> PgVectorIndex:
+    """获取（必要时创建并同步）该向量模型的 pgvector 索引"""
+    index = _indexes.get(embedding_model.pk)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.setdefault(embedding_model.pk, PgVectorIndex(embedding_model.pk, config))
+    index.sync()
+    return index
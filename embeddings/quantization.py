@@ -0,0 +1,88 @@
+"""知识向量的量化存储
+
+EmbeddingModel.vector_precision 为 float16 或 int8 时，发布知识向量时在 float32 文件之外额外写出量化矩阵：
+
+- float16：逐元素转换，大小为 float32 的一半
+- int8：每个向量按自身最大绝对值缩放到 [-127, 127]，另存每行的缩放系数，大小约为四分之一
+
+检索分两步：先在量化矩阵上计算近似相似度取出 top_k * RESCORE_FACTOR 个候选，
+再用原始精度（float32 文件，只读取候选行）重新计算并排序。
+float32 文件仍然发布（重排需要它），磁盘占用因此增加一半或四分之一；减少的只是常驻内存：
+检索时扫描的是量化矩阵，float32 文件中未被读取的页不会进入页缓存。
+NumPy 没有 float16/int8 的矩阵乘法加速，量化矩阵需分块转换为 float32 后计算：
+int8 全量扫描与 float32 相近；NumPy 自带的 float16 转换很慢，这里改用整数位运算转换，
+全量扫描仍约为 float32 的3倍耗时。float16 是以检索速度换内存，知识很多时应与ANN索引一起使用。
+"""
+from typing import Dict, Optional
+
+import numpy as np
+
+PRECISION_CHOICES = [
+    ('float32', 'float32（原始精度）'),
+    ('float16', 'float16（常驻内存约1/2，全量扫描约慢3倍）'),
+    ('int8', 'int8（按向量缩放，常驻内存约1/4）'),
+]
+
+# 分块转换为 float32 后再做矩阵乘法，限制临时内存
+SCORE_BATCH_SIZE = 1024
+
+# float16 的指数偏置为15，float32 为127：指数位对齐后乘以 2**112 即为原值（含非规格化数）
+_FLOAT16_EXPONENT_SCALE = np.float32(2.0 ** 112)
+# 清除符号扩展带入 float32 指数高3位的1，保留符号位
+_FLOAT16_SIGN_EXTENSION_MASK = np.int32(-0x70000001)  # 0x8FFFFFFF
+
+
+def quantize(matrix: np.ndarray, precision: str) -> Dict[str, np.ndarray]:
+    """返回需要随知识向量一起发布的量化数组，float32 时为空"""
+    if precision == 'float16':
+        return {'quantized': np.asarray(matrix, dtype=np.float16)}
+    if precision == 'int8':
+        scales = np.abs(matrix).max(axis=1, initial=0.0).astype(np.float32) / 127
+        scales[scales == 0] = 1.0
+        quantized = np.empty(matrix.shape, dtype=np.int8)
+        for start in range(0, len(matrix), SCORE_BATCH_SIZE):
+            batch = np.asarray(matrix[start:start + SCORE_BATCH_SIZE], dtype=np.float32)
+            quantized[start:start + len(batch)] = np.rint(batch / scales[start:start + len(batch), None])
+        return {'quantized': quantized, 'scales': scales}
+    return {}
+
+
+def precision_of(quantized: Optional[np.ndarray]) -> str:
+    if quantized is None:
+        return 'float32'
+    return 'float16' if quantized.dtype == np.float16 else 'int8'
+
+
+def _upcast_float16(batch: np.ndarray, out: np.ndarray) -> None:
+    """把 float16 块逐位精确地转换为 float32 写入 out（不含 inf/nan，向量中不会出现）
+
+    按 int16 读出并带符号扩展左移13位，符号位落在 float32 的符号位、指数与尾数对齐，
+    再清除扩展出的指数高位并乘以 2**112 修正指数偏置。三次整数/浮点运算都有SIMD实现，
+    比 NumPy 的 float16 类型转换快约3倍。
+    """
+    bits = out.view(np.int32)
+    np.left_shift(batch.view(np.int16), 13, out=bits, dtype=np.int32)
+    np.bitwise_and(bits, _FLOAT16_SIGN_EXTENSION_MASK, out=bits)
+    np.multiply(out, _FLOAT16_EXPONENT_SCALE, out=out)
+
+
+def approximate_scores(quantized: np.ndarray, scales: Optional[np.ndarray],
+                       query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+    """在量化矩阵（或其中的 rows 行）上计算与查询的近似内积"""
+    size = len(quantized) if rows is None else len(rows)
+    scores = np.empty(size, dtype=np.float32)
+    buffer = np.empty((min(size, SCORE_BATCH_SIZE), quantized.shape[1]), dtype=np.float32)
+    for start in range(0, size, SCORE_BATCH_SIZE):
+        if rows is None:
+            batch = quantized[start:start + SCORE_BATCH_SIZE]
+        else:
+            batch = quantized[rows[start:start + SCORE_BATCH_SIZE]]
+        converted = buffer[:len(batch)]
+        if batch.dtype == np.float16:
+            _upcast_float16(batch, converted)
+        else:
+            np.copyto(converted, batch, casting='unsafe')
+        np.matmul(converted, query, out=scores[start:start + len(batch)])
+    if scales is not None:
+        scores *= scales if rows is None else scales[rows]
+    return scores
@@ -0,0 +1,179 @@
+"""知识检索的重排阶段
+
+应用配置了重排模型（AIModel，类型为 RERANK）时，向量检索先取出 rerank_candidates 条候选，
+再把查询与全部候选答案一次性发送到重排接口（Jina / BGE / 硅基流动兼容的 POST {api_url}/rerank），
+按相关性得分取前 max_knowledge_items 条且得分不低于 rerank_threshold 的知识。
+
+重排结果以 (重排接口地址与模型, 规范化后的查询, 候选知识ID与答案) 为键缓存，后端配置与查询向量缓存相同::
+
+    RERANK_CACHE = {
+        'BACKEND': 'sqlite',   # locmem / django / sqlite
+        'PATH': BASE_DIR / 'embedding_cache.sqlite3',
+        'TABLE': 'rerank_result',
+        'MAX_SIZE': 10000,
+        'TTL': 3600,
+    }
+
+重排接口出错时退回向量检索的顺序。
+"""
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from chat.clients import get_async_openai_client, get_openai_client
+
+from .cache import build_backend, normalize_query
+
+logger = logging.getLogger(__name__)
+
+Result = Tuple[int, str, float]
+
+
+def make_key(rerank_model, query: str, results: Sequence[Result]) -> str:
+    digest = hashlib.sha256()
+    digest.update(f"{rerank_model.api_url}\x00{rerank_model.name}\x00{normalize_query(query)}".encode('utf-8'))
+    for knowledge_id, answer, _ in results:
+        digest.update(f"\x00{knowledge_id}\x00{answer}".encode('utf-8'))
+    return 'rerank:' + digest.hexdigest()
+
+
+class RerankCache:
+    """重排得分缓存（按候选顺序保存的 float32 数组），记录当前进程的命中率"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        # 多个请求线程同时计数
+        self._stats_lock = threading.Lock()
+
+    def _count(self, hit: bool) -> None:
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str, size: int) -> Optional[np.ndarray]:
+        try:
+            cached = self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"读取重排缓存失败: {str(e)}")
+            cached = None
+        scores = None if cached is None else np.frombuffer(cached, dtype=np.float32)
+        if scores is None or len(scores) != size:
+            self._count(False)
+            return None
+        self._count(True)
+        return scores
+
+    def set(self, key: str, scores: np.ndarray) -> None:
+        try:
+            self.backend.set(key, np.asarray(scores, dtype=np.float32).tobytes())
+        except Exception as e:
+            logger.warning(f"写入重排缓存失败: {str(e)}")
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / total, 4) if total else 0.0,
+        }
+
+
+_cache: Optional[RerankCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_rerank_cache() -> RerankCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = {'TTL': 3600, **getattr(settings, 'RERANK_CACHE', {})}
+                _cache = RerankCache(build_backend(config, table='rerank_result'))
+    return _cache
+
+
+def uses_rerank(application) -> bool:
+    model = application.rerank_model
+    return bool(model and model.is_active)
+
+
+def _request_body(rerank_model, query: str, results: Sequence[Result]) -> dict:
+    return {
+        'model': rerank_model.name,
+        'query': query,
+        'documents': [answer for _, answer, _ in results],
+        'top_n': len(results),
+        'return_documents': False,
+    }
+
+
+def _scores(response, size: int) -> np.ndarray:
+    """把接口返回的 results（按 index 对应候选）整理为与候选顺序一致的得分数组"""
+    scores = np.full(size, -np.inf, dtype=np.float32)
+    for item in response.get('results', []):
+        scores[int(item['index'])] = float(item['relevance_score'])
+    return scores
+
+
+def _select(application, results: Sequence[Result], scores: np.ndarray) -> List[Result]:
+    order = np.argsort(-scores, kind='stable')[:application.max_knowledge_items]
+    return [
+        (results[i][0], results[i][1], float(scores[i]))
+        for i in order if scores[i] >= application.rerank_threshold
+    ]
+
+
+def _fallback(application, results: Sequence[Result]) -> List[Result]:
+    return list(results[:application.max_knowledge_items])
+
+
+def rerank_knowledge(application, query: str, results: Sequence[Result]) -> List[Result]:
+    """用应用的重排模型对向量检索候选重新排序，返回最终使用的知识"""
+    if not results or not uses_rerank(application):
+        return _fallback(application, results)
+    rerank_model = application.rerank_model
+    cache = get_rerank_cache()
+    key = make_key(rerank_model, query, results)
+    scores = cache.get(key, len(results))
+    if scores is None:
+        try:
+            client = get_openai_client(rerank_model.api_url, rerank_model.api_key)
+            response = client.post('/rerank', body=_request_body(rerank_model, query, results), cast_to=object)
+            scores = _scores(response, len(results))
+        except Exception as e:
+            logger.warning(f"重排失败，使用向量检索顺序: {str(e)}")
+            return _fallback(application, results)
+        cache.set(key, scores)
+    return _select(application, results, scores)
+
+
+async def arerank_knowledge(application, query: str, results: Sequence[Result]) -> List[Result]:
+    """rerank_knowledge 的异步版本，缓存读写放到线程中执行"""
+    if not results or not uses_rerank(application):
+        return _fallback(application, results)
+    rerank_model = application.rerank_model
+    cache = get_rerank_cache()
+    key = make_key(rerank_model, query, results)
+    scores = await asyncio.to_thread(cache.get, key, len(results))
+    if scores is None:
+        try:
+            client = get_async_openai_client(rerank_model.api_url, rerank_model.api_key)
+            response = await client.post('/rerank', body=_request_body(rerank_model, query, results), cast_to=object)
+            scores = _scores(response, len(results))
+        except Exception as e:
+            logger.warning(f"重排失败，使用向量检索顺序: {str(e)}")
+            return _fallback(application, results)
+        await asyncio.to_thread(cache.set, key, scores)
+    return _select(application, results, scores)
@@ -0,0 +1,228 @@
+"""向量生成相关服务"""
+import logging
+import threading
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from django.db import close_old_connections
+from django.utils import timezone
+from openai import AsyncOpenAI, OpenAI
+
+from chat.clients import get_async_openai_client, get_openai_client
+
+from .breaker import CircuitBreaker
+from .cache import get_query_cache
+from .index import get_knowledge_index
+from .lexical import get_lexical_index, lexical_config, reciprocal_rank_fusion
+from .models import EmbeddingModel, Knowledge
+from .rerank import uses_rerank
+
+logger = logging.getLogger(__name__)
+
+# 检索触发的后台补齐最短间隔（秒），向量接口不可用时避免每次检索都重试
+MISSING_EMBEDDINGS_INTERVAL = 60
+
+_backfill_lock = threading.Lock()
+_backfill_running = set()
+_backfill_pending = set()
+_backfill_checked = {}
+
+
+def get_embedding_client(embedding_model: EmbeddingModel) -> OpenAI:
+    """获取向量模型客户端（进程内复用连接池）"""
+    return get_openai_client(embedding_model.api_url, embedding_model.api_key)
+
+
+def get_async_embedding_client(embedding_model: EmbeddingModel) -> AsyncOpenAI:
+    """获取异步向量模型客户端（进程内复用连接池）"""
+    return get_async_openai_client(embedding_model.api_url, embedding_model.api_key)
+
+
+def _to_matrix(response) -> np.ndarray:
+    # 接口按index返回，不保证顺序
+    data = sorted(response.data, key=lambda item: item.index)
+    return np.asarray([item.embedding for item in data], dtype=np.float32)
+
+
+def _with_deadline(client, timeout: Optional[float]):
+    # 有时间预算时超时即失败、不再重试（连接池与原客户端共用）
+    return client.with_options(timeout=timeout, max_retries=0) if timeout else client
+
+
+def embed_texts(embedding_model: EmbeddingModel, texts: Sequence[str],
+                timeout: Optional[float] = None) -> np.ndarray:
+    """批量获取文本向量，返回形状为 (len(texts), dimension) 的float32矩阵"""
+    if not texts:
+        return np.empty((0, embedding_model.dimension), dtype=np.float32)
+    client = _with_deadline(get_embedding_client(embedding_model), timeout)
+    response = client.embeddings.create(
+        model=embedding_model.model_name,
+        input=list(texts)
+    )
+    return _to_matrix(response)
+
+
+async def aembed_texts(embedding_model: EmbeddingModel, texts: Sequence[str],
+                       timeout: Optional[float] = None) -> np.ndarray:
+    """embed_texts 的异步版本"""
+    if not texts:
+        return np.empty((0, embedding_model.dimension), dtype=np.float32)
+    client = _with_deadline(get_async_embedding_client(embedding_model), timeout)
+    response = await client.embeddings.create(
+        model=embedding_model.model_name,
+        input=list(texts)
+    )
+    return _to_matrix(response)
+
+
+def embed_query(embedding_model: EmbeddingModel, text: str, timeout: Optional[float] = None,
+                breaker: Optional[CircuitBreaker] = None) -> np.ndarray:
+    """获取单条查询文本的向量，相同模型下规范化后相同的查询直接命中缓存
+
+    timeout 为本次接口调用的超时（秒），用于对话的检索时间预算，超时时抛出异常。
+    传入 breaker 时只有未命中缓存、需要调用接口时才经过熔断器，熔断中抛出 CircuitOpenError。
+    """
+    def compute():
+        return embed_texts(embedding_model, [text], timeout)[0]
+
+    if breaker is not None:
+        return get_query_cache().get_or_compute(embedding_model, text, lambda: breaker.call(compute))
+    return get_query_cache().get_or_compute(embedding_model, text, compute)
+
+
+async def aembed_query(embedding_model: EmbeddingModel, text: str, timeout: Optional[float] = None,
+                       breaker: Optional[CircuitBreaker] = None) -> np.ndarray:
+    """embed_query 的异步版本"""
+    async def compute():
+        return (await aembed_texts(embedding_model, [text], timeout))[0]
+
+    if breaker is not None:
+        return await get_query_cache().aget_or_compute(embedding_model, text, lambda: breaker.acall(compute))
+    return await get_query_cache().aget_or_compute(embedding_model, text, compute)
+
+
+def refresh_knowledge_embeddings(embedding_model: EmbeddingModel,
+                                 items: Sequence[Knowledge],
+                                 batch_size: int = 32) -> List[Knowledge]:
+    """为给定知识生成问题向量并写回数据库"""
+    items = list(items)
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        vectors = embed_texts(embedding_model, [item.question for item in batch])
+        now = timezone.now()
+        for item, vector in zip(batch, vectors):
+            item.set_embedding(vector)
+            item.updated_at = now
+        # bulk_update不触发信号，避免重复生成；更新时间用于通知各进程的索引增量同步
+        Knowledge.objects.bulk_update(batch, ['embedding', 'updated_at'])
+        logger.info(f"已生成 {len(batch)} 条知识向量 (向量模型: {embedding_model.name})")
+    return items
+
+
+def ensure_knowledge_embeddings(embedding_model: EmbeddingModel) -> int:
+    """补齐尚未生成向量的有效知识（生成失败或向量模型变更后），返回补齐条数"""
+    missing_items = list(Knowledge.objects.filter(
+        model=embedding_model, is_valid=True, embedding__isnull=True
+    ).only('id', 'question'))
+    if missing_items:
+        refresh_knowledge_embeddings(embedding_model, missing_items)
+    return len(missing_items)
+
+
+def schedule_missing_embeddings(embedding_model: EmbeddingModel, force: bool = False) -> None:
+    """在后台线程中补齐缺失的知识向量，立即返回
+
+    检索触发时同一向量模型每 MISSING_EMBEDDINGS_INTERVAL 秒最多一次；
+    force 用于知识或向量模型保存后，不受间隔限制，补齐正在进行时会在其结束后再补一轮。
+    """
+    now = time.monotonic()
+    with _backfill_lock:
+        if embedding_model.pk in _backfill_running:
+            if force:
+                _backfill_pending.add(embedding_model.pk)
+            return
+        last = _backfill_checked.get(embedding_model.pk, -MISSING_EMBEDDINGS_INTERVAL)
+        if not force and now - last < MISSING_EMBEDDINGS_INTERVAL:
+            return
+        _backfill_running.add(embedding_model.pk)
+        _backfill_checked[embedding_model.pk] = now
+
+    def run():
+        try:
+            while True:
+                try:
+                    filled = ensure_knowledge_embeddings(embedding_model)
+                    if filled:
+                        logger.info(f"后台补齐知识向量 {filled} 条 (向量模型: {embedding_model.name})")
+                except Exception as e:
+                    logger.warning(f"后台补齐知识向量失败 (向量模型: {embedding_model.name}): {str(e)}")
+                with _backfill_lock:
+                    if embedding_model.pk not in _backfill_pending:
+                        _backfill_running.discard(embedding_model.pk)
+                        return
+                    _backfill_pending.discard(embedding_model.pk)
+        finally:
+            close_old_connections()
+
+    threading.Thread(target=run, name=f'knowledge-backfill-{embedding_model.pk}', daemon=True).start()
+
+
+def _result_count(application) -> int:
+    """检索返回的条数；配置了重排模型时取出 rerank_candidates 条候选，由 rerank.rerank_knowledge 截取"""
+    if uses_rerank(application):
+        return max(application.max_knowledge_items, application.rerank_candidates)
+    return application.max_knowledge_items
+
+
+def search_lexical(application, query: str, top_k: int = 0) -> List[Tuple[int, str, float]]:
+    """关键词检索 (知识ID, 答案, 查询词元覆盖率)，关键词索引不可用时为空"""
+    index = get_lexical_index(application.embedding_model)
+    if index is None:
+        return []
+    return index.search(query, top_k or _result_count(application))
+
+
+def direct_answer(application, results) -> Optional[Tuple[int, str, float]]:
+    """向量检索最相似的知识达到应用的直接回答阈值时返回该知识，否则为None"""
+    threshold = application.direct_answer_threshold
+    if threshold is None or not results or results[0][2] < threshold:
+        return None
+    return results[0]
+
+
+def match_knowledge(application, query_embedding, query: str = ''):
+    """检索相关知识，返回 (知识列表, 可直接作为回答的知识或None)
+
+    知识列表为 (知识ID, 答案, 相似度)，按应用的阈值与条数限制过滤。
+    检索本身只读，缺失的知识向量由后台线程补齐，补齐前这些知识不参与检索。
+    应用检索方式为 hybrid 且提供了查询文本时，与关键词检索结果按 RRF 融合排序，得分仍为向量相似度；
+    只被关键词命中的知识需向量相似度不低于 KNOWLEDGE_LEXICAL['MIN_SIMILARITY']。
+    直接回答只看向量检索的相似度：命中时不再做关键词检索与融合。
+    """
+    embedding_model = application.embedding_model
+    schedule_missing_embeddings(embedding_model)
+    index = get_knowledge_index(embedding_model)
+    top_k = _result_count(application)
+    if not query or application.retrieval_strategy != 'hybrid':
+        results = index.search(query_embedding, top_k=top_k, threshold=application.knowledge_similarity_threshold)
+        return results, direct_answer(application, results)
+    config = lexical_config()
+    candidates = max(top_k, config['CANDIDATES'])
+    results = index.search(query_embedding, top_k=candidates, threshold=application.knowledge_similarity_threshold)
+    direct = direct_answer(application, results)
+    if direct is not None:
+        return results[:top_k], direct
+    lexical = search_lexical(application, query, candidates)
+    similarity = {knowledge_id: score for knowledge_id, _, score in results}
+    lexical_only = [knowledge_id for knowledge_id, _, _ in lexical if knowledge_id not in similarity]
+    similarity.update(index.similarities(query_embedding, lexical_only))
+    # 关键词命中但语义无关（或尚无向量）的知识不参与融合
+    lexical = [item for item in lexical if similarity.get(item[0], -1.0) >= config['MIN_SIMILARITY']]
+    fused = reciprocal_rank_fusion([results, lexical], config['RRF_K'])
+    return [(knowledge_id, answer, similarity[knowledge_id]) for knowledge_id, answer, _ in fused[:top_k]], None
+
+
+def search_knowledge(application, query_embedding, query: str = '') -> List[Tuple[int, str, float]]:
+    """按应用的阈值与条数限制检索相关知识 (知识ID, 答案, 相似度)，见 match_knowledge"""
+    return match_knowledge(application, query_embedding, query)[0]
@@ -1,3 +1,1070 @@
-from django.test import TestCase
+import asyncio
+import importlib.util
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import services
+from .ann import AnnMapping, IVFIndex, build_ivf, list_count
+from .cache import LocMemBackend, QueryEmbeddingCache, SQLiteBackend, make_key
+from .importer import JOB_STALE_AFTER, fail_stale_import_jobs, import_knowledge, run_import_job
+from .filestore import KEEP_GENERATIONS, GenerationStore
+from .index import AnswerTable, KnowledgeIndex, get_knowledge_index, normalize, store_config
+from .lexical import (
+    LexicalIndex, fts5_available, get_lexical_index, match_expression, reciprocal_rank_fusion, sync_lexical_index,
+    tokenize
+)
+from .models import EmbeddingModel, Knowledge, KnowledgeImport
+from .pgvector import PgVectorIndex, _vector_literal
+from .quantization import _upcast_float16, approximate_scores, quantize
+from .rerank import RerankCache, arerank_knowledge, rerank_knowledge
+from .services import aembed_query, search_knowledge, embed_query, ensure_knowledge_embeddings, schedule_missing_embeddings
+
+
+def fake_vectors(embedding_model, texts, *args, **kwargs):
+    """按文本长度生成确定的向量，代替向量接口"""
+    return np.asarray([[len(text)] + [1] * (embedding_model.dimension - 1) for text in texts], dtype=np.float32)
+
+
+def clustered_vectors(size, dimension, clusters, seed=0):
+    """围绕若干中心分布的归一化向量，接近真实知识库中问题向量成簇的情况"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension))
+    labels = rng.integers(clusters, size=size)
+    return normalize(centers[labels] + 0.4 * rng.standard_normal((size, dimension)))
+
+
+def nearby_queries(matrix, count, seed=1):
+    """在知识向量附近取查询向量"""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(matrix), count, replace=False)
+    return normalize(matrix[rows] + 0.1 * rng.standard_normal((count, matrix.shape[1])))
+
+
+def exact_top(matrix, query, top_k):
+    return np.argsort(-(matrix @ query), kind='stable')[:top_k]
+
+
+def add_knowledge(embedding_model, question, vector, **fields):
+    knowledge = Knowledge(question=question, answer=fields.pop('answer', f'{question}的答案'), model=embedding_model, **fields)
+    knowledge.set_embedding(vector)
+    knowledge.save()
+    return knowledge
+
+
+class KnowledgeEmbeddingSignalTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch('embeddings.services.schedule_missing_embeddings')
+        self.schedule = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.embedding_model = EmbeddingModel.objects.create(
+            name='emb', model_name='bge', api_url='http://embeddings.local/v1/', dimension=4
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.knowledge = Knowledge.objects.create(question='如何退款', answer='七天内可退', model=self.embedding_model)
+        self.knowledge.set_embedding([1, 0, 0, 0])
+        Knowledge.objects.filter(pk=self.knowledge.pk).update(embedding=self.knowledge.embedding)
+        self.schedule.reset_mock()
+
+    def save(self, instance):
+        with self.captureOnCommitCallbacks(execute=True):
+            instance.save()
+
+    def stored_embedding(self):
+        return Knowledge.objects.get(pk=self.knowledge.pk).get_embedding()
+
+    def test_new_knowledge_is_embedded_in_background_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            Knowledge.objects.create(question='如何开票', answer='联系客服', model=self.embedding_model)
+        self.schedule.assert_not_called()
+        for callback in callbacks:
+            callback()
+        self.schedule.assert_called_once_with(self.embedding_model, force=True)
+
+    def test_question_change_clears_embedding(self):
+        self.knowledge.question = '怎么退款'
+        self.save(self.knowledge)
+        self.assertIsNone(self.stored_embedding())
+        self.schedule.assert_called_once()
+
+    def test_answer_change_keeps_embedding(self):
+        self.knowledge.answer = '十五天内可退'
+        self.save(self.knowledge)
+        np.testing.assert_array_equal(self.stored_embedding(), [1, 0, 0, 0])
+        self.schedule.assert_not_called()
+
+    def test_raw_save_does_not_schedule(self):
+        # loaddata 以 raw 方式保存，不应调用向量接口
+        now = timezone.now()
+        knowledge = Knowledge(question='导入的问题', answer='导入的答案', model=self.embedding_model,
+                              created_at=now, updated_at=now)
+        with self.captureOnCommitCallbacks(execute=True):
+            knowledge.save_base(raw=True)
+        self.schedule.assert_not_called()
+
+    def test_vector_field_change_clears_all_embeddings(self):
+        for field, value in (('model_name', 'bge-m3'), ('api_url', 'http://other.local/v1/'), ('dimension', 8)):
+            with self.subTest(field=field):
+                Knowledge.objects.filter(pk=self.knowledge.pk).update(embedding=self.knowledge.embedding)
+                self.schedule.reset_mock()
+                setattr(self.embedding_model, field, value)
+                self.save(self.embedding_model)
+                self.assertIsNone(self.stored_embedding())
+                self.schedule.assert_called_once_with(self.embedding_model, force=True)
+
+    def test_other_field_change_keeps_embeddings(self):
+        self.embedding_model.name = '新名称'
+        self.embedding_model.description = '说明'
+        self.save(self.embedding_model)
+        np.testing.assert_array_equal(self.stored_embedding(), [1, 0, 0, 0])
+        self.schedule.assert_not_called()
+
+
+class EnsureEmbeddingsTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch('embeddings.services.schedule_missing_embeddings')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.embedding_model = EmbeddingModel.objects.create(
+            name='emb', model_name='bge', api_url='http://embeddings.local/v1/', dimension=4
+        )
+        Knowledge.objects.create(question='问', answer='答', model=self.embedding_model)
+        Knowledge.objects.create(question='问题二', answer='答', model=self.embedding_model)
+        Knowledge.objects.create(question='已失效', answer='答', model=self.embedding_model, is_valid=False)
+
+    @mock.patch('embeddings.services.embed_texts', side_effect=fake_vectors)
+    def test_fills_only_missing_valid_knowledge(self, embed_texts):
+        self.assertEqual(ensure_knowledge_embeddings(self.embedding_model), 2)
+        embed_texts.assert_called_once()
+        stored = {item.question: item.get_embedding() for item in Knowledge.objects.all()}
+        self.assertEqual(stored['问题二'][0], 3)
+        self.assertIsNone(stored['已失效'])
+        self.assertEqual(ensure_knowledge_embeddings(self.embedding_model), 0)
+        embed_texts.assert_called_once()
+
+
+class ScheduleMissingEmbeddingsTests(SimpleTestCase):
+    def setUp(self):
+        for name, value in (('_backfill_running', set()), ('_backfill_pending', set()), ('_backfill_checked', {})):
+            patcher = mock.patch.object(services, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.embedding_model = EmbeddingModel(pk=1, name='emb')
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+        def ensure(embedding_model):
+            self.calls += 1
+            self.started.set()
+            self.release.wait(5)
+            return 0
+
+        patcher = mock.patch('embeddings.services.ensure_knowledge_embeddings', side_effect=ensure)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def wait_idle(self):
+        for _ in range(500):
+            with services._backfill_lock:
+                if not services._backfill_running:
+                    return
+            threading.Event().wait(0.01)
+        self.fail('后台补齐未结束')
+
+    def test_retrieval_triggered_backfill_runs_at_most_once_per_interval(self):
+        self.release.set()
+        schedule_missing_embeddings(self.embedding_model)
+        self.wait_idle()
+        schedule_missing_embeddings(self.embedding_model)
+        self.wait_idle()
+        self.assertEqual(self.calls, 1)
+
+    def test_forced_backfill_runs_again_after_the_current_one(self):
+        schedule_missing_embeddings(self.embedding_model)
+        self.assertTrue(self.started.wait(5))
+        # 补齐进行中又保存了知识：当前一轮可能没读到新知识，结束后再补一轮
+        schedule_missing_embeddings(self.embedding_model, force=True)
+        schedule_missing_embeddings(self.embedding_model, force=True)
+        self.release.set()
+        self.wait_idle()
+        self.assertEqual(self.calls, 2)
+
+
+class KnowledgeIndexSyncTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict('embeddings.index._indexes', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.embedding_model = EmbeddingModel.objects.create(
+            name='emb', model_name='bge', api_url='http://embeddings.local/v1/', dimension=4
+        )
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        override = override_settings(KNOWLEDGE_VECTOR_STORE={'BACKEND': 'memory', 'DIRECTORY': directory})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.refund = add_knowledge(self.embedding_model, '如何退款', [1, 0, 0, 0])
+        self.invoice = add_knowledge(self.embedding_model, '如何开票', [0, 1, 0, 0])
+        self.index = get_knowledge_index(self.embedding_model)
+
+    def search(self, vector, top_k=5, threshold=0.5):
+        return get_knowledge_index(self.embedding_model).search(np.asarray(vector, dtype=np.float32), top_k, threshold)
+
+    def test_search_orders_by_similarity_and_applies_threshold(self):
+        add_knowledge(self.embedding_model, '退款多久到账', [1, 1, 0, 0])
+        results = self.search([2, 0.1, 0, 0])
+        self.assertEqual([answer for _, answer, _ in results], ['如何退款的答案', '退款多久到账的答案'])
+        self.assertAlmostEqual(results[0][2], 0.9988, places=3)
+        self.assertEqual(len(self.search([2, 0.1, 0, 0], top_k=1)), 1)
+        self.assertEqual(self.search([0, 0, 1, 0]), [])
+
+    def test_changes_are_applied_incrementally(self):
+        with mock.patch.object(KnowledgeIndex, '_load', autospec=True, side_effect=KnowledgeIndex._load) as load:
+            self.refund.answer = '七天内可退'
+            self.refund.save()
+            self.assertEqual(self.search([1, 0, 0, 0])[0][1], '七天内可退')
+
+            shipping = add_knowledge(self.embedding_model, '多久发货', [0, 0, 1, 0])
+            self.assertEqual(self.search([0, 0, 1, 0])[0][0], shipping.pk)
+
+            self.invoice.is_valid = False
+            self.invoice.save()
+            self.assertEqual(self.search([0, 1, 0, 0]), [])
+
+            shipping.delete()
+            self.assertEqual(self.search([0, 0, 1, 0]), [])
+            load.assert_not_called()
+        self.assertEqual(sorted(self.index.ids.tolist()), [self.refund.pk])
+
+    def test_vectors_generated_later_join_the_index(self):
+        pending = Knowledge.objects.create(question='如何改地址', answer='联系客服', model=self.embedding_model)
+        self.assertEqual(self.search([0, 0, 0, 1]), [])
+        with mock.patch('embeddings.services.embed_texts', return_value=np.asarray([[0, 0, 0, 1]], dtype=np.float32)):
+            ensure_knowledge_embeddings(self.embedding_model)
+        self.assertEqual(self.search([0, 0, 0, 1])[0][0], pending.pk)
+
+    def test_unchanged_index_skips_reload(self):
+        with mock.patch.object(KnowledgeIndex, '_apply_changes') as apply_changes:
+            self.search([1, 0, 0, 0])
+        apply_changes.assert_not_called()
+
+
+class LexicalTokenizeTests(SimpleTestCase):
+    def test_cjk_runs_become_bigrams(self):
+        self.assertEqual(tokenize('退款政策'), ['退款', '款政', '政策'])
+        self.assertEqual(tokenize('你好，世界!'), ['你好', '世界'])
+
+    def test_single_cjk_char_and_latin_runs_are_kept(self):
+        self.assertEqual(tokenize('买 iPhone15'), ['买', 'iphone15'])
+        self.assertEqual(tokenize('Ｘ200 说明书'), ['x200', '说明', '明书'])
+
+    def test_match_expression_quotes_unique_tokens(self):
+        self.assertEqual(match_expression(['x200', '保修', 'x200']), '"x200" OR "保修"')
+
+
+class ReciprocalRankFusionTests(SimpleTestCase):
+    def test_scores_sum_reciprocal_ranks(self):
+        vector = [(1, 'a', 0.9), (2, 'b', 0.8)]
+        lexical = [(2, 'b', 1.0), (3, 'c', 0.5)]
+        fused = reciprocal_rank_fusion([vector, lexical], k=60)
+        self.assertEqual([item[0] for item in fused], [2, 1, 3])
+        self.assertAlmostEqual(fused[0][2], 1 / 62 + 1 / 61)
+        self.assertAlmostEqual(fused[1][2], 1 / 61)
+        self.assertAlmostEqual(fused[2][2], 1 / 62)
+
+    def test_smaller_k_favours_top_ranks(self):
+        vector = [(knowledge_id, str(knowledge_id), 0.9) for knowledge_id in range(1, 7)]
+        lexical = [(7, '7', 1.0), (8, '8', 1.0), (6, '6', 1.0)]
+        # 两路都命中但名次靠后：k 大时胜过单路第一，k 小时不如
+        self.assertEqual(reciprocal_rank_fusion([vector, lexical], k=60)[0][0], 6)
+        self.assertEqual([item[0] for item in reciprocal_rank_fusion([vector, lexical], k=1)[:2]], [1, 7])
+
+
+class LexicalSearchTests(TestCase):
+    def setUp(self):
+        from chat.models import Application
+        for target in ('embeddings.lexical._indexes', 'embeddings.index._indexes'):
+            patcher = mock.patch.dict(target, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for target, value in (('embeddings.lexical._fts5_available', None),
+                              ('embeddings.services.schedule_missing_embeddings', mock.DEFAULT)):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        if not fts5_available():
+            self.skipTest('SQLite 不支持 FTS5')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        override = override_settings(KNOWLEDGE_VECTOR_STORE={'BACKEND': 'memory', 'DIRECTORY': directory})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.embedding_model = EmbeddingModel.objects.create(
+            name='emb', model_name='bge', api_url='http://embeddings.local/v1/', dimension=4
+        )
+        self.warranty = add_knowledge(self.embedding_model, 'X200 的保修期', [1, 0, 0, 0])
+        self.manual = add_knowledge(self.embedding_model, 'X200 说明书下载', [0.6, 0.8, 0, 0])
+        self.parts = add_knowledge(self.embedding_model, 'X200 配件价格', [0, 0, 1, 0])
+        self.refund = add_knowledge(self.embedding_model, '如何退款', [0.99, 0.1, 0, 0])
+        self.assertTrue(sync_lexical_index(self.embedding_model))
+        self.application = Application(
+            name='app', embedding_model=self.embedding_model, retrieval_strategy='hybrid',
+            knowledge_similarity_threshold=0.7, max_knowledge_items=3
+        )
+
+    def test_search_filters_by_token_overlap(self):
+        index = get_lexical_index(self.embedding_model)
+        results = index.search('X200 保修期', 10)
+        self.assertEqual(results[0][:2], (self.warranty.pk, self.warranty.answer))
+        self.assertEqual(results[0][2], 1.0)
+        self.assertEqual({item[0] for item in results[1:]}, {self.manual.pk, self.parts.pk})
+        self.assertEqual(index.search('退款', 10)[0][0], self.refund.pk)
+        self.assertEqual(index.search('发票', 10), [])
+
+    def test_hybrid_fuses_by_rank_and_reports_vector_similarity(self):
+        results = search_knowledge(self.application, np.asarray([1, 0, 0, 0], dtype=np.float32), 'X200 保修期')
+        # 向量：保修期、退款；关键词：保修期、说明书（相似度0.6），配件价格与查询向量正交被截掉
+        self.assertEqual([item[0] for item in results], [self.warranty.pk, self.refund.pk, self.manual.pk])
+        self.assertAlmostEqual(results[0][2], 1.0, places=5)
+        self.assertAlmostEqual(results[2][2], 0.6, places=5)
+
+    def test_lexical_only_hits_below_min_similarity_are_dropped(self):
+        with override_settings(KNOWLEDGE_LEXICAL={'MIN_SIMILARITY': 0.7}):
+            results = search_knowledge(self.application, np.asarray([1, 0, 0, 0], dtype=np.float32), 'X200 保修期')
+        self.assertEqual([item[0] for item in results], [self.warranty.pk, self.refund.pk])
+
+    def test_vector_strategy_ignores_lexical(self):
+        self.application.retrieval_strategy = 'vector'
+        results = search_knowledge(self.application, np.asarray([1, 0, 0, 0], dtype=np.float32), 'X200 保修期')
+        self.assertEqual([item[0] for item in results], [self.warranty.pk, self.refund.pk])
+
+    def test_request_path_never_writes(self):
+        invoice = add_knowledge(self.embedding_model, '如何开发票', [0, 0, 0, 1])
+        with mock.patch.object(LexicalIndex, 'schedule_sync') as schedule_sync, \
+                CaptureQueriesContext(connection) as queries:
+            index = get_lexical_index(self.embedding_model)
+            results = index.search('开发票', 10)
+        # 落后的索引照常使用，同步交给后台
+        schedule_sync.assert_called_once_with()
+        self.assertEqual(results, [])
+        self.assertFalse([query['sql'] for query in queries.captured_queries
+                          if query['sql'].lstrip().upper().startswith(('INSERT', 'UPDATE', 'DELETE'))])
+
+        index.sync()
+        self.assertEqual(index.search('开发票', 10)[0][0], invoice.pk)
+        invoice.delete()
+        index.sync()
+        self.assertEqual(index.search('开发票', 10), [])
+
+    def test_unbuilt_index_is_not_used(self):
+        other = EmbeddingModel.objects.create(
+            name='emb2', model_name='bge', api_url='http://embeddings.local/v1/', dimension=4
+        )
+        add_knowledge(other, 'X200 的保修期', [1, 0, 0, 0])
+        with mock.patch.object(LexicalIndex, 'schedule_sync') as schedule_sync:
+            self.assertIsNone(get_lexical_index(other))
+        schedule_sync.assert_called_once_with()
+
+
+class QueryEmbeddingCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = QueryEmbeddingCache(LocMemBackend())
+        patcher = mock.patch('embeddings.cache._cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.embedding_model = EmbeddingModel(
+            pk=1, name='emb', model_name='bge', api_url='http://embeddings.local/v1/', dimension=4
+        )
+
+    @mock.patch('embeddings.services.embed_texts', side_effect=fake_vectors)
+    def test_normalized_query_hits_cache(self, embed_texts):
+        first = embed_query(self.embedding_model, '如何退款？')
+        second = embed_query(self.embedding_model, '  如何退款? ')
+        embed_texts.assert_called_once()
+        np.testing.assert_array_equal(first, second)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_async_query_shares_the_cache(self):
+        async def embed(embedding_model, texts, *args):
+            return fake_vectors(embedding_model, texts)
+
+        with mock.patch('embeddings.services.embed_texts', side_effect=fake_vectors) as embed_texts, \
+                mock.patch('embeddings.services.aembed_texts', side_effect=embed) as aembed_texts:
+            first = asyncio.run(aembed_query(self.embedding_model, '如何退款'))
+            second = embed_query(self.embedding_model, '如何退款')
+        aembed_texts.assert_called_once()
+        embed_texts.assert_not_called()
+        np.testing.assert_array_equal(first, second)
+
+    def test_key_covers_endpoint_model_and_dimension(self):
+        key = make_key('http://a/v1/', 'bge', 4, 'Hello  World')
+        self.assertEqual(key, make_key('http://a/v1/', 'bge', 4, 'hello world'))
+        self.assertNotEqual(key, make_key('http://b/v1/', 'bge', 4, 'hello world'))
+        self.assertNotEqual(key, make_key('http://a/v1/', 'bge-m3', 4, 'hello world'))
+        self.assertNotEqual(key, make_key('http://a/v1/', 'bge', 8, 'hello world'))
+
+    @mock.patch('embeddings.services.embed_texts', side_effect=fake_vectors)
+    def test_other_endpoint_misses_cache(self, embed_texts):
+        embed_query(self.embedding_model, '如何退款')
+        self.embedding_model.api_url = 'http://other.local/v1/'
+        embed_query(self.embedding_model, '如何退款')
+        self.assertEqual(embed_texts.call_count, 2)
+
+    def test_failed_compute_is_not_cached(self):
+        with self.assertRaises(RuntimeError):
+            self.cache.get_or_compute(self.embedding_model, '问题', mock.Mock(side_effect=RuntimeError))
+        vector = self.cache.get_or_compute(self.embedding_model, '问题', lambda: np.ones(4))
+        np.testing.assert_array_equal(vector, np.ones(4))
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_counters_are_exact_under_concurrency(self):
+        self.cache.get_or_compute(self.embedding_model, '问题', lambda: np.ones(4))
+
+        def lookups():
+            for _ in range(500):
+                self.cache.get_or_compute(self.embedding_model, '问题', lambda: np.ones(4))
+
+        threads = [threading.Thread(target=lookups) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.cache.stats()['hits'], 8 * 500)
+
+    def test_locmem_evicts_least_recently_used_and_expired(self):
+        backend = LocMemBackend(max_size=2, ttl=60)
+        backend.set('a', b'1')
+        backend.set('b', b'2')
+        backend.get('a')
+        backend.set('c', b'3')
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), b'1')
+        with mock.patch('embeddings.cache.time.time', return_value=10 ** 12):
+            self.assertIsNone(backend.get('a'))
+
+    def test_sqlite_backend_is_shared_between_instances(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        path = f'{directory}/cache.sqlite3'
+        SQLiteBackend(path=path).set('key', np.ones(4, dtype=np.float32).tobytes())
+        other = SQLiteBackend(path=path)
+        np.testing.assert_array_equal(np.frombuffer(other.get('key'), dtype=np.float32), np.ones(4))
+        self.assertIsNone(other.get('missing'))
+
+
+class FakeEmbeddings:
+    """代替向量接口：记录每次调用的文本，按问题注入失败次数"""
+
+    def __init__(self, dimension, failures=None, delay=0):
+        self.dimension = dimension
+        self.failures = dict(failures or {})
+        self.delay = delay
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, embedding_model, texts, timeout=None):
+        with self._lock:
+            self.calls.append(list(texts))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            failing = [text for text in texts if self.failures.get(text)]
+            for text in failing:
+                self.failures[text] -= 1
+        try:
+            # 不用 time.sleep：测试中它被替换以跳过重试等待
+            threading.Event().wait(self.delay)
+            if failing:
+                raise RuntimeError(f"向量接口出错: {failing[0]}")
+            return np.ones((len(texts), self.dimension), dtype=np.float32)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+class ImporterTests(TestCase):
+
+    def setUp(self):
+        self.embedding_model = EmbeddingModel.objects.create(
+            name='emb', model_name='bge', api_url='http://embedding.invalid/v1', api_key='k', dimension=4
+        )
+        self.records = [(f'q{i}', f'a{i}') for i in range(10)]
+        sleep = mock.patch('embeddings.importer.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def run_import(self, fake, records=None, **kwargs):
+        with mock.patch('embeddings.importer.embed_texts', fake):
+            return import_knowledge(self.embedding_model, records or self.records, **kwargs)
+
+    def test_batches_respect_size_and_concurrency(self):
+        fake = FakeEmbeddings(4, delay=0.02)
+        result = self.run_import(fake, batch_size=4, concurrency=2)
+        self.assertEqual(sorted(len(call) for call in fake.calls), [2, 4, 4])
+        self.assertLessEqual(fake.max_in_flight, 2)
+        self.assertEqual((result.created, result.embedded, result.failed_batches), (10, 10, 0))
+        self.assertEqual(Knowledge.objects.filter(model=self.embedding_model, embedding__isnull=False).count(), 10)
+
+    def test_skips_existing_and_repeated_questions(self):
+        Knowledge.objects.bulk_create([Knowledge(question='q0', answer='old', model=self.embedding_model)])
+        result = self.run_import(FakeEmbeddings(4), self.records + [('q1', 'again')], batch_size=4)
+        self.assertEqual((result.created, result.skipped), (9, 2))
+        self.assertEqual(Knowledge.objects.get(question='q0').answer, 'old')
+        self.assertEqual(Knowledge.objects.get(question='q1').answer, 'a1')
+
+    def test_failed_batch_is_retried(self):
+        fake = FakeEmbeddings(4, failures={'q5': 2})
+        result = self.run_import(fake, batch_size=4, concurrency=1, max_retries=3)
+        self.assertEqual(len(fake.calls), 3 + 2)
+        self.assertEqual(self.sleep.call_count, 2)
+        # 指数退避
+        first, second = (call.args[0] for call in self.sleep.call_args_list)
+        self.assertLess(first, 1.5)
+        self.assertGreaterEqual(second, 1.0)
+        self.assertEqual((result.created, result.embedded, result.failed_batches), (10, 10, 0))
+
+    def test_batch_failing_after_retries_is_saved_without_vectors(self):
+        fake = FakeEmbeddings(4, failures={'q5': 10})
+        result = self.run_import(fake, batch_size=4, concurrency=2, max_retries=1)
+        self.assertEqual((result.created, result.embedded, result.failed_batches), (10, 6, 1))
+        self.assertIn('q5', result.errors[0])
+        self.assertEqual(
+            sorted(Knowledge.objects.filter(embedding__isnull=True).values_list('question', flat=True)),
+            ['q4', 'q5', 'q6', 'q7']
+        )
+
+
+class ImportJobTests(TransactionTestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.embedding_model = EmbeddingModel.objects.create(
+            name='emb', model_name='bge', api_url='http://embedding.invalid/v1', api_key='k', dimension=4
+        )
+
+    def create_job(self, content, file_format):
+        return KnowledgeImport.objects.create(
+            model=self.embedding_model, file=ContentFile(content.encode('utf-8'), name=f'k.{file_format}'),
+            file_format=file_format, batch_size=2, concurrency=1
+        )
+
+    def test_progress_is_written_after_each_batch(self):
+        job = self.create_job('question,answer\nq1,a1\nq2,a2\nq3,a3\n,空问题\n', 'csv')
+        seen = []
+        fake = FakeEmbeddings(4)
+
+        def embed(embedding_model, texts, timeout=None):
+            seen.append(KnowledgeImport.objects.values_list('status', 'created').get(pk=job.pk))
+            return fake(embedding_model, texts)
+
+        with mock.patch('embeddings.importer.embed_texts', embed):
+            run_import_job(job.pk)
+        self.assertEqual(seen, [('running', 0), ('running', 2)])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.created, job.embedded), ('done', 3, 3))
+        self.assertTrue(job.message)
+
+    def test_failed_job_records_error(self):
+        job = self.create_job('{"question": "q1", "answer": "a1"}\nnot json\n', 'jsonl')
+        with mock.patch('embeddings.importer.embed_texts', FakeEmbeddings(4)), self.assertRaises(ValueError):
+            run_import_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertTrue(job.message)
+
+    def test_jobs_left_by_exited_process_are_marked_failed(self):
+        running = self.create_job('question,answer\nq1,a1\n', 'csv')
+        stale = timezone.now() - JOB_STALE_AFTER - timedelta(seconds=1)
+        KnowledgeImport.objects.filter(pk=running.pk).update(status='running', updated_at=stale)
+        fresh = self.create_job('question,answer\nq1,a1\n', 'csv')
+        KnowledgeImport.objects.filter(pk=fresh.pk).update(status='running')
+        done = self.create_job('question,answer\nq1,a1\n', 'csv')
+        KnowledgeImport.objects.filter(pk=done.pk).update(status='done', updated_at=stale)
+
+        self.assertEqual(fail_stale_import_jobs(), 1)
+        statuses = dict(KnowledgeImport.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {running.pk: 'failed', fresh.pk: 'running', done.pk: 'done'})
+
+
+class FakeRerankClient:
+    """重排接口替身，按 scores 返回各候选的相关性得分"""
+
+    def __init__(self, scores, error=None):
+        self.scores = scores
+        self.error = error
+        self.bodies = []
+
+    def post(self, path, body, cast_to):
+        self.bodies.append(body)
+        if self.error:
+            raise RuntimeError(self.error)
+        return {'results': [
+            {'index': index, 'relevance_score': score} for index, score in enumerate(self.scores)
+        ]}
+
+
+class RerankTests(SimpleTestCase):
+    def setUp(self):
+        from chat.models import AIModel, Application
+        self.cache = RerankCache(LocMemBackend())
+        patcher = mock.patch('embeddings.rerank._cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.rerank_model = AIModel(pk=1, name='bge-reranker', model_type='RERANK', api_url='http://rerank.local/v1/')
+        self.application = Application(
+            name='app', max_knowledge_items=2, rerank_candidates=5, rerank_threshold=0.2,
+            rerank_model=self.rerank_model
+        )
+        self.candidates = [(knowledge_id, f'答案{knowledge_id}', 0.9 - knowledge_id / 100) for knowledge_id in range(5)]
+
+    def rerank(self, client):
+        with mock.patch('embeddings.rerank.get_openai_client', return_value=client):
+            return rerank_knowledge(self.application, '如何退款', self.candidates)
+
+    def test_results_are_reordered_and_truncated(self):
+        client = FakeRerankClient([0.1, 0.3, 0.95, 0.25, 0.8])
+        results = self.rerank(client)
+        # 按重排得分取前 max_knowledge_items 条，得分替换为重排得分
+        self.assertEqual([item[:2] for item in results], [(2, '答案2'), (4, '答案4')])
+        self.assertEqual([round(item[2], 4) for item in results], [0.95, 0.8])
+        self.assertEqual(client.bodies[0]['documents'], [answer for _, answer, _ in self.candidates])
+
+    def test_threshold_drops_low_scores(self):
+        results = self.rerank(FakeRerankClient([0.1, 0.3, 0.15, 0.05, 0.1]))
+        self.assertEqual([item[0] for item in results], [1])
+
+    def test_scores_are_cached_per_endpoint(self):
+        self.rerank(FakeRerankClient([0.1, 0.3, 0.95, 0.25, 0.8]))
+        client = FakeRerankClient([0.9, 0, 0, 0, 0])
+        self.assertEqual([item[0] for item in self.rerank(client)], [2, 4])
+        self.assertEqual(client.bodies, [])
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        # 换用其他接口地址的同名模型时不使用缓存
+        self.rerank_model.api_url = 'http://rerank2.local/v1/'
+        self.assertEqual([item[0] for item in self.rerank(client)], [0])
+
+    def test_api_error_falls_back_to_vector_order(self):
+        results = self.rerank(FakeRerankClient([], error='接口超时'))
+        self.assertEqual(results, self.candidates[:2])
+
+    def test_without_rerank_model_vector_results_are_truncated(self):
+        self.application.rerank_model = None
+        self.assertEqual(rerank_knowledge(self.application, '如何退款', self.candidates), self.candidates[:2])
+
+    def test_async_rerank_shares_the_cache(self):
+        class AsyncClient(FakeRerankClient):
+            async def post(self, *args, **kwargs):
+                return FakeRerankClient.post(self, *args, **kwargs)
+
+        client = AsyncClient([0.1, 0.3, 0.95, 0.25, 0.8])
+        with mock.patch('embeddings.rerank.get_async_openai_client', return_value=client):
+            results = asyncio.run(arerank_knowledge(self.application, '如何退款', self.candidates))
+        self.assertEqual([item[0] for item in results], [2, 4])
+        self.assertEqual([item[0] for item in self.rerank(FakeRerankClient([]))], [2, 4])
+
+    def test_search_fetches_rerank_candidates(self):
+        index = mock.Mock()
+        with mock.patch('embeddings.services.get_knowledge_index', return_value=index), \
+                mock.patch('embeddings.services.schedule_missing_embeddings'):
+            search_knowledge(self.application, np.ones(4))
+            self.assertEqual(index.search.call_args.kwargs['top_k'], 5)
+            self.application.rerank_model = None
+            search_knowledge(self.application, np.ones(4))
+            self.assertEqual(index.search.call_args.kwargs['top_k'], 2)
+
+
+class SharedVectorFilesTests(TestCase):
+    """同一目录上的两个 KnowledgeIndex 相当于同一主机上的两个 worker"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.embedding_model = EmbeddingModel.objects.create(
+            name='emb', model_name='bge', api_url='http://embeddings.local/v1/', dimension=4
+        )
+        self.refund = add_knowledge(self.embedding_model, '如何退款', [1, 0, 0, 0])
+        self.first = self.worker()
+        self.first.sync()
+
+    def worker(self):
+        return KnowledgeIndex(self.embedding_model.pk, directory=self.directory)
+
+    def test_second_worker_maps_published_generation(self):
+        second = self.worker()
+        with mock.patch.object(KnowledgeIndex, '_load') as load:
+            second.sync()
+        load.assert_not_called()
+        self.assertEqual(second.generation, self.first.generation)
+        self.assertIsInstance(second.matrix, np.memmap)
+        self.assertEqual(second.search(np.array([1, 0, 0, 0]), 1, 0.5)[0][1], '如何退款的答案')
+
+    def test_newer_generation_is_adopted_without_recomputing(self):
+        second = self.worker()
+        second.sync()
+        self.refund.answer = '七天内可退'
+        self.refund.save()
+        self.first.sync()
+        self.assertEqual(self.first.generation, second.generation + 1)
+        with mock.patch.object(KnowledgeIndex, '_apply_changes') as apply_changes:
+            second.sync()
+        apply_changes.assert_not_called()
+        self.assertEqual(second.generation, self.first.generation)
+        self.assertEqual(second.search(np.array([1, 0, 0, 0]), 1, 0.5)[0][1], '七天内可退')
+
+    def test_worker_keeps_serving_while_another_publishes(self):
+        add_knowledge(self.embedding_model, '如何开票', [0, 1, 0, 0])
+        generation = self.first.generation
+        with self.first.store.lock(blocking=True):
+            self.first.sync()
+        # 未取得文件锁时不等待，继续使用当前一代
+        self.assertEqual(self.first.generation, generation)
+        self.assertEqual(self.first.search(np.array([0, 1, 0, 0]), 1, 0.5), [])
+        self.first.sync()
+        self.assertEqual(self.first.generation, generation + 1)
+        self.assertEqual(self.first.search(np.array([0, 1, 0, 0]), 1, 0.5)[0][1], '如何开票的答案')
+
+    def test_precision_change_publishes_quantized_generation(self):
+        generation = self.first.generation
+        self.assertIsNone(self.first.quantized)
+        self.first.precision = 'int8'
+        self.first.sync()
+        self.assertEqual(self.first.generation, generation + 1)
+        self.assertEqual(self.first.quantized.dtype, np.int8)
+        # 原始精度的向量仍随同一代发布，用于重排
+        self.assertEqual(self.first.matrix.dtype, np.float32)
+
+
+class GenerationStoreTests(SimpleTestCase):
+    def test_publish_swaps_current_and_removes_old_generations(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        store = GenerationStore(directory)
+        self.assertIsNone(store.current())
+        for value in range(1, 4):
+            with store.lock() as locked:
+                self.assertTrue(locked)
+                self.assertEqual(store.publish({'values': np.full(3, value)}), value)
+        self.assertEqual(store.current(), 3)
+        self.assertEqual(store.load(3)['values'].tolist(), [3, 3, 3])
+        generations = sorted(name for name in os.listdir(directory) if name.startswith('gen-'))
+        self.assertEqual(len(generations), KEEP_GENERATIONS)
+        # 持有锁时其他非阻塞获取失败
+        with store.lock(blocking=True), store.lock() as locked:
+            self.assertFalse(locked)
+
+
+class MemoryIndexMixin:
+    """不经过数据库，直接把数组装入 KnowledgeIndex"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def make_index(self, matrix, precision='float32'):
+        index = KnowledgeIndex(1, directory=self.directory, precision=precision)
+        ids = np.arange(1, len(matrix) + 1, dtype=np.int64)
+        answers = AnswerTable.pack([f'答案{knowledge_id}' for knowledge_id in ids])
+        arrays = quantize(matrix, precision)
+        index._swap(
+            ids, AnswerTable(answers['answers'], answers['answer_offsets']), matrix,
+            arrays.get('quantized'), arrays.get('scales')
+        )
+        return index
+
+
+class IVFRecallTests(MemoryIndexMixin, SimpleTestCase):
+    top_k = 10
+
+    def setUp(self):
+        super().setUp()
+        self.matrix = clustered_vectors(4000, 32, 40)
+        self.ids = np.arange(1, len(self.matrix) + 1, dtype=np.int64)
+        self.queries = nearby_queries(self.matrix, 50)
+
+    def recall(self, index):
+        found = 0
+        for query in self.queries:
+            expected = {int(self.ids[row]) for row in exact_top(self.matrix, query, self.top_k)}
+            found += len(expected.intersection(
+                knowledge_id for knowledge_id, _, _ in index.search(query, self.top_k, threshold=-1)
+            ))
+        return found / (len(self.queries) * self.top_k)
+
+    def test_recall_close_to_exact_search(self):
+        index = self.make_index(self.matrix)
+        ann = IVFIndex.from_arrays(1, build_ivf(self.ids, self.matrix, synced_until=0))
+        index._ann_mapping = AnnMapping.build(ann, index.ids)
+        with override_settings(KNOWLEDGE_ANN={'NPROBE': 16}):
+            self.assertGreaterEqual(self.recall(index), 0.95)
+        # 计算量约为精确检索的 NPROBE / nlist
+        self.assertLess(len(index._ann_mapping.candidate_rows(self.queries[0], 16)), len(self.matrix) / 2)
+
+    def test_probing_all_lists_is_exact(self):
+        index = self.make_index(self.matrix)
+        ann = IVFIndex.from_arrays(1, build_ivf(self.ids, self.matrix, synced_until=0))
+        index._ann_mapping = AnnMapping.build(ann, index.ids)
+        with override_settings(KNOWLEDGE_ANN={'NPROBE': list_count(len(self.matrix))}):
+            self.assertEqual(self.recall(index), 1.0)
+            query = self.queries[0]
+            self.assertEqual(
+                index.search(query, self.top_k, threshold=-1),
+                index.search(query, self.top_k, threshold=-1, exact=True)
+            )
+
+    def test_rows_added_after_build_are_searched_exactly(self):
+        # 索引只包含前3000条，之后新增的知识不在任何簇中，检索时单独计算
+        indexed = 3000
+        ann = IVFIndex.from_arrays(1, build_ivf(self.ids[:indexed], self.matrix[:indexed], synced_until=0))
+        index = self.make_index(self.matrix)
+        index._ann_mapping = mapping = AnnMapping.build(ann, index.ids)
+        self.assertEqual(len(mapping.delta_rows), len(self.matrix) - indexed)
+        with override_settings(KNOWLEDGE_ANN={'NPROBE': 16}):
+            for row in (indexed, len(self.matrix) - 1):
+                results = index.search(self.matrix[row], 1, threshold=-1)
+                self.assertEqual(results[0][0], int(self.ids[row]))
+
+    @mock.patch.object(KnowledgeIndex, '_map_ann', lambda self, ann, ids: AnnMapping.build(ann, ids))
+    def test_published_index_is_shared_through_the_directory(self):
+        index = self.make_index(self.matrix)
+        ann = index.build_ann()
+        self.assertEqual(index.ann_store.current(), ann.generation)
+        # 另一个进程中的索引直接加载已发布的一代，不再重新构建
+        other = self.make_index(self.matrix)
+        with override_settings(KNOWLEDGE_ANN={'MIN_SIZE': 1}), \
+                mock.patch.object(KnowledgeIndex, '_schedule_ann_build') as schedule:
+            other._refresh_ann()
+        schedule.assert_not_called()
+        self.assertEqual(other._ann_mapping.ann.generation, ann.generation)
+
+
+class QuantizedRescoreTests(MemoryIndexMixin, SimpleTestCase):
+    top_k = 10
+
+    def setUp(self):
+        super().setUp()
+        self.matrix = clustered_vectors(3000, 64, 30)
+        self.queries = nearby_queries(self.matrix, 30)
+
+    def test_float16_upcast_is_exact(self):
+        rng = np.random.default_rng(0)
+        values = np.concatenate([
+            rng.standard_normal(5000),
+            [0.0, -0.0, 6e-8, -6e-8, 1e-5, 65504.0, -65504.0],  # 含非规格化数与最大值
+        ]).astype(np.float16)
+        out = np.empty(values.shape, dtype=np.float32)
+        _upcast_float16(values, out)
+        np.testing.assert_array_equal(out.view(np.int32), values.astype(np.float32).view(np.int32))
+
+    def test_approximate_scores_on_selected_rows(self):
+        for precision in ('float16', 'int8'):
+            arrays = quantize(self.matrix, precision)
+            query = self.queries[0]
+            rows = np.array([5, 1, 2999, 1024, 1023])
+            full = approximate_scores(arrays['quantized'], arrays.get('scales'), query)
+            np.testing.assert_allclose(
+                approximate_scores(arrays['quantized'], arrays.get('scales'), query, rows), full[rows]
+            )
+            np.testing.assert_allclose(full, self.matrix @ query, atol=0.02)
+
+    def test_rescored_results_match_exact_order(self):
+        for precision in ('float16', 'int8'):
+            index = self.make_index(self.matrix, precision)
+            self.assertIsNotNone(index.quantized)
+            for query in self.queries:
+                results = index.search(query, self.top_k, threshold=-1)
+                expected = index.search(query, self.top_k, threshold=-1, exact=True)
+                self.assertEqual([item[0] for item in results], [item[0] for item in expected], precision)
+                # 得分按原始精度重新计算，结果按得分降序
+                scores = [item[2] for item in results]
+                self.assertEqual(scores, [item[2] for item in expected])
+                self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_threshold_applies_to_rescored_scores(self):
+        index = self.make_index(self.matrix, 'int8')
+        query = self.queries[0]
+        expected = index.search(query, self.top_k, threshold=-1, exact=True)
+        threshold = expected[3][2]
+        results = index.search(query, self.top_k, threshold=threshold)
+        self.assertEqual(results, expected[:4])
+
+
+class BenchmarkKnowledgeIndexCommandTests(TestCase):
+    def test_model_benchmark_leaves_live_index_untouched(self):
+        live = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, live, True)
+        embedding_model = EmbeddingModel.objects.create(
+            name='emb', model_name='bge', api_url='http://embeddings.local/v1/', dimension=8
+        )
+        items = [Knowledge(question=f'q{row}', answer=f'a{row}', model=embedding_model) for row in range(200)]
+        for item, vector in zip(items, clustered_vectors(len(items), 8, 4)):
+            item.set_embedding(vector)
+        Knowledge.objects.bulk_create(items)
+
+        stdout = mock.MagicMock()
+        with override_settings(KNOWLEDGE_VECTOR_STORE={'BACKEND': 'memory', 'DIRECTORY': live}), \
+                mock.patch.dict('embeddings.index._indexes', clear=True):
+            call_command('benchmark_knowledge_index', '--model', str(embedding_model.pk),
+                         '--queries', '10', '--k', '5', '--nprobe', '4', stdout=stdout)
+        self.assertTrue(any('recall@5' in str(call) for call in stdout.write.call_args_list))
+        self.assertEqual(os.listdir(live), [])
+
+
+class SyncKnowledgeVectorsCommandTests(TestCase):
+    def setUp(self):
+        self.embedding_model = EmbeddingModel.objects.create(
+            name='emb', model_name='bge', api_url='http://embeddings.local/v1/', dimension=4
+        )
+        with mock.patch('embeddings.services.schedule_missing_embeddings'):
+            self.knowledge = Knowledge.objects.create(question='退货', answer='七天无理由', model=self.embedding_model)
+
+    def test_fills_missing_embeddings_with_memory_backend(self):
+        with mock.patch('embeddings.services.embed_texts', side_effect=fake_vectors):
+            call_command('sync_knowledge_vectors', stdout=mock.MagicMock())
+        self.knowledge.refresh_from_db()
+        self.assertIsNotNone(self.knowledge.embedding)
+
+    def test_syncs_lexical_index(self):
+        with mock.patch.dict('embeddings.lexical._indexes', clear=True), \
+                mock.patch('embeddings.lexical._fts5_available', None), \
+                mock.patch('embeddings.services.embed_texts', side_effect=fake_vectors):
+            if not fts5_available():
+                self.skipTest('SQLite 不支持 FTS5')
+            with mock.patch.object(LexicalIndex, 'schedule_sync'):
+                self.assertIsNone(get_lexical_index(self.embedding_model))
+            call_command('sync_knowledge_vectors', stdout=mock.MagicMock())
+            index = get_lexical_index(self.embedding_model)
+            self.assertEqual(index.search('退货', 5)[0][0], self.knowledge.pk)
+
+    def test_rebuild_requires_pgvector(self):
+        with self.assertRaises(CommandError):
+            call_command('sync_knowledge_vectors', '--rebuild')
+
+
+def pgvector_configured() -> bool:
+    config = store_config()
+    return (
+        config['BACKEND'] == 'pgvector'
+        and config['DATABASE'] in settings.DATABASES
+        and any(importlib.util.find_spec(name) for name in ('psycopg2', 'psycopg'))
+    )
+
+
+class PgVectorDispatchTests(SimpleTestCase):
+
+    def test_vector_literal(self):
+        self.assertEqual(_vector_literal(np.array([0.5, -1, 1e-8], dtype=np.float32)), '[0.5,-1,1e-08]')
+
+    def test_pgvector_backend_is_selected(self):
+        embedding_model = EmbeddingModel(pk=987, name='emb', dimension=4)
+        store = {'BACKEND': 'pgvector', 'DATABASE': 'vectors'}
+        with override_settings(KNOWLEDGE_VECTOR_STORE=store), \
+                mock.patch.dict('embeddings.pgvector._indexes', clear=True), \
+                mock.patch.object(PgVectorIndex, 'sync') as sync:
+            index = get_knowledge_index(embedding_model)
+        self.assertIsInstance(index, PgVectorIndex)
+        self.assertEqual(index.table, 'knowledge_vector_987')
+        sync.assert_called_once_with()
+
+
+@unittest.skipUnless(
+    pgvector_configured(),
+    "需要 KNOWLEDGE_VECTOR_STORE['BACKEND'] 为 pgvector、已配置对应数据库并安装 PostgreSQL 驱动"
+)
+class PgVectorIndexTests(TestCase):
+    # 未配置时不声明该连接，测试运行器会为声明的连接做检查与建库
+    databases = {'default', store_config()['DATABASE']} if pgvector_configured() else {'default'}
+    dimension = 16
+    top_k = 5
+
+    def setUp(self):
+        self.embedding_model = EmbeddingModel.objects.create(
+            name='emb', model_name='bge', api_url='http://embedding.invalid/v1', api_key='k',
+            dimension=self.dimension
+        )
+        self.matrix = clustered_vectors(300, self.dimension, 10)
+        items = [
+            Knowledge(question=f'q{row}', answer=f'a{row}', model=self.embedding_model)
+            for row in range(len(self.matrix))
+        ]
+        for item, vector in zip(items, self.matrix):
+            item.set_embedding(vector)
+        self.items = Knowledge.objects.bulk_create(items)
+        self.ids = np.array([item.pk for item in self.items], dtype=np.int64)
+
+    def make_index(self, **config):
+        index = PgVectorIndex(self.embedding_model.pk, {**store_config(), **config})
+        try:
+            index.sync()
+        except DatabaseError as e:
+            self.skipTest(f"pgvector 不可用: {str(e)}")
+        return index
+
+    def assert_matches_exact(self, index, matrix, ids):
+        found = 0
+        queries = nearby_queries(matrix, 20)
+        for query in queries:
+            results = index.search(query, self.top_k, threshold=-1)
+            expected = [int(ids[row]) for row in exact_top(matrix, query, self.top_k)]
+            self.assertEqual(results[0][0], expected[0])
+            found += len(set(expected).intersection(item[0] for item in results))
+            scores = dict(zip(ids.tolist(), (matrix @ query).tolist()))
+            for knowledge_id, _, score in results:
+                self.assertAlmostEqual(score, scores[knowledge_id], places=4)
+        self.assertGreaterEqual(found / (len(queries) * self.top_k), 0.9)
+
+    def test_hnsw_search_matches_exact_search(self):
+        index = self.make_index(INDEX_TYPE='hnsw')
+        self.assertEqual(index.dimension, self.dimension)
+        self.assert_matches_exact(index, self.matrix, self.ids)
+
+    def test_ivfflat_search_matches_exact_search(self):
+        index = self.make_index(INDEX_TYPE='ivfflat', IVFFLAT_LISTS=10, IVFFLAT_PROBES=10)
+        self.assert_matches_exact(index, self.matrix, self.ids)
+
+    def test_sync_applies_updates_and_deletes(self):
+        index = self.make_index()
+        removed, changed = self.items[0], self.items[1]
+        removed.delete()
+        vector = normalize(np.random.default_rng(5).standard_normal(self.dimension))
+        changed.set_embedding(vector)
+        changed.updated_at = timezone.now()
+        Knowledge.objects.bulk_update([changed], ['embedding', 'updated_at'])
+        index.sync()
+        self.assertEqual(index.search(vector, 1, threshold=-1)[0][0], changed.pk)
+        self.assertNotIn(
+            removed.pk, [item[0] for item in index.search(self.matrix[0], self.top_k, threshold=-1)]
+        )
+
+    def test_rebuild_after_dimension_change(self):
+        index = self.make_index()
+        self.embedding_model.dimension = 8
+        self.embedding_model.save()
+        matrix = clustered_vectors(len(self.items), 8, 5, seed=3)
+        for item, vector in zip(self.items, matrix):
+            item.set_embedding(vector)
+            item.updated_at = timezone.now()
+        Knowledge.objects.bulk_update(self.items, ['embedding', 'updated_at'])
+        self.assertEqual(index.rebuild(), len(self.items))
+        self.assertEqual(index.dimension, 8)
+        self.assert_matches_exact(index, matrix, self.ids)
@@ -11,6 +11,8 @@ def run_migrations():
         # 确保静态文件和媒体目录存在
         Path('/gongjuyuan_chat/staticfiles').mkdir(parents=True, exist_ok=True)
         Path('/gongjuyuan_chat/media').mkdir(parents=True, exist_ok=True)
+        # 数据库文件不随代码提交，首次启动时建表，升级后补齐新的迁移
+        subprocess.run(['python', 'manage.py', 'migrate', '--noinput'], check=True)
         subprocess.run(['python', 'manage.py', 'collectstatic', '--noinput'], check=True)
     except subprocess.CalledProcessError as e:
       
@@ -23,6 +25,32 @@ def main():
     # 运行迁移
     run_migrations()
 
+    if os.environ.get('SERVER_MODE') == 'asgi':
+        run_asgi()
+    else:
+        run_uwsgi()
+
+def run_asgi():
+    """启动 uvicorn（ASGI），流式对话走异步视图，单进程可同时保持大量SSE连接"""
+    uvicorn_args = [
+        'uvicorn',
+        'gongjuyuan_chat.asgi:application',
+        '--host', '0.0.0.0',
+        '--port', '8000',
+        '--app-dir', '/gongjuyuan_chat',
+        '--workers', os.environ.get('ASGI_WORKERS', '2'),
+        '--proxy-headers',
+        '--forwarded-allow-ips', '*',
+        '--timeout-keep-alive', '75',
+        '--no-access-log',
+    ]
+
+    try:
+        os.execvp('uvicorn', uvicorn_args)
+    except Exception as e:
+        sys.exit(1)
+
+def run_uwsgi():
     # 启动 uWSGI
     uwsgi_args = [
         '/usr/local/bin/uwsgi',
@@ -91,13 +91,24 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'gongjuyuan_chat.wsgi.application'
+ASGI_APPLICATION = 'gongjuyuan_chat.asgi.application'
 
+# 运行方式：wsgi（uWSGI，默认）或 asgi（uvicorn），见 entrypoint.py
+SERVER_MODE = os.environ.get('SERVER_MODE', 'wsgi')
+# ASGI 下流式对话使用异步视图（AsyncOpenAI + 异步ORM）
+CHAT_ASYNC_STREAMING = SERVER_MODE == 'asgi'
 
 
+
+# SQLite 使用 WAL 模式及调优后的 PRAGMA（见 gongjuyuan_chat/sqlite_wal/base.py）
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'ENGINE': 'gongjuyuan_chat.sqlite_wal',
+        'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+        'OPTIONS': {
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
@@ -142,6 +153,123 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # API_URL = 'http://127.0.0.1:9000'  # 开发环境
 # API_URL = 'https://您的域名'  # 生产环境
 
+# 模型客户端连接池（同一API地址与密钥在进程内复用连接，见 chat/clients.py）
+OPENAI_CLIENT_POOL = {
+    'MAX_CONNECTIONS': 100,
+    'MAX_KEEPALIVE_CONNECTIONS': 20,
+    'KEEPALIVE_EXPIRY': 60,
+    'CONNECT_TIMEOUT': 10,
+    'READ_TIMEOUT': 300,
+    'HTTP2': True,
+    'MAX_RETRIES': 2,
+}
+
+# 查询向量缓存（BACKEND 可选 locmem / django / sqlite，sqlite 可在多个 worker 间共享）
+EMBEDDING_QUERY_CACHE = {
+    'BACKEND': 'sqlite',
+    'PATH': BASE_DIR / 'embedding_cache.sqlite3',
+    'MAX_SIZE': 10000,
+    'TTL': 24 * 60 * 60,
+}
+
+# 知识关键词检索（SQLite FTS5），用于混合检索与向量接口不可用时的退路（见 embeddings/lexical.py）
+KNOWLEDGE_LEXICAL = {
+    'ENABLED': True,
+    'CANDIDATES': 20,
+    'MIN_OVERLAP': 0.3,
+    'MIN_SIMILARITY': 0.3,
+    'RRF_K': 60,
+}
+
+# 知识重排结果缓存（应用配置了重排模型时使用，见 embeddings/rerank.py）
+RERANK_CACHE = {
+    'BACKEND': 'sqlite',
+    'PATH': BASE_DIR / 'embedding_cache.sqlite3',
+    'TABLE': 'rerank_result',
+    'MAX_SIZE': 10000,
+    'TTL': 60 * 60,
+}
+
+# 模型回答的语义缓存（应用开启"回答缓存"时使用，见 chat/response_cache.py）
+RESPONSE_CACHE = {
+    'BACKEND': 'sqlite',
+    'PATH': BASE_DIR / 'embedding_cache.sqlite3',
+    'TABLE': 'response_cache',
+    'MAX_SIZE': 10000,
+    'TTL': 60 * 60,
+    'SIMILARITY_THRESHOLD': 0.97,
+    'GROUP_SIZE': 16,
+    'SINGLE_TURN_ONLY': True,
+}
+
+# 向量接口熔断：连续失败（出错或超出应用的检索时间预算）达到次数后暂停调用，改用关键词检索（见 embeddings/breaker.py）
+EMBEDDING_CIRCUIT_BREAKER = {
+    'FAILURE_THRESHOLD': 3,
+    'COOL_DOWN': 30,
+}
+
+# 按模型限流（AIModel 的最大并发请求数 / RPM / TPM），计数保存在所有 worker 共享的存储中（见 chat/ratelimit.py）
+MODEL_RATE_LIMIT = {
+    'BACKEND': 'sqlite',
+    'PATH': BASE_DIR / 'rate_limit.sqlite3',
+    'MAX_WAIT': 10,
+    'POLL_INTERVAL': 0.25,
+    'LEASE_TTL': 600,
+}
+
+# 知识向量存储：memory（默认，向量文件保存在 DIRECTORY 下，各 worker 内存映射共享，见 embeddings/index.py）
+# 或 pgvector（见 embeddings/pgvector.py）
+KNOWLEDGE_VECTOR_STORE = {
+    'BACKEND': os.environ.get('KNOWLEDGE_VECTOR_BACKEND', 'memory'),
+    'DIRECTORY': os.path.join(MEDIA_ROOT, 'knowledge_index'),
+    'DATABASE': 'vectors',
+    'INDEX_TYPE': os.environ.get('PGVECTOR_INDEX_TYPE', 'hnsw'),
+}
+if KNOWLEDGE_VECTOR_STORE['BACKEND'] == 'pgvector':
+    DATABASES['vectors'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('PGVECTOR_DB', 'gongjuyuan_vectors'),
+        'USER': os.environ.get('PGVECTOR_USER', 'postgres'),
+        'PASSWORD': os.environ.get('PGVECTOR_PASSWORD', ''),
+        'HOST': os.environ.get('PGVECTOR_HOST', 'localhost'),
+        'PORT': os.environ.get('PGVECTOR_PORT', '5432'),
+        'CONN_MAX_AGE': 60,
+    }
+
+# memory 存储的近似最近邻（IVF）索引，与知识向量文件保存在同一目录（见 embeddings/ann.py）
+KNOWLEDGE_ANN = {
+    'ENABLED': True,
+    'MIN_SIZE': 20000,
+    'NPROBE': 16,
+    'REBUILD_RATIO': 0.1,
+}
+
+# 对话历史窗口：按模型上下文上限（AIModel.max_tokens_limit，未设置时用 DEFAULT_CONTEXT_TOKENS）保留最近的消息
+CHAT_HISTORY_WINDOW = {
+    'MAX_MESSAGES': 40,
+    'DEFAULT_CONTEXT_TOKENS': 8192,
+}
+
+# 调用模型前并发执行知识检索与保存用户消息的线程池，同时进行的检索最多占用一半线程（见 chat/services.py prepare_generation）
+CHAT_PREGENERATION = {
+    'WORKERS': 8,
+}
+
+# 会话滚动摘要（应用配置了摘要模型时在后台生成，见 chat/summary.py）
+CHAT_SUMMARY = {
+    'TRIGGER_TOKENS': 3000,
+    'KEEP_RECENT': 6,
+    'MAX_TOKENS': 600,
+    'WORKERS': 2,
+}
+
+# 模型使用统计写缓冲（进程内按 模型/日期/应用 累加后批量写入，见 chat/usage.py）
+USAGE_STATS_BUFFER = {
+    'ENABLED': True,
+    'FLUSH_INTERVAL': 5,
+    'MAX_PENDING': 200,
+}
+
 
 
 # 静态文件设置
@@ -0,0 +1,65 @@
+"""启用 WAL 的 SQLite 数据库后端
+
+在 Django 自带 sqlite3 后端的基础上，每个新连接建立时执行一组 PRAGMA：
+WAL 日志模式下读写互不阻塞，多个 worker 同时保存消息时不再频繁出现 "database is locked"。
+在 settings.DATABASES 中使用::
+
+    DATABASES = {
+        'default': {
+            'ENGINE': 'gongjuyuan_chat.sqlite_wal',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                'timeout': 20,                  # 等待锁的超时（秒），同时用作 busy_timeout
+                'transaction_mode': 'IMMEDIATE',  # atomic() 以 BEGIN IMMEDIATE 开始事务
+                'pragmas': {'cache_size': -64000},  # 覆盖或追加 PRAGMA
+            },
+        }
+    }
+
+transaction_mode 为 IMMEDIATE 时事务开始即获取写锁，等待时受 busy_timeout 约束；
+默认的 DEFERRED 事务在读后升级为写时若遇到冲突会直接报错，不会等待。
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+from django.utils.asyncio import async_unsafe
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 128 * 1024 * 1024,
+    'cache_size': -20000,  # 负数表示KB，约20MB
+    'temp_store': 'MEMORY',
+}
+
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_connection_params(self):
+        options = self.settings_dict['OPTIONS']
+        # busy_timeout 默认与 timeout 选项一致（毫秒）
+        self.pragmas = {
+            **DEFAULT_PRAGMAS,
+            'busy_timeout': int(options.get('timeout', 5) * 1000),
+            **options.get('pragmas', {}),
+        }
+        self.transaction_mode = options.get('transaction_mode', 'IMMEDIATE').upper()
+        if self.transaction_mode not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(
+                f"transaction_mode 必须是 {', '.join(TRANSACTION_MODES)} 之一"
+            )
+        kwargs = super().get_connection_params()
+        kwargs.pop('pragmas', None)
+        kwargs.pop('transaction_mode', None)
+        return kwargs
+
+    @async_unsafe
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f"BEGIN {self.transaction_mode}")